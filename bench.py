@@ -0,0 +1,372 @@
+# bench.py
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from itertools import product
+
+import client
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+SERVER_IP = '127.0.0.1'
+TCP_PORT = 30002
+UDP_PORT = 30001
+SERVER_START_TIMEOUT = 10  # Seconds to wait for a server subprocess to accept connections
+DEFAULT_THRESHOLD = 0.1  # Relative throughput drop flagged as a regression
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Record fields compared against the baseline, with True when higher is better
+COMPARED_METRICS = {'tcp_throughput': True, 'udp_throughput': True, 'udp_success_rate': True}
+CONFIG_FIELDS = ('mode', 'workers', 'datagram_size', 'file_size', 'tcp_connections', 'udp_connections', 'verify')
+
+# ANSI Color Codes
+GREEN = '\033[92m'
+ERROR = '\033[91m'
+METRIC_COLOR = '\033[93m'
+RESET = '\033[0m'
+
+
+def int_list(value):
+    """
+    Parses a comma separated list of integers from the command line.
+    """
+    return [int(item) for item in value.split(',') if item]
+
+
+def process_usage(pid):
+    """
+    Reads the CPU time and peak resident memory of a process from /proc.
+
+    Returns:
+        tuple: CPU seconds and peak RSS in kB, both None where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime and stime
+        with open(f'/proc/{pid}/status') as f:
+            peak_rss = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        return cpu_time, peak_rss
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None, None
+
+
+def process_tree(pid):
+    """
+    Returns `pid` followed by the PIDs of all its descendants, such as the workers of a server, read from /proc.
+    """
+    children = {}
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue  # Exited while listing
+        children.setdefault(parent, []).append(int(entry))
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children.get(parent, []))
+    return pids
+
+
+def reset_peak_rss(pids):
+    """
+    Resets the peak RSS of the processes to their current RSS, so the next `tree_usage` reports the peak of
+    what ran in between rather than of the processes' whole lifetime.
+    """
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass  # Not Linux, or the process already exited
+
+
+def tree_usage(pids):
+    """
+    Reads the CPU time and peak RSS of every process of a process tree.
+
+    Returns:
+        tuple: CPU seconds by PID, and the sum of the peak RSS in kB of the processes, None where /proc
+            is not available.
+    """
+    cpu_times = {}
+    peak_rss = None
+    for pid in pids:
+        cpu_time, rss = process_usage(pid)
+        if cpu_time is None:
+            continue
+        cpu_times[pid] = cpu_time
+        peak_rss = (peak_rss or 0) + rss
+    return cpu_times, peak_rss
+
+
+@contextlib.contextmanager
+def server_process(mode, workers, datagram_size):
+    """
+    Runs `server.py` in a subprocess for the duration of the block and waits until it accepts TCP connections.
+    The server gets its own process group, so stopping it also stops its worker processes.
+
+    Yields:
+        subprocess.Popen: The server process.
+    """
+    command = [sys.executable, SERVER_PATH, '--mode', mode, '--workers', str(workers),
+               '--datagram-size', str(datagram_size)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                socket.create_connection((SERVER_IP, TCP_PORT), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Server did not start listening in time")
+                time.sleep(0.1)
+        yield process
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+
+def run_downloads(file_size, tcp_connections, udp_connections, verify=False):
+    """
+    Runs concurrent TCP and UDP downloads against the server, the same way `client.main` does, with
+    checksummed payloads when `verify` is set.
+
+    Returns:
+        tuple: The wall time in seconds and the results of the downloads that completed.
+    """
+    results = []
+    lock = threading.Lock()
+
+    def download(target, *args):
+        result = target(*args, verify=verify)
+        if result:
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=download, args=(client.tcp_download, SERVER_IP, TCP_PORT, file_size, i))
+               for i in range(1, tcp_connections + 1)]
+    threads += [threading.Thread(target=download, args=(client.udp_download, SERVER_IP, UDP_PORT, file_size, i))
+                for i in range(1, udp_connections + 1)]
+
+    start_time = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start_time, results
+
+
+def run_case(server, file_size, tcp_connections, udp_connections, verify=False, verbose=False):
+    """
+    Runs one benchmark case against a running server and measures it.
+
+    Server CPU time and peak RSS cover the server process and all its workers, and peak RSS is reset
+    before the case, so both the server and the client report the peak of this case alone.
+
+    Returns:
+        dict: Throughput, loss, CPU time and peak memory of the case, and the client time spent verifying
+            checksums and the corrupt blocks found when `verify` is set.
+    """
+    server_pids = process_tree(server.pid)
+    reset_peak_rss(server_pids + [os.getpid()])
+    server_cpu_before, _ = tree_usage(server_pids)
+    client_usage_before = resource.getrusage(resource.RUSAGE_SELF)
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        wall_time, results = run_downloads(file_size, tcp_connections, udp_connections, verify)
+
+    server_cpu_after, server_peak_rss = tree_usage(process_tree(server.pid))
+    client_usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, client_peak_rss = process_usage(os.getpid())
+
+    tcp_results = [result for result in results if result['protocol'] == 'tcp']
+    udp_results = [result for result in results if result['protocol'] == 'udp']
+    return {
+        'wall_time': wall_time,
+        'tcp_completed': len(tcp_results),
+        'udp_completed': len(udp_results),
+        'tcp_throughput': sum(result['throughput'] for result in tcp_results),
+        'udp_throughput': sum(result['throughput'] for result in udp_results),
+        'udp_success_rate': (sum(result['success_rate'] for result in udp_results) / len(udp_results)
+                             if udp_results else None),
+        'server_cpu_time': (sum(cpu_time - server_cpu_before.get(pid, 0)
+                                for pid, cpu_time in server_cpu_after.items()) if server_cpu_after else None),
+        'server_peak_rss_kb': server_peak_rss,
+        'client_cpu_time': (client_usage.ru_utime + client_usage.ru_stime
+                            - client_usage_before.ru_utime - client_usage_before.ru_stime),
+        'client_peak_rss_kb': client_peak_rss,
+        'verify_time': sum(result.get('verify_time', 0) for result in results),
+        'corrupt': sum(result.get('corrupt', 0) for result in results),
+    }
+
+
+def run_benchmark(args):
+    """
+    Sweeps every combination of the requested server and client parameters.
+
+    Returns:
+        list: One record per case, holding its configuration and measurements.
+    """
+    records = []
+    for mode, workers, datagram_size in product(args.modes, args.workers, args.datagram_sizes):
+        with server_process(mode, workers, datagram_size) as server:
+            for file_size, tcp_connections, udp_connections, verify in product(args.sizes, args.tcp_connections,
+                                                                              args.udp_connections, args.verify):
+                if tcp_connections == udp_connections == 0:
+                    continue
+                for _ in range(args.repeat):
+                    record = {'mode': mode, 'workers': workers, 'datagram_size': datagram_size,
+                              'file_size': file_size, 'tcp_connections': tcp_connections,
+                              'udp_connections': udp_connections, 'verify': verify}
+                    record.update(run_case(server, file_size, tcp_connections, udp_connections, bool(verify),
+                                           args.verbose))
+                    records.append(record)
+                    print_record(record)
+    return records
+
+
+def print_record(record):
+    config = ' '.join(f"{field}={record[field]}" for field in CONFIG_FIELDS)
+    success_rate = record['udp_success_rate']
+    print(f"{GREEN}[Bench]{RESET} {config}: "
+          f"TCP {METRIC_COLOR}{record['tcp_throughput'] / 1e6:.2f} MB/s{RESET}, "
+          f"UDP {METRIC_COLOR}{record['udp_throughput'] / 1e6:.2f} MB/s{RESET}"
+          + (f" at {METRIC_COLOR}{success_rate:.2f}%{RESET}" if success_rate is not None else "")
+          + f", {METRIC_COLOR}{record['wall_time']:.2f} s{RESET} wall"
+          + (f", {METRIC_COLOR}{record['verify_time'] * 1000:.2f} ms{RESET} verifying, "
+             f"{METRIC_COLOR}{record['corrupt']}{RESET} corrupt" if record['verify'] else ""))
+
+
+def write_records(records, path):
+    """
+    Writes the records as JSON, or as CSV when `path` ends with .csv.
+    """
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=list(records[0]) if records else [])
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, f, indent=2)
+
+
+def read_records(path):
+    """
+    Reads records written by `write_records`.
+    """
+    with open(path, newline='') as f:
+        if not path.endswith('.csv'):
+            return json.load(f)
+        records = []
+        for row in csv.DictReader(f):
+            records.append({key: value if key == 'mode' else (float(value) if value else None)
+                            for key, value in row.items()})
+        return records
+
+
+def config_key(record):
+    # Records written before a field was added count as its default
+    return (record['mode'],) + tuple(int(record.get(field) or 0) for field in CONFIG_FIELDS[1:])
+
+
+def average_by_config(records):
+    """
+    Averages the compared metrics of repeated runs of the same case.
+    """
+    grouped = {}
+    for record in records:
+        grouped.setdefault(config_key(record), []).append(record)
+    averages = {}
+    for key, group in grouped.items():
+        averages[key] = {}
+        for metric in COMPARED_METRICS:
+            values = [record[metric] for record in group if record.get(metric) is not None]
+            averages[key][metric] = sum(values) / len(values) if values else None
+    return averages
+
+
+def compare_to_baseline(records, baseline, threshold):
+    """
+    Compares the averaged metrics of each case to the same case in the baseline.
+
+    Returns:
+        list: A description of every metric that got worse by more than `threshold`.
+    """
+    regressions = []
+    current = average_by_config(records)
+    previous = average_by_config(baseline)
+    for key, metrics in current.items():
+        if key not in previous:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            new, old = metrics[metric], previous[key][metric]
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                config = ' '.join(f"{field}={value}" for field, value in zip(CONFIG_FIELDS, key))
+                regressions.append(f"{config}: {metric} {old:.2f} -> {new:.2f} ({change * 100:+.1f}%)")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the speed test server and client over loopback.")
+    parser.add_argument('--sizes', type=int_list, default=[10_000_000, 100_000_000],
+                        help="Comma separated file sizes in bytes.")
+    parser.add_argument('--tcp-connections', type=int_list, default=[1, 4],
+                        help="Comma separated numbers of concurrent TCP downloads.")
+    parser.add_argument('--udp-connections', type=int_list, default=[0, 1],
+                        help="Comma separated numbers of concurrent UDP downloads.")
+    parser.add_argument('--datagram-sizes', type=int_list, default=[1024],
+                        help="Comma separated server UDP datagram sizes.")
+    parser.add_argument('--modes', type=lambda value: value.split(','), default=['threaded', 'asyncio'],
+                        help="Comma separated server modes.")
+    parser.add_argument('--workers', type=int_list, default=[1],
+                        help="Comma separated numbers of server worker processes.")
+    parser.add_argument('--verify', type=int_list, default=[0],
+                        help="Comma separated 0 or 1: download plain payloads, or checksummed ones verified by the "
+                             "client. '0,1' measures the cost of verification.")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs of every case.")
+    parser.add_argument('--output', help="Write the results to this .json or .csv file.")
+    parser.add_argument('--baseline', help="Compare the results to a .json or .csv file written by an earlier run.")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative drop of a metric reported as a regression.")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of every download.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    records = run_benchmark(args)
+    if args.output:
+        write_records(records, args.output)
+        print(f"{GREEN}[Bench]{RESET} Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare_to_baseline(records, read_records(args.baseline), args.threshold)
+        for regression in regressions:
+            print(f"{ERROR}[Regression]{RESET} {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"{GREEN}[Bench]{RESET} No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
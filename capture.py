@@ -0,0 +1,126 @@
+# capture.py
+import atexit
+import mmap
+import struct
+import threading
+import time
+from collections import namedtuple
+
+TRACE_MAGIC = b'CHTRACE1'
+TRACE_HEADER = struct.Struct('<8sI')  # Magic and record size, so readers can reject files of another layout
+# Timestamp in ns since the epoch, segment number (byte offset for TCP), total segments (end of the range for
+# TCP), bytes on the wire, stream, message type and flags
+TRACE_RECORD = struct.Struct('<qQQIIBB')
+TRACE_GROW_SIZE = 16 * 1024 * 1024  # Bytes the trace file and its mapping grow by when full
+
+# Record flags
+SENT = 0x1  # Recorded by the sender, otherwise by the receiver
+TCP = 0x2  # A TCP send or receive call, otherwise a UDP datagram
+CHECKSUMMED = 0x4  # A UDP datagram whose header carries the CRC32 of its payload
+
+TraceRecord = namedtuple('TraceRecord', 'timestamp segment total size stream msg_type flags')
+
+
+class TraceWriter:
+    """
+    Appends fixed-size binary records to a memory-mapped trace file.
+
+    Records are packed straight into the mapping, so capturing a packet costs a lock and a `pack_into`
+    and no system call. The file grows `TRACE_GROW_SIZE` bytes at a time and is cut back to its records
+    on `close`. A trace left behind by a process that never closed it ends in zeroed records, which
+    `read_trace` skips. One writer is shared by every thread of a process, each transfer recording under
+    its own stream number from `new_stream`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w+b')
+        self._map = None
+        self._size = 0
+        self._offset = TRACE_HEADER.size
+        self._streams = 0
+        self._lock = threading.Lock()
+        self._grow()
+        TRACE_HEADER.pack_into(self._map, 0, TRACE_MAGIC, TRACE_RECORD.size)
+
+    def _grow(self):
+        if self._map is not None:
+            self._map.close()
+        self._size += TRACE_GROW_SIZE
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+    def new_stream(self):
+        with self._lock:
+            self._streams += 1
+            return self._streams
+
+    def record(self, stream, msg_type, flags, segment, total, size, timestamp=None):
+        """
+        Appends one record, timestamped now unless `timestamp` is given.
+        """
+        timestamp = time.time_ns() if timestamp is None else timestamp
+        with self._lock:
+            if self._map is None:
+                return
+            if self._offset + TRACE_RECORD.size > self._size:
+                self._grow()
+            TRACE_RECORD.pack_into(self._map, self._offset, timestamp, segment, total, size, stream, msg_type, flags)
+            self._offset += TRACE_RECORD.size
+
+    def record_batch(self, stream, msg_type, flags, segments, total, sizes, timestamp=None):
+        """
+        Appends one record per segment of a batch sent in one call, all with the same timestamp.
+        """
+        timestamp = time.time_ns() if timestamp is None else timestamp
+        with self._lock:
+            if self._map is None:
+                return
+            if self._offset + len(segments) * TRACE_RECORD.size > self._size:
+                self._grow()
+            for segment, size in zip(segments, sizes):
+                TRACE_RECORD.pack_into(self._map, self._offset, timestamp, segment, total, size, stream, msg_type,
+                                       flags)
+                self._offset += TRACE_RECORD.size
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.truncate(self._offset)
+            self._file.close()
+
+
+def open_trace(path):
+    """
+    Creates a trace file at `path` that is closed when the process exits.
+    """
+    writer = TraceWriter(path)
+    atexit.register(writer.close)
+    return writer
+
+
+def read_trace(path):
+    """
+    Reads every record of a trace file, in the order they were written.
+
+    Raises:
+        ValueError: If the file is not a trace or was written with another record layout.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(f"{path} is not a trace file")
+    magic, record_size = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or record_size != TRACE_RECORD.size:
+        raise ValueError(f"{path} is not a trace file of this version")
+    end = TRACE_HEADER.size + (len(data) - TRACE_HEADER.size) // TRACE_RECORD.size * TRACE_RECORD.size
+    records = []
+    for record in TRACE_RECORD.iter_unpack(memoryview(data)[TRACE_HEADER.size:end]):
+        if not record[0]:  # The zeroed tail of a trace that was never closed
+            break
+        records.append(TraceRecord(*record))
+    return records
@@ -1,8 +1,27 @@
 # client.py
+import argparse
+import asyncio
+import logging
+import mmap
+import multiprocessing
+import operator
+import os
+import random
+import re
+import resource
+import select
 import socket
 import struct
 import threading
 import time
+import zlib
+from array import array
+from collections import Counter, deque
+from itertools import accumulate, chain
+
+from capture import CHECKSUMMED, TCP, open_trace
+from logs import LOG_LEVELS, setup_logging
+from metrics import MetricsRegistry, PhaseTimer, start_stats_endpoint
 
 GOOSE = "    __  \n  >(o )___  \n   (  ._> /  \n    `----'   "
 
@@ -12,9 +31,41 @@ MAGIC_COOKIE = 0xabcddcba
 OFFER_TYPE = 0x2
 REQUEST_TYPE = 0x3
 PAYLOAD_TYPE = 0x4
+NACK_TYPE = 0x5
+REJECT_TYPE = 0x6
+PROBE_TYPE = 0x7
+SESSION_TYPE = 0x8
+SESSION_REQUEST_TYPE = 0x9
+SESSION_RESPONSE_TYPE = 0xa
 BROADCAST_LISTEN_PORT = 30003
 BUFFER_SIZE = 1024
 RECV_BUFFER_SIZE = 1024  # Standard buffer size for receiving data
+UDP_RECV_BUFFER_SIZE = 65536  # Large enough for any UDP datagram the server may send
+TCP_READ_SIZE = 256 * 1024  # Bytes read per recv_into call during a TCP download
+SOCKET_RCVBUF = 4 * 1024 * 1024  # Requested kernel receive buffer of download sockets, capped by net.core.rmem_max
+NACK_INTERVAL = 0.02  # Seconds between progress reports sent during a reliable UDP download
+MAX_NACK_BITMAP_SIZE = 1024  # Most bitmap bytes in one NACK packet, each bit flags one segment
+FINAL_NACK_COUNT = 3  # Copies of the completion report sent at the end of a reliable download
+RELIABLE_TIMEOUT = 5  # Seconds without any packet before a reliable download gives up
+LOSS_HISTOGRAM_BUCKETS = 10  # Number of equal slices of the file the loss is broken down into
+UDP_IDLE_TIMEOUT = 1  # Longest wait for a UDP packet, before the first one and when packets arrive slowly
+UDP_MIN_IDLE_TIMEOUT = 0.05  # Shortest adaptive idle timeout, covering scheduling hiccups of a fast sender
+IDLE_GAP_FACTOR = 20  # Idle timeout in expected inter-arrival times, the mean gap plus four times the jitter
+IDLE_TIMEOUT_UPDATE = 16  # Packets between two updates of the socket timeout from the inter-arrival times
+JITTER_GAIN = 1 / 16  # Weight of a new sample in the smoothed inter-arrival time and jitter, as in RFC 3550
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)  # Linux option for nanosecond kernel receive timestamps
+DEFAULT_TCP_PORT = 30002
+DEFAULT_UDP_PORT = 30001
+LOAD_MAX_IN_FLIGHT = 1000  # Default limit of concurrent downloads in load generator mode
+PERCENTILES = (50, 90, 99)
+METER_FLUSH_INTERVAL = 0.1  # Seconds between UDP throughput meter updates during a download
+STATS_REPORT_INTERVAL = 1  # Seconds between metrics reports of load generator processes to the parent
+OFFER_MULTICAST_GROUP = '239.255.117.3'  # Default group servers send multicast offers to
+OFFER_TTL = 5  # Seconds a server is still chosen after its last offer
+PROBE_INTERVAL = 1  # Seconds between round trip probes of every known server
+RTT_SMOOTHING = 0.2  # Weight of a new round trip sample in the smoothed round trip time
+SESSION_POOL_SIZE = 8  # Default idle sessions kept per server for reuse
+PIPELINE_DEPTH = 16  # Default most requests in flight on one session of the load generator
 
 # ANSI Color Codes
 BLUE = '\033[94m'
@@ -38,96 +89,884 @@ OFFER_PACKET_SIZE = struct.calcsize(OFFER_PACKET_FORMAT)
 REQUEST_PACKET_FORMAT = '!IbQ'
 REQUEST_PACKET_SIZE = struct.calcsize(REQUEST_PACKET_FORMAT)
 
+REQUEST_OPTIONS_FORMAT = '!QB'  # Optional requested rate in bytes per second and flags, appended to a request packet
+RELIABLE_FLAG = 0x1  # Request flag asking for a reliable transfer
+VERIFY_FLAG = 0x2  # Request flag asking for checksummed segments, followed by the content seed
+REQUEST_SEED_FORMAT = '!I'
+
 PAYLOAD_PACKET_FORMAT = '!IbQQ'
 PAYLOAD_PACKET_HEADER_SIZE = struct.calcsize(PAYLOAD_PACKET_FORMAT)
+PAYLOAD_PACKET_STRUCT = struct.Struct(PAYLOAD_PACKET_FORMAT)
+VERIFIED_PACKET_STRUCT = struct.Struct('!IbQQI')  # Payload header followed by the CRC32 of the segment
+CHECKSUM_STRUCT = struct.Struct('!I')  # CRC32 received after every block of a verified TCP download
+TCP_CHECKSUM_BLOCK = 256 * 1024  # Payload bytes covered by each checksum of a verified TCP download
 
+NACK_PACKET_FORMAT = '!IbQQ'  # Followed by a bitmap of the missing segments from the base segment on
 
-DEBUG_CONTENT = False
+REJECT_PACKET_FORMAT = '!IbBI'  # Reason and the milliseconds to wait before retrying, 0 for never
+REJECT_PACKET_SIZE = struct.calcsize(REJECT_PACKET_FORMAT)
+REJECT_REASONS = {0x1: 'server busy', 0x2: 'client over quota', 0x3: 'file too large'}
 
+PROBE_PACKET_FORMAT = '!IbQ'  # Token echoed back in the reply
+PROBE_REPLY_FORMAT = '!IbQII'  # Echoed token, admitted transfers and the most transfers admitted at once
+PROBE_REPLY_SIZE = struct.calcsize(PROBE_REPLY_FORMAT)
 
-def listen_for_offers():
-    """
-       Listens for broadcast offers over UDP and processes incoming packets with error checking.
+SESSION_HELLO = struct.pack('!Ib', MAGIC_COOKIE, SESSION_TYPE)  # Opens a persistent session, in place of a request line
+SESSION_REQUEST_STRUCT = struct.Struct('!IbIQQQBI')  # Request id, file size, offset, length, flags and content seed
+# Request id, reject reason or 0, milliseconds to wait before retrying and the payload bytes that follow
+SESSION_RESPONSE_STRUCT = struct.Struct('!IbIBIQ')
+
+TIMESPEC_STRUCT = struct.Struct('@ll')  # Seconds and nanoseconds of a kernel receive timestamp
+TIMESTAMP_ANCILLARY_SIZE = socket.CMSG_SPACE(TIMESPEC_STRUCT.size) if hasattr(socket, 'CMSG_SPACE') else 0
+
+# Maps an arrival count to '1' when the segment is missing and '0' when it arrived
+MISSING_DIGITS = bytes.maketrans(bytes(range(256)), b'1' + b'0' * 255)
+
+log = logging.getLogger('client')
+client_metrics = MetricsRegistry()
+client_capture = None  # Trace every payload packet and TCP read of the interactive downloads is recorded to, if any
 
-       Returns:
-           tuple: A tuple containing the sender's IP address (str), UDP port (int), and TCP port (int).
 
-       Raises:
-           RuntimeError: For any critical errors during socket operations or data unpacking.
+def open_offer_socket(multicast_group=None):
     """
-    print(f"{BLUE}[Client]{OFFER_COLOR} Listening for offers...{RESET}")
+    Binds a socket to the offer port, joined to `multicast_group` when one is given.
+
+    :raises RuntimeError: If the socket cannot be bound.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            try:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind(('', BROADCAST_LISTEN_PORT))
-            except socket.error as e:
-                raise RuntimeError(f"Socket binding failed: {e}")
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('', BROADCAST_LISTEN_PORT))
+        if multicast_group:
+            membership = struct.pack('!4sI', socket.inet_aton(multicast_group), socket.INADDR_ANY)
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except socket.error as e:
+        s.close()
+        raise RuntimeError(f"Socket binding failed: {e}")
+    return s
+
+
+def parse_offer(data):
+    """
+    Returns the UDP and TCP ports of an offer packet.
+
+    :raises ValueError: If the packet is not a valid offer.
+    """
+    if len(data) != OFFER_PACKET_SIZE:
+        raise ValueError("Offer packet has the wrong size")
+    magic_cookie, msg_type, udp_port, tcp_port = struct.unpack(OFFER_PACKET_FORMAT, data)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, OFFER_TYPE):
+        raise ValueError("Invalid offer")
+    return udp_port, tcp_port
+
+
+class ServerDiscovery:
+    """
+    Collects server offers in the background and picks the servers new downloads go to.
+
+    A single socket stays bound to the offer port for the life of the client, so no offer is missed
+    between rounds and a round can start as soon as any server is known. Servers are keyed by
+    (ip, udp_port, tcp_port) and expire `ttl` seconds after their last offer. Every live server is
+    probed over its UDP port every `PROBE_INTERVAL` seconds for its round trip time and load.
+    """
+
+    def __init__(self, multicast_group=None, ttl=OFFER_TTL, selection='load'):
+        """
+        :param multicast_group: Multicast group to also receive offers on, or None.
+        :param ttl: Seconds a server is kept after its last offer.
+        :param selection: 'load' to prefer the least loaded servers, 'latency' to prefer the closest ones.
+        """
+        self.multicast_group = multicast_group
+        self.ttl = ttl
+        self.selection = selection
+        self._servers = {}  # (ip, udp_port, tcp_port) to {'last_seen', 'rtt', 'load', 'capacity'}
+        self._probes = {}  # Token to (server, send time) of the probes waiting for a reply
+        self._next_token = 0  # Only the discovery thread sends probes
+        self._condition = threading.Condition()
+
+    def start(self):
+        offer_socket = open_offer_socket(self.multicast_group)
+        probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        threading.Thread(target=self.run, args=(offer_socket, probe_socket), daemon=True).start()
+        return self
 
+    def run(self, offer_socket, probe_socket):
+        next_probe = time.monotonic()
+        with offer_socket, probe_socket:
             while True:
                 try:
-                    data, addr = s.recvfrom(RECV_BUFFER_SIZE)
-                    magic_cookie, msg_type, udp_port, tcp_port = struct.unpack(OFFER_PACKET_FORMAT, data)
-                    if magic_cookie == MAGIC_COOKIE and msg_type == OFFER_TYPE:
-                        print(
-                            f"{BLUE}[Client]{RESET} {OFFER_COLOR}Offer received{RESET} from {ADDR_COLOR}{addr[0]}{RESET} {UDP_DOWNLOAD_COLOR}UDP{RESET} port: {ADDR_COLOR}{udp_port}{RESET} {TCP_DOWNLOAD_COLOR}TCP{RESET} port: {ADDR_COLOR}{tcp_port}{RESET}")
-                        return addr[0], udp_port, tcp_port
-                    else:
-                        print(
-                            f"{ERROR}[Error]{RESET} {OFFER_COLOR}Invalid packet received from {ADDR_COLOR}{addr[0]}{RESET}")
-                except struct.error as e:
-                    print(
-                        f"{ERROR}[Error]{RESET} {OFFER_COLOR}Failed to unpack data from {ADDR_COLOR}{addr[0]}{RESET}: {e}")
+                    readable, _, _ = select.select([offer_socket, probe_socket], [], [],
+                                                   max(0, next_probe - time.monotonic()))
+                    if offer_socket in readable:
+                        data, addr = offer_socket.recvfrom(RECV_BUFFER_SIZE)
+                        self.add_offer(addr[0], data, probe_socket)
+                    if probe_socket in readable:
+                        self.add_probe_reply(*probe_socket.recvfrom(RECV_BUFFER_SIZE))
+                    if time.monotonic() >= next_probe:
+                        self.expire()
+                        for server in self.servers():
+                            self.probe(probe_socket, server)
+                        next_probe = time.monotonic() + PROBE_INTERVAL
                 except socket.error as e:
-                    print(f"{ERROR}[Error]{RESET} {OFFER_COLOR}Socket error while receiving data: {e}")
-    except Exception as e:
-        print(f"{ERROR}[Client]{RESET} {OFFER_COLOR}Critical error: {e}")
+                    log.warning("Socket error during server discovery: %s", e)
+
+    def add_offer(self, ip, data, probe_socket):
+        try:
+            udp_port, tcp_port = parse_offer(data)
+        except (ValueError, struct.error) as e:
+            log.warning("%s from %s", e, ip)
+            return
+        server = (ip, udp_port, tcp_port)
+        with self._condition:
+            info = self._servers.get(server)
+            if info is None:
+                info = self._servers[server] = {'rtt': None, 'load': 0, 'capacity': 0}
+                print(f"{BLUE}[Client]{RESET} {OFFER_COLOR}Offer received{RESET} from {ADDR_COLOR}{ip}{RESET} "
+                      f"{UDP_DOWNLOAD_COLOR}UDP{RESET} port: {ADDR_COLOR}{udp_port}{RESET} "
+                      f"{TCP_DOWNLOAD_COLOR}TCP{RESET} port: {ADDR_COLOR}{tcp_port}{RESET}")
+                self.probe(probe_socket, server)
+            info['last_seen'] = time.monotonic()
+            self._condition.notify_all()
+
+    def probe(self, probe_socket, server):
+        self._next_token += 1
+        token = self._next_token
+        self._probes[token] = (server, time.monotonic())
+        probe_socket.sendto(struct.pack(PROBE_PACKET_FORMAT, MAGIC_COOKIE, PROBE_TYPE, token), (server[0], server[1]))
+
+    def add_probe_reply(self, data, addr):
+        if len(data) != PROBE_REPLY_SIZE:
+            return
+        magic_cookie, msg_type, token, load, capacity = struct.unpack(PROBE_REPLY_FORMAT, data)
+        probe = self._probes.pop(token, None)
+        if (magic_cookie, msg_type) != (MAGIC_COOKIE, PROBE_TYPE) or probe is None or probe[0][0] != addr[0]:
+            return
+        server, sent_at = probe
+        rtt = time.monotonic() - sent_at
+        with self._condition:
+            info = self._servers.get(server)
+            if info is not None:
+                info['rtt'] = rtt if info['rtt'] is None else info['rtt'] + RTT_SMOOTHING * (rtt - info['rtt'])
+                info['load'], info['capacity'] = load, capacity
+
+    def expire(self):
+        now = time.monotonic()
+        with self._condition:
+            for server, info in list(self._servers.items()):
+                if now - info['last_seen'] > self.ttl:
+                    del self._servers[server]
+                    print(f"{BLUE}[Client]{RESET} {OFFER_COLOR}No offers from {ADDR_COLOR}{server[0]}{RESET} "
+                          f"{OFFER_COLOR}for {self.ttl} s, forgetting it{RESET}")
+        self._probes = {token: probe for token, probe in self._probes.items() if now - probe[1] < self.ttl}
+
+    def servers(self):
+        """
+        Returns the live servers with their round trip time in seconds, None until a probe is answered,
+        and the transfers they last reported having admitted.
+        """
+        now = time.monotonic()
+        with self._condition:
+            return {server: dict(info) for server, info in self._servers.items() if now - info['last_seen'] <= self.ttl}
+
+    def choose(self, count, timeout=None):
+        """
+        Waits until a server is known and spreads `count` new downloads over the live servers.
+
+        With 'load' selection every download goes to the server with the fewest transfers, counting the
+        downloads already placed on it by this call, ties going to the lowest round trip time. With
+        'latency' selection the order of the two is swapped.
+
+        :param count: Number of downloads to place.
+        :param timeout: Seconds to wait for a first server, None to wait for ever.
+        :return: A list of `count` (ip, udp_port, tcp_port) tuples, empty if no server was found in time.
+        """
+        with self._condition:
+            if not self._condition.wait_for(self.servers, timeout):
+                return []
+        servers = self.servers()
+        placed = Counter()
+
+        def score(server):
+            info = servers[server]
+            load = info['load'] + placed[server]
+            rtt = float('inf') if info['rtt'] is None else info['rtt']
+            return (load, rtt) if self.selection == 'load' else (rtt, load)
+
+        choices = []
+        for _ in range(count):
+            server = min(servers, key=score)
+            placed[server] += 1
+            choices.append(server)
+        return choices
+
+
+class TransferRejected(ConnectionError):
+    """
+    Raised when the server turns a request away with a reject packet.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Rejected by server: {REJECT_REASONS.get(reason, 'unknown reason')}")
+        self.reason = reason
+        self.retry_after = retry_after  # Seconds to wait before retrying, or None to not retry
+
+
+def parse_reject(data, num_bytes):
+    """
+    Returns a `TransferRejected` for a reject packet, or None if `data` holds anything else.
+    """
+    if num_bytes != REJECT_PACKET_SIZE:
+        return None
+    magic_cookie, msg_type, reason, retry_after_ms = struct.unpack_from(REJECT_PACKET_FORMAT, data)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, REJECT_TYPE):
+        return None
+    return TransferRejected(reason, retry_after_ms / 1000 if retry_after_ms else None)
+
+
+def tune_receive_buffer(s):
+    """
+    Asks the kernel for a `SOCKET_RCVBUF` receive buffer so bursts are not dropped while the client is busy.
+    """
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+    except socket.error as e:
+        print(f"{ERROR}[Error]{RESET} Failed to set receive buffer size: {e}")
+
+
+def phase_duration(timer, start_phase, end_phase):
+    """
+    Returns the seconds between two phases of a `PhaseTimer`, never zero.
+    """
+    return max(timer.marks[end_phase] - timer.marks[start_phase], 1) / 1e9
+
+
+def phase_times(timer):
+    """
+    Returns the nanoseconds from the start of a `PhaseTimer` to each of its phases.
+    """
+    return {phase: timestamp - timer.start for phase, timestamp in timer.marks.items()}
+
+
+class PayloadVerifier:
+    """
+    Checks the CRC32 checksums carried by a verified download against the data that arrived.
+
+    The time spent computing checksums is summed on its own, so the cost of verification can be told
+    apart from the cost of receiving.
+    """
+
+    __slots__ = ('seed', 'checked', 'corrupt', 'elapsed_ns')
+
+    def __init__(self, seed=None):
+        # Where in its payload block the server starts this download's content, shared by the stripes of a download
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.checked = 0
+        self.corrupt = 0
+        self.elapsed_ns = 0
+
+    def update(self, data, checksum=0):
+        """
+        Returns the running CRC32 `checksum` extended with `data`.
+        """
+        start = time.perf_counter_ns()
+        checksum = zlib.crc32(data, checksum)
+        self.elapsed_ns += time.perf_counter_ns() - start
+        return checksum
 
+    def check(self, checksum, expected):
+        """
+        Counts one checked segment or block.
 
-def tcp_download(server_ip, tcp_port, file_size, connection_id):
+        :return: True if the checksum of the data matches the one the server sent.
+        """
+        self.checked += 1
+        if checksum != expected:
+            self.corrupt += 1
+            return False
+        return True
+
+    def merge(self, other):
+        self.checked += other.checked
+        self.corrupt += other.corrupt
+        self.elapsed_ns += other.elapsed_ns
+
+    def summary(self):
+        return {'checked': self.checked, 'corrupt': self.corrupt, 'verify_time': self.elapsed_ns / 1e9}
+
+
+def print_verification(label, connection_id, verifier, duration):
+    """
+    Prints the checksum results of a download and the share of its duration spent verifying.
+    """
+    color = ERROR if verifier.corrupt else METRIC_COLOR
+    print(f"{BLUE}[Client]{RESET} {label} {ID_COLOR}#{connection_id}{RESET} checksums: "
+          f"{METRIC_COLOR}{verifier.checked}{RESET} verified, {color}{verifier.corrupt}{RESET} corrupt, "
+          f"verification took {METRIC_COLOR}{verifier.elapsed_ns / 1e6:.2f} ms{RESET} "
+          f"({METRIC_COLOR}{verifier.elapsed_ns / 1e9 / duration * 100:.1f}%{RESET} of the download)")
+
+
+def receive_checksum(s):
+    """
+    Reads the checksum sent after a block of a verified TCP download.
+
+    :raises ConnectionError: If the connection closes first.
+    """
+    trailer = bytearray(CHECKSUM_STRUCT.size)
+    if s.recv_into(trailer, CHECKSUM_STRUCT.size, socket.MSG_WAITALL) < CHECKSUM_STRUCT.size:
+        raise ConnectionError("Connection lost before file was fully received.")
+    return CHECKSUM_STRUCT.unpack(trailer)[0]
+
+
+class Session:
+    """
+    A persistent TCP session with a server, over which downloads are requested one after the other
+    without a new connection each.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address  # (server IP, TCP port)
+        self.next_request_id = 0
+
+    @classmethod
+    def connect(cls, server_ip, tcp_port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            tune_receive_buffer(s)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Requests must not wait for the server's ACKs
+            s.connect((server_ip, tcp_port))
+            s.sendall(SESSION_HELLO)
+        except OSError:
+            s.close()
+            raise
+        return cls(s, (server_ip, tcp_port))
+
+    def request(self, file_size, offset, length, timer, verifier=None):
+        """
+        Requests a range of a file and waits for the response header, after which the payload follows on `sock`.
+
+        Raises:
+        TransferRejected: If the server turns the request away. The session can still be used.
+        ConnectionError: If the connection is lost or the server answers out of order.
+        """
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        flags, seed = (VERIFY_FLAG, verifier.seed) if verifier is not None else (0, 0)
+        self.sock.sendall(SESSION_REQUEST_STRUCT.pack(MAGIC_COOKIE, SESSION_REQUEST_TYPE, request_id, file_size,
+                                                      offset, length, flags, seed))
+        timer.mark('request')
+        header = bytearray(SESSION_RESPONSE_STRUCT.size)
+        if self.sock.recv_into(header, len(header), socket.MSG_WAITALL) < len(header):
+            raise ConnectionError("Connection lost before the response arrived.")
+        reason, retry_after_ms = check_session_response(header, request_id, length)
+        if reason:
+            raise TransferRejected(reason, retry_after_ms / 1000 if retry_after_ms else None)
+
+    def close(self):
+        self.sock.close()
+
+
+def check_session_response(header, request_id, length):
+    """
+    Checks a session response header against the request it should answer.
+
+    :return: The reject reason, 0 if the payload follows, and the milliseconds to wait before retrying.
+    :raises ConnectionError: If the header is malformed, answers another request or announces another length.
+    """
+    magic_cookie, msg_type, response_id, reason, retry_after_ms, response_length = \
+        SESSION_RESPONSE_STRUCT.unpack_from(header)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, SESSION_RESPONSE_TYPE):
+        raise ConnectionError("Malformed session response.")
+    if response_id != request_id or (not reason and response_length != length):
+        raise ConnectionError(f"Response to request {response_id} received while waiting for request {request_id}.")
+    return reason, retry_after_ms
+
+
+class SessionPool:
+    """
+    Idle persistent sessions by server address, shared by the downloads of every thread.
+
+    A download takes an idle session to the server if there is one and opens a new one otherwise, and
+    hands it back once its range has arrived. At most `max_idle` sessions per server are kept.
+    """
+
+    def __init__(self, max_idle=SESSION_POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = {}  # (server IP, TCP port) to its idle sessions
+        self._lock = threading.Lock()
+
+    def acquire(self, server_ip, tcp_port, timer):
+        """
+        Returns an idle session to the server, or a new one, marking the connect phase of `timer`.
+        """
+        with self._lock:
+            idle = self._idle.get((server_ip, tcp_port))
+            session = idle.pop() if idle else None
+        if session is None:
+            session = Session.connect(server_ip, tcp_port)
+        timer.mark('connect')
+        return session
+
+    def release(self, session):
+        with self._lock:
+            idle = self._idle.setdefault(session.address, [])
+            if len(idle) < self.max_idle:
+                idle.append(session)
+                return
+        session.close()
+
+    def close(self):
+        with self._lock:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+def receive_payload(s, offset, length, buffer, timer, read_size=TCP_READ_SIZE, verifier=None):
+    """
+    Reads a requested range of `length` bytes from a TCP socket with `recv_into`, checking the checksum
+    after every block when a `verifier` is given.
+
+    A buffer of at least `length` bytes receives the range in place. A shorter one is reused for every
+    read and the data is discarded.
+
+    Raises:
+    TransferRejected: If a reject packet arrives instead of the data.
+    ConnectionError: If the server closes the connection before the whole range arrived.
+    """
+    fill = len(buffer) >= length
+    meter = client_metrics.meter('tcp')
+    capture = client_capture
+    stream = capture.new_stream() if capture is not None else 0
+    received = 0
+    head = b''
+    block_left = min(length, TCP_CHECKSUM_BLOCK) if verifier else length  # Bytes until the next checksum
+    checksum = 0
+    while received < length:
+        size = min(read_size, block_left)
+        target = buffer[received:received + size] if fill else buffer
+        num_bytes = s.recv_into(target, size)
+        if not num_bytes:
+            raise parse_reject(head, received) or ConnectionError(
+                "Connection lost before file was fully received.")
+        if not received:
+            head = bytes(buffer[:REJECT_PACKET_SIZE])  # A reject packet arrives instead of the data
+        timer.mark('first_byte')
+        meter.add(num_bytes)
+        if capture is not None:
+            capture.record(stream, PAYLOAD_TYPE, TCP, offset + received, offset + length, num_bytes)
+        received += num_bytes
+        block_left -= num_bytes
+        if verifier is not None:
+            checksum = verifier.update(target[:num_bytes], checksum)
+            if not block_left:
+                verifier.check(checksum, receive_checksum(s))
+                checksum = 0
+                block_left = min(length - received, TCP_CHECKSUM_BLOCK)
+
+
+def receive_tcp_range(server_ip, tcp_port, file_size, offset, length, buffer, timer, read_size=TCP_READ_SIZE,
+                      verifier=None, sessions=None):
+    """
+    Requests `length` bytes of a `file_size` byte file starting at `offset` over a new TCP connection,
+    or over a persistent session from `sessions`, and reads them with `receive_payload`.
+
+    Parameters:
+    server_ip (str): The IP address of the server to connect to.
+    tcp_port (int): The port number on which the server is listening.
+    file_size (int): The size of the whole file in bytes.
+    offset (int): The position of the first requested byte.
+    length (int): The number of bytes requested.
+    buffer (memoryview): Where the data is read into.
+    timer (PhaseTimer): Marks the connect, request, first_byte and last_byte phases, which are then
+        recorded in `client_metrics`.
+    read_size (int): The most bytes read per call.
+    verifier (PayloadVerifier): Requests the range with checksums and checks every block as it completes,
+        or None to request the bare payload.
+    sessions (SessionPool): Where the session the range is requested over comes from and goes back to,
+        or None to request it over a connection of its own.
+
+    Raises:
+    TransferRejected: If the server turns the request away.
+    ConnectionError: If the server closes the connection before the whole range arrived.
+    OSError: If connecting or receiving fails.
+    """
+    if sessions is not None:
+        session = sessions.acquire(server_ip, tcp_port, timer)
+        try:
+            session.request(file_size, offset, length, timer, verifier)
+            receive_payload(session.sock, offset, length, buffer, timer, read_size, verifier)
+        except TransferRejected:
+            sessions.release(session)
+            raise
+        except BaseException:
+            session.close()  # Whatever is left of the response would be read as the next one
+            raise
+        sessions.release(session)
+    else:
+        if verifier is not None:
+            request = f"{file_size} {offset} {length} {verifier.seed}\n"
+        elif offset == 0 and length == file_size:
+            request = f"{file_size}\n"
+        else:
+            request = f"{file_size} {offset} {length}\n"
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            tune_receive_buffer(s)
+            s.connect((server_ip, tcp_port))
+            timer.mark('connect')
+            s.sendall(request.encode())
+            timer.mark('request')
+            receive_payload(s, offset, length, buffer, timer, read_size, verifier)
+
+    timer.mark('last_byte')
+    client_metrics.record_phases('tcp', timer)
+
+
+def tcp_download(server_ip, tcp_port, file_size, connection_id, read_size=TCP_READ_SIZE, verify=False,
+                 sessions=None):
     """
     Downloads a file over a TCP connection from a specified server.
 
+    The data is read with `recv_into` into one buffer allocated for the whole download.
+
     Parameters:
     server_ip (str): The IP address of the server to connect to.
     tcp_port (int): The port number on which the server is listening.
     file_size (int): The expected size of the file in bytes.
     connection_id (int): An identifier for this connection (used for logging).
+    read_size (int): The most bytes read per call.
+    verify (bool): Request checksummed blocks and verify every one as it arrives.
+    sessions (SessionPool): Request the file over a pooled persistent session instead of a new connection.
 
     Returns:
-    None
+    dict: The protocol, bytes received, duration from request to last byte, throughput in bytes per second
+        and phase times in nanoseconds of the download, with the `PayloadVerifier.summary` results when
+        verifying, or None if it failed.
     """
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.connect((server_ip, tcp_port))
-                s.sendall(f"{file_size}\n".encode())
-                print(
-                    f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} requested{RESET}")
+        print(
+            f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} requested{RESET}")
+        timer = PhaseTimer()
+        verifier = PayloadVerifier() if verify else None
+        try:
+            receive_tcp_range(server_ip, tcp_port, file_size, 0, file_size, memoryview(bytearray(read_size)), timer,
+                              read_size, verifier, sessions)
+        except socket.error as e:
+            print(
+                f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} failed: {e}")
+            return
 
-                start_time = time.time()
-                received = 0
+        duration = phase_duration(timer, 'request', 'last_byte')
+        print(
+            f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} complete in {METRIC_COLOR}{duration:.2f} seconds{RESET}, total speed: {METRIC_COLOR}{file_size / duration / 1000:.2f} kB/s{RESET}, "
+            f"first byte after {METRIC_COLOR}{phase_duration(timer, 'request', 'first_byte') * 1000:.2f} ms{RESET}")
+        result = {'protocol': 'tcp', 'bytes': file_size, 'duration': duration, 'throughput': file_size / duration,
+                  'phases': phase_times(timer)}
+        if verifier is not None:
+            print_verification(f"{TCP_DOWNLOAD_COLOR}TCP download{RESET}", connection_id, verifier, duration)
+            result.update(verifier.summary())
+        return result
 
-                while received < file_size:
-                    data = s.recv(BUFFER_SIZE)
-                    if not data:
-                        raise ConnectionError("Connection lost before file was fully received.")
-                    received += len(data)
+    except Exception as e:
+        print(
+            f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} encountered an error: {e}")
 
-                duration = time.time() - start_time
-                print(
-                    f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} complete in {METRIC_COLOR}{duration:.2f} seconds{RESET}, total speed: {METRIC_COLOR}{file_size / duration / 1000:.2f} kB/s{RESET}")
 
-            except socket.error as e:
-                print(
-                    f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} failed: {e}")
+def striped_tcp_download(server_ip, tcp_port, file_size, connection_id, streams, use_mmap=False,
+                         read_size=TCP_READ_SIZE, verify=False, sessions=None):
+    """
+    Downloads one file over `streams` parallel TCP connections, each fetching its own byte range.
+
+    Every stream reads its range with `recv_into` straight into its slice of one buffer preallocated for
+    the whole file, so the file is reassembled without copying. On links with a large bandwidth-delay
+    product the streams together fill the pipe where a single window-limited stream cannot.
+
+    Parameters:
+    server_ip (str): The IP address of the server to connect to.
+    tcp_port (int): The port number on which the server is listening.
+    file_size (int): The size of the file in bytes.
+    connection_id (int): An identifier for this download (used for logging).
+    streams (int): The number of parallel connections.
+    use_mmap (bool): Back the file buffer with an anonymous memory map instead of a bytearray.
+    read_size (int): The most bytes read per call.
+    verify (bool): Request checksummed blocks on every stream and verify them as they arrive.
+    sessions (SessionPool): Request every range over a pooled persistent session instead of a new connection.
+
+    Returns:
+    dict: The protocol, bytes received, duration from the first connect to the last byte, throughput in
+        bytes per second and number of streams of the download, with the `PayloadVerifier.summary` results
+        over all streams when verifying, or None if a stream failed or the file is empty.
+    """
+    if file_size <= 0:
+        print(
+            f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} has nothing to download")
+        return
+    try:
+        buffer = memoryview(mmap.mmap(-1, file_size) if use_mmap else bytearray(file_size))
+        stripe_size = -(-file_size // max(1, streams))  # At least 1, files smaller than `streams` get fewer stripes
+        stripes = [(offset, min(stripe_size, file_size - offset)) for offset in range(0, file_size, stripe_size)]
+        errors = []
+        seed = random.getrandbits(32)  # One content seed for every stripe, so they make up one consistent file
+        verifiers = [PayloadVerifier(seed) if verify else None for _ in stripes]
+
+        def fetch(offset, length, verifier):
+            try:
+                receive_tcp_range(server_ip, tcp_port, file_size, offset, length, buffer[offset:offset + length],
+                                  PhaseTimer(), read_size, verifier, sessions)
+            except Exception as e:  # Any failed stripe fails the whole download
+                errors.append(e)
+
+        print(
+            f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} requested over {METRIC_COLOR}{len(stripes)}{RESET} streams{RESET}")
+        threads = [threading.Thread(target=fetch, args=(*stripe, verifier))
+                   for stripe, verifier in zip(stripes, verifiers)]
+        start_time = time.perf_counter_ns()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duration = max(time.perf_counter_ns() - start_time, 1) / 1e9
+
+        if errors:
+            print(
+                f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} failed: {errors[0]}")
+            return
+        print(
+            f"{BLUE}[Client]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} complete in {METRIC_COLOR}{duration:.2f} seconds{RESET}, total speed: {METRIC_COLOR}{file_size / duration / 1000:.2f} kB/s{RESET} over {METRIC_COLOR}{len(stripes)}{RESET} streams")
+        result = {'protocol': 'tcp', 'bytes': file_size, 'duration': duration, 'throughput': file_size / duration,
+                  'streams': len(stripes)}
+        if verify:
+            verifier = PayloadVerifier()
+            for stripe_verifier in verifiers:
+                verifier.merge(stripe_verifier)
+            print_verification(f"{TCP_DOWNLOAD_COLOR}TCP download{RESET}", connection_id, verifier, duration)
+            result.update(verifier.summary())
+        return result
 
     except Exception as e:
         print(
             f"{ERROR}[Error]{RESET} {TCP_DOWNLOAD_COLOR}TCP{TCP_DOWNLOAD_COLOR} download {ID_COLOR}#{connection_id}{RESET} encountered an error: {e}")
 
 
-def udp_download(server_ip, udp_port, file_size, connection_id):
+class SegmentTracker:
+    """
+    Tracks which segments of a UDP download arrived, in arrays preallocated from `total_segments`.
+
+    `counts` holds one byte per segment counting its arrivals, saturating at 255, and `arrivals` holds
+    the segment numbers in arrival order. Recording a packet is two array writes, and everything else
+    is computed from the arrays after the transfer.
+    """
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.counts = bytearray(total_segments)
+        self.arrivals = array('I' if total_segments < 2 ** 32 else 'Q')
+        self.received = 0
+
+    def add(self, segment_number):
+        """
+        Records the arrival of a segment.
+
+        :return: True if the segment arrived for the first time, False for a duplicate or an invalid segment number.
+        """
+        if segment_number >= self.total_segments:
+            return False
+        self.arrivals.append(segment_number)
+        count = self.counts[segment_number]
+        if count < 255:
+            self.counts[segment_number] = count + 1
+        if count:
+            return False
+        self.received += 1
+        return True
+
+    def first_missing(self, start=0):
+        """
+        Returns the first segment from `start` on that has not arrived, or `total_segments` if there is none.
+        """
+        missing = self.counts.find(0, start)
+        return self.total_segments if missing < 0 else missing
+
+    def missing_bitmap(self, start, end):
+        """
+        Returns a bitmap of the missing segments in [start, end), bit i of byte i // 8 standing for segment start + i.
+        """
+        if end <= start:
+            return b''
+        digits = self.counts[start:end].translate(MISSING_DIGITS)
+        return int(digits[::-1], 2).to_bytes((end - start + 7) // 8, 'little')
+
+    def analyze(self):
+        """
+        Analyzes the download once it is over.
+
+        :return: A dict with the number of duplicate packets, the number of packets that arrived after a
+            higher segment and the largest such distance, the lengths of the loss bursts, and the loss
+            percentage in each of `LOSS_HISTOGRAM_BUCKETS` slices of the file. The server sends segments
+            in order, so the slices show how loss developed over the transfer.
+        """
+        running_max = accumulate(self.arrivals, max)
+        distances = [distance for distance in map(operator.sub, chain((0,), running_max), self.arrivals)
+                     if distance > 0]
+        bursts = Counter(len(burst) for burst in re.findall(b'\x00+', self.counts))
+
+        bucket_size = -(-self.total_segments // LOSS_HISTOGRAM_BUCKETS) or 1
+        loss_histogram = []
+        for start in range(0, self.total_segments, bucket_size):
+            bucket = self.counts[start:start + bucket_size]
+            loss_histogram.append(bucket.count(0) / len(bucket) * 100)
+
+        return {
+            'duplicates': len(self.arrivals) - self.received,
+            'reordered': len(distances),
+            'max_reorder_distance': max(distances, default=0),
+            'loss_bursts': dict(sorted(bursts.items())),
+            'max_loss_burst': max(bursts, default=0),
+            'loss_histogram': loss_histogram,
+        }
+
+
+class ArrivalTimes:
+    """
+    Receive timestamps of the packets of a UDP download, in nanoseconds.
+
+    Keeps the first and last timestamp, so throughput can be measured over the time packets were actually
+    arriving, and smoothed estimates of the inter-arrival time and its jitter, the mean deviation of each
+    gap from the smoothed inter-arrival time. Both are updated with a gain of `JITTER_GAIN`.
+    """
+
+    __slots__ = ('first', 'last', 'count', 'mean_gap', 'jitter')
+
+    def __init__(self):
+        self.first = self.last = None
+        self.count = 0
+        self.mean_gap = 0.0
+        self.jitter = 0.0
+
+    def add(self, timestamp):
+        if self.last is None:
+            self.first = timestamp
+        else:
+            gap = timestamp - self.last
+            if self.count == 1:
+                self.mean_gap = gap
+            else:
+                self.jitter += (abs(gap - self.mean_gap) - self.jitter) * JITTER_GAIN
+                self.mean_gap += (gap - self.mean_gap) * JITTER_GAIN
+        self.last = timestamp
+        self.count += 1
+
+    @property
+    def span(self):
+        """
+        Seconds from the first to the last packet.
+        """
+        return (self.last - self.first) / 1e9 if self.count > 1 else 0.0
+
+    def idle_timeout(self):
+        """
+        Seconds without a packet after which the sender is taken to have stopped, `IDLE_GAP_FACTOR` expected
+        inter-arrival times bounded by `UDP_MIN_IDLE_TIMEOUT` and `UDP_IDLE_TIMEOUT`.
+        """
+        if self.count < 2:
+            return UDP_IDLE_TIMEOUT
+        expected_gap = (self.mean_gap + 4 * self.jitter) / 1e9
+        return min(UDP_IDLE_TIMEOUT, max(UDP_MIN_IDLE_TIMEOUT, IDLE_GAP_FACTOR * expected_gap))
+
+
+def enable_timestamps(s):
+    """
+    Asks the kernel to timestamp every datagram received on `s`.
+
+    :return: True if datagrams carry a kernel timestamp, False if receive times have to be read by the client.
+    """
+    if not TIMESTAMP_ANCILLARY_SIZE:
+        return False
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        return True
+    except OSError:
+        return False
+
+
+def receive_timestamp(ancdata):
+    """
+    Returns the kernel receive timestamp from the ancillary data of `recvmsg_into`, in nanoseconds since
+    the epoch, or the current time if the datagram carries none.
+    """
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC_STRUCT.size:
+            seconds, nanoseconds = TIMESPEC_STRUCT.unpack_from(data)
+            return seconds * 1_000_000_000 + nanoseconds
+    return time.time_ns()
+
+
+def arrival_throughput(arrivals, data_size, first_payload, duration):
+    """
+    Returns the bytes per second received between the first and the last packet, leaving out the payload
+    of the first packet, which arrived at the start of the span. Falls back to `data_size / duration`
+    when fewer than two packets arrived.
+    """
+    if arrivals.span:
+        return (data_size - first_payload) / arrivals.span
+    return data_size / duration
+
+
+def report_udp_download(connection_id, tracker, arrivals, data_size, first_payload, duration):
+    """
+    Prints the speed, success rate, arrival timing and segment analysis of a finished UDP download.
+
+    Shared by `udp_download` and the offline analysis of captured downloads in `replay.py`.
+
+    :param connection_id: An identifier for the download (for logging purposes).
+    :param tracker: The `SegmentTracker` of the download, None if no payload arrived.
+    :param arrivals: The `ArrivalTimes` of the payload packets.
+    :param data_size: The payload bytes received, duplicates left out.
+    :param first_payload: The payload bytes of the first packet.
+    :param duration: Seconds from the request to the last packet, 0 if unknown.
+    :return: The protocol, payload bytes received, duration, throughput in bytes per second between the first
+        and the last packet (None without a duration to measure it over), packet success rate, inter-arrival
+        time and jitter in seconds of the download, with the `SegmentTracker.analyze` results.
+    """
+    throughput = arrival_throughput(arrivals, data_size, first_payload, duration) if duration else None
+    speed = f"{throughput / 1000 :.2f} kB/s" if throughput is not None else "n/a"
+    success_rate = (tracker.received / tracker.total_segments * 100) if tracker else 0.0
+
+    print(
+        f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}UDP download{RESET} {ID_COLOR}#{connection_id}{RESET} complete in {METRIC_COLOR}{duration:.2f} seconds{RESET}, "
+        f"speed: {METRIC_COLOR}{speed}{RESET}, with {METRIC_COLOR}{success_rate:.2f}%{RESET} packet success rate{RESET}, "
+        f"inter-arrival: {METRIC_COLOR}{arrivals.mean_gap / 1000:.1f} µs{RESET}, jitter: {METRIC_COLOR}{arrivals.jitter / 1000:.1f} µs{RESET}")
+    if tracker:
+        analysis = tracker.analyze()
+        loss_histogram = ' '.join(f"{loss:.0f}%" for loss in analysis['loss_histogram'])
+        print(
+            f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}UDP download{RESET} {ID_COLOR}#{connection_id}{RESET} "
+            f"duplicates: {METRIC_COLOR}{analysis['duplicates']}{RESET}, "
+            f"reordered: {METRIC_COLOR}{analysis['reordered']}{RESET} (max distance {METRIC_COLOR}{analysis['max_reorder_distance']}{RESET}), "
+            f"longest loss burst: {METRIC_COLOR}{analysis['max_loss_burst']}{RESET}, "
+            f"loss over transfer: {METRIC_COLOR}{loss_histogram}{RESET}")
+    else:
+        analysis = {}
+    return {'protocol': 'udp', 'bytes': data_size, 'duration': duration, 'throughput': throughput,
+            'success_rate': success_rate, 'inter_arrival': arrivals.mean_gap / 1e9,
+            'jitter': arrivals.jitter / 1e9, **analysis}
+
+
+def build_nack(tracker, base, frontier):
+    """
+    Builds the progress report of a reliable UDP download.
+
+    :param tracker: The SegmentTracker of the download.
+    :param base: The first missing segment, every segment below it has been received.
+    :param frontier: The segment after the highest one received.
+    :return: A NACK packet flagging the missing segments between `base` and `frontier`.
+    """
+    bitmap = tracker.missing_bitmap(base, min(frontier, base + MAX_NACK_BITMAP_SIZE * 8))
+    return struct.pack(NACK_PACKET_FORMAT, MAGIC_COOKIE, NACK_TYPE, base, frontier) + bitmap
+
+
+def udp_download(server_ip, udp_port, file_size, connection_id, rate=0, reliable=False, verify=False):
     """
     Downloads a file using UDP from a specified server.
 
@@ -135,79 +974,790 @@ def udp_download(server_ip, udp_port, file_size, connection_id):
     :param udp_port: The UDP port to connect to.
     :param file_size: The size of the file to be downloaded in bytes.
     :param connection_id: An identifier for the connection (for logging purposes).
+    :param rate: The rate in bytes per second to ask the server to send at, 0 to leave it to the server.
+        In reliable mode the server adapts its rate to the reported losses and never exceeds this one.
+    :param reliable: Report missing segments to the server every `NACK_INTERVAL` so it retransmits
+        them, and finish only once every segment has arrived.
+    :param verify: Request checksummed segments and verify every one as it arrives. A corrupt segment
+        counts as lost.
+
+    Datagrams are received into one buffer allocated for the whole download, and their headers are parsed
+    in place. Each carries its kernel receive timestamp where the platform supports `SO_TIMESTAMPNS`.
+    The download ends as soon as every segment has arrived, or once no packet arrived for the adaptive
+    `ArrivalTimes.idle_timeout`.
+
+    :return: The protocol, payload bytes received, duration from request to last packet, throughput in
+        bytes per second between the first and the last packet, packet success rate, inter-arrival time
+        and jitter in seconds and phase times in nanoseconds of the download, with the
+        `SegmentTracker.analyze` results and the `PayloadVerifier.summary` results when verifying, or None
+        if it failed.
     """
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tune_receive_buffer(s)
+            verifier = PayloadVerifier() if verify else None
+            header_size = VERIFIED_PACKET_STRUCT.size if verify else PAYLOAD_PACKET_HEADER_SIZE
             try:
                 request = struct.pack(REQUEST_PACKET_FORMAT, MAGIC_COOKIE, REQUEST_TYPE, file_size)
+                if rate or reliable or verify:
+                    flags = (RELIABLE_FLAG if reliable else 0) | (VERIFY_FLAG if verify else 0)
+                    request += struct.pack(REQUEST_OPTIONS_FORMAT, rate, flags)
+                if verify:
+                    request += struct.pack(REQUEST_SEED_FORMAT, verifier.seed)
             except struct.error as e:
                 print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Error in struct packing: {e}{RESET}")
                 return
 
             try:
+                timer = PhaseTimer()
                 s.sendto(request, (server_ip, udp_port))
+                timer.mark('request')
                 print(
                     f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}UDP download {ID_COLOR}#{connection_id}{RESET} requested")
             except socket.error as e:
                 print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Failed to send request: {e}{RESET}")
                 return
 
-            start_time = time.time()
-            received_segments = set()
+            debug = log.isEnabledFor(logging.DEBUG)
+            tracker = None
             total_segments = 0
             data_size = 0
+            sender_addr = None  # Reports go to the server socket that sends the payload
+            base = frontier = 0
+            last_packet = next_report = next_meter_flush = time.monotonic()
+            last_packet_ns = timer.marks['request']
+            meter = client_metrics.meter('udp')
+            metered_size = 0
+            buffer = bytearray(UDP_RECV_BUFFER_SIZE)
+            buffers = [buffer]
+            view = memoryview(buffer)
+            timestamps = enable_timestamps(s)
+            arrivals = ArrivalTimes()
+            first_payload = 0
+            capture = client_capture
+            stream = capture.new_stream() if capture is not None else 0
 
+            s.settimeout(NACK_INTERVAL if reliable else UDP_IDLE_TIMEOUT)
             while True:
                 try:
-                    s.settimeout(1)
-                    data, _ = s.recvfrom(RECV_BUFFER_SIZE)
-                    if len(data) >= PAYLOAD_PACKET_HEADER_SIZE:
+                    if timestamps:
+                        num_bytes, ancdata, _, addr = s.recvmsg_into(buffers, TIMESTAMP_ANCILLARY_SIZE)
+                        received_at = receive_timestamp(ancdata)
+                    else:
+                        num_bytes, addr = s.recvfrom_into(buffer)
+                        received_at = time.time_ns()
+                    rejection = parse_reject(buffer, num_bytes)
+                    if rejection:
+                        print(
+                            f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}UDP download {ID_COLOR}#{connection_id}{RESET} {rejection}")
+                        return
+                    if num_bytes >= header_size:
                         try:
-                            _, msg_type, total_segments, segment_number = struct.unpack(PAYLOAD_PACKET_FORMAT, data[
-                                                                                                               :PAYLOAD_PACKET_HEADER_SIZE])
+                            if verifier is None:
+                                _, msg_type, total_segments, segment_number = PAYLOAD_PACKET_STRUCT.unpack_from(buffer)
+                            else:
+                                _, msg_type, total_segments, segment_number, checksum = \
+                                    VERIFIED_PACKET_STRUCT.unpack_from(buffer)
                         except struct.error as e:
-                            print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Packet unpacking error: {e}{RESET}")
+                            log.warning("Packet unpacking error: %s", e)
                             continue
+                        if capture is not None:
+                            capture.record(stream, msg_type, CHECKSUMMED if verify else 0, segment_number,
+                                           total_segments, num_bytes, received_at)
 
                         if msg_type == PAYLOAD_TYPE:
-                            if DEBUG_CONTENT:
-                                print(
-                                    f"{BLUE}[Client]{RESET} Received {UDP_DOWNLOAD_COLOR}UDP{RESET} segment{METRIC_COLOR}{segment_number}{RESET}")
-                            received_segments.add(segment_number)
-                            data_size += len(data[PAYLOAD_PACKET_HEADER_SIZE:])
+                            if debug:
+                                log.debug("Received UDP segment %d", segment_number)
+                            if verifier is not None and not verifier.check(
+                                    verifier.update(view[header_size:num_bytes]), checksum):
+                                continue  # A corrupt segment counts as lost, a reliable download asks for it again
+                            if tracker is None:
+                                tracker = SegmentTracker(total_segments)
+                                first_payload = num_bytes - header_size
+                            if tracker.add(segment_number):
+                                data_size += num_bytes - header_size
+                            arrivals.add(received_at)
+                            sender_addr = addr
+                            frontier = max(frontier, segment_number + 1)
+                            last_packet = time.monotonic()
+                            last_packet_ns = time.perf_counter_ns()
+                            timer.mark('first_byte', last_packet_ns)
+                            if last_packet >= next_meter_flush:
+                                meter.add(data_size - metered_size)
+                                metered_size = data_size
+                                next_meter_flush = last_packet + METER_FLUSH_INTERVAL
+                            if not reliable and arrivals.count % IDLE_TIMEOUT_UPDATE == 0:
+                                s.settimeout(arrivals.idle_timeout())
+                            if not reliable and tracker.received == total_segments:
+                                break
                 except socket.timeout:
-                    break
+                    if not reliable:
+                        break
+                    if time.monotonic() - last_packet > RELIABLE_TIMEOUT:
+                        print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Server stopped sending, giving up.{RESET}")
+                        break
                 except socket.error as e:
                     print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Socket error during receive: {e}{RESET}")
                     break
 
-            duration = time.time() - start_time
-            success_rate = (len(received_segments) / total_segments * 100) if total_segments > 0 else 0.0
+                if reliable and sender_addr and time.monotonic() >= next_report:
+                    base = tracker.first_missing(base)
+                    nack = build_nack(tracker, base, frontier)
+                    if base >= total_segments:
+                        for _ in range(FINAL_NACK_COUNT):
+                            s.sendto(nack, sender_addr)
+                        break
+                    s.sendto(nack, sender_addr)
+                    next_report = time.monotonic() + NACK_INTERVAL
 
-            print(
-                f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}UDP download{RESET} {ID_COLOR}#{connection_id}{RESET} complete in {METRIC_COLOR}{duration:.2f} seconds{RESET}, "
-                f"speed: {METRIC_COLOR}{data_size / duration / 1000 :.2f} kB/s{RESET}, with {METRIC_COLOR}{success_rate:.2f}%{RESET} packet success rate{RESET}")
+            meter.add(data_size - metered_size)
+            timer.mark('last_byte', last_packet_ns)
+            client_metrics.record_phases('udp', timer)
+            duration = phase_duration(timer, 'request', 'last_byte')
+            result = report_udp_download(connection_id, tracker, arrivals, data_size, first_payload, duration)
+            if verifier is not None:
+                print_verification(f"{UDP_DOWNLOAD_COLOR}UDP download{RESET}", connection_id, verifier, duration)
+                result.update(verifier.summary())
+            result['phases'] = phase_times(timer)
+            return result
 
     except Exception as e:
         print(f"{BLUE}[Client]{RESET} {UDP_DOWNLOAD_COLOR}Unexpected error: {e}{RESET}")
 
 
-def main():
+async def wait_readable(loop, sock):
+    """
+    Waits until a non-blocking socket has data to read.
+    """
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def async_tcp_download(server_ip, tcp_port, file_size, buffer):
+    """
+    Event-loop version of `tcp_download` used by the load generator. Prints nothing.
+
+    :param server_ip: The IP address of the server.
+    :param tcp_port: The TCP port of the server.
+    :param file_size: The size of the file to be downloaded in bytes.
+    :param buffer: A memoryview the data is read into. The data is discarded, so every download of the
+        event loop shares the same buffer.
+    :return: The protocol, bytes received, duration from connect to last byte, throughput in bytes per second
+        and phase times in nanoseconds of the download.
+    :raises TransferRejected: If the server turns the request away.
+    :raises ConnectionError: If the server closes the connection early.
+    """
+    loop = asyncio.get_running_loop()
+    meter = client_metrics.meter('tcp')
+    timer = PhaseTimer()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setblocking(False)
+        await loop.sock_connect(s, (server_ip, tcp_port))
+        timer.mark('connect')
+        await loop.sock_sendall(s, f"{file_size}\n".encode())
+        timer.mark('request')
+        received = 0
+        # The first bytes may be a reject packet, so they are read apart from the shared buffer, which other
+        # downloads overwrite before this one resumes
+        head = memoryview(bytearray(REJECT_PACKET_SIZE))
+        while received < file_size:
+            view = buffer if received else head
+            num_bytes = await loop.sock_recv_into(s, view[:min(len(view), file_size - received)])
+            if not num_bytes:
+                raise parse_reject(head, received) or ConnectionError(
+                    "Connection lost before file was fully received.")
+            timer.mark('first_byte')
+            meter.add(num_bytes)
+            received += num_bytes
+    timer.mark('last_byte')
+    client_metrics.record_phases('tcp', timer)
+    duration = max(timer.marks['last_byte'] - timer.start, 1) / 1e9
+    return {'protocol': 'tcp', 'bytes': received, 'duration': duration, 'throughput': received / duration,
+            'phases': phase_times(timer)}
+
+
+class AsyncSession:
+    """
+    Event-loop version of `Session`, over which the load generator pipelines its downloads.
+
+    A download sends its request as soon as it is made, without waiting for the responses to the earlier
+    ones. The server answers in request order, so a reader task reads each response in turn into the
+    shared buffer and completes the download waiting for it.
+    """
+
+    def __init__(self, server_ip, tcp_port, buffer):
+        self.address = (server_ip, tcp_port)
+        self.buffer = buffer
+        self.sock = None
+        self.pending = deque()  # (request id, future, timer, length) in request order
+        self.closed = False
+        self.in_flight = 0  # Downloads made on the session and not yet over, including those waiting to send
+        self.next_request_id = 0
+        self._send_lock = asyncio.Lock()  # Keeps request frames whole and in the order of `pending`
+        self._reader = None
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Requests must not wait for the server's ACKs
+        try:
+            await loop.sock_connect(self.sock, self.address)
+            await loop.sock_sendall(self.sock, SESSION_HELLO)
+        except OSError:
+            self.close()
+            raise
+        self._reader = asyncio.create_task(self._read_responses())
+
+    async def download(self, file_size):
+        """
+        Requests a file over the session and waits for it to arrive.
+
+        :return: The same result as `async_tcp_download`.
+        :raises TransferRejected: If the server turns the request away.
+        :raises ConnectionError: If the session fails before the file arrived.
+        """
+        loop = asyncio.get_running_loop()
+        timer = PhaseTimer()
+        future = loop.create_future()
+        self.in_flight += 1
+        try:
+            async with self._send_lock:
+                if self.sock is None and not self.closed:
+                    await self._open()
+                if self.closed:
+                    raise ConnectionError("Session closed.")
+                request_id = self.next_request_id
+                self.next_request_id += 1
+                self.pending.append((request_id, future, timer, file_size))
+                await loop.sock_sendall(self.sock, SESSION_REQUEST_STRUCT.pack(
+                    MAGIC_COOKIE, SESSION_REQUEST_TYPE, request_id, file_size, 0, file_size, 0, 0))
+                timer.mark('request')
+            return await future
+        finally:
+            self.in_flight -= 1
+
+    async def _receive_exactly(self, view):
+        loop = asyncio.get_running_loop()
+        received = 0
+        while received < len(view):
+            num_bytes = await loop.sock_recv_into(self.sock, view[received:])
+            if not num_bytes:
+                raise ConnectionError("Session closed by the server.")
+            received += num_bytes
+
+    async def _read_responses(self):
+        loop = asyncio.get_running_loop()
+        meter = client_metrics.meter('tcp')
+        header = memoryview(bytearray(SESSION_RESPONSE_STRUCT.size))
+        try:
+            while True:
+                await self._receive_exactly(header)
+                if not self.pending:
+                    raise ConnectionError("Response received without a request.")
+                request_id, future, timer, length = self.pending.popleft()
+                reason, retry_after_ms = check_session_response(header, request_id, length)
+                if reason:
+                    retry_after = retry_after_ms / 1000 if retry_after_ms else None
+                    if not future.done():
+                        future.set_exception(TransferRejected(reason, retry_after))
+                    continue
+                received = 0
+                while received < length:
+                    num_bytes = await loop.sock_recv_into(self.sock, self.buffer[:min(len(self.buffer),
+                                                                                      length - received)])
+                    if not num_bytes:
+                        raise ConnectionError("Connection lost before file was fully received.")
+                    timer.mark('first_byte')
+                    meter.add(num_bytes)
+                    received += num_bytes
+                timer.mark('last_byte')
+                client_metrics.record_phases('tcp', timer)
+                duration = max(timer.marks['last_byte'] - timer.start, 1) / 1e9
+                if not future.done():
+                    future.set_result({'protocol': 'tcp', 'bytes': received, 'duration': duration,
+                                       'throughput': received / duration, 'phases': phase_times(timer)})
+        except (OSError, ConnectionError) as e:
+            self.close(e)
+
+    def close(self, error=None):
+        """
+        Closes the session and fails the downloads still waiting on it.
+        """
+        self.closed = True
+        if self.sock is not None:
+            self.sock.close()
+        while self.pending:
+            _, future, _, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error or ConnectionError("Session closed."))
+        if self._reader is not None and self._reader is not asyncio.current_task():
+            self._reader.cancel()
+
+
+class AsyncSessionPool:
+    """
+    Persistent sessions to one server, shared by the downloads of an event loop.
+
+    A download goes to the open session with the fewest requests in flight. Another session is opened
+    while every session has `pipeline_depth` requests in flight and fewer than `max_sessions` are open,
+    and failed sessions are replaced on the next download.
+    """
+
+    def __init__(self, server_ip, tcp_port, buffer, max_sessions, pipeline_depth=PIPELINE_DEPTH):
+        self.server_ip = server_ip
+        self.tcp_port = tcp_port
+        self.buffer = buffer
+        self.max_sessions = max_sessions
+        self.pipeline_depth = pipeline_depth
+        self.sessions = []
+
+    async def download(self, file_size):
+        """
+        Downloads a file over one of the pooled sessions.
+
+        :return: The same result as `async_tcp_download`.
+        """
+        self.sessions = [session for session in self.sessions if not session.closed]
+        session = min(self.sessions, key=lambda session: session.in_flight, default=None)
+        if session is None or (session.in_flight >= self.pipeline_depth and len(self.sessions) < self.max_sessions):
+            session = AsyncSession(self.server_ip, self.tcp_port, self.buffer)
+            self.sessions.append(session)
+        return await session.download(file_size)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+
+async def async_udp_download(server_ip, udp_port, file_size, buffer, rate=0, reliable=False):
+    """
+    Event-loop version of `udp_download` used by the load generator. Prints nothing.
+
+    The download ends once every segment has arrived, or after the adaptive `ArrivalTimes.idle_timeout`
+    without a packet. A reliable download reports its missing segments every `NACK_INTERVAL` instead, and
+    ends once every segment has arrived or after `RELIABLE_TIMEOUT` seconds without a packet.
+
+    :param server_ip: The IP address of the server.
+    :param udp_port: The UDP port of the server.
+    :param file_size: The size of the file to be downloaded in bytes.
+    :param buffer: A buffer of at least `UDP_RECV_BUFFER_SIZE` bytes, shared by the downloads of the event loop.
+    :param rate: The rate in bytes per second to ask the server to send at, 0 to leave it to the server.
+    :param reliable: Ask for a reliable transfer, retransmitting the segments reported missing.
+    :return: The protocol, payload bytes received, duration, throughput in bytes per second between the
+        first and the last packet, packet success rate, inter-arrival time and jitter in seconds and phase
+        times in nanoseconds of the download.
+    :raises TransferRejected: If the server turns the request away.
+    """
+    loop = asyncio.get_running_loop()
+    request = struct.pack(REQUEST_PACKET_FORMAT, MAGIC_COOKIE, REQUEST_TYPE, file_size)
+    if rate or reliable:
+        request += struct.pack(REQUEST_OPTIONS_FORMAT, rate, RELIABLE_FLAG if reliable else 0)
+
+    timer = PhaseTimer()
+    last_packet = timer.start
+    tracker = None
+    data_size = 0
+    first_payload = 0
+    arrivals = ArrivalTimes()
+    buffers = [buffer]
+    sender_addr = None  # Reports go to the server socket that sends the payload
+    base = frontier = 0
+    last_arrival = next_report = loop.time()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setblocking(False)
+        timestamps = enable_timestamps(s)
+        await loop.sock_sendto(s, request, (server_ip, udp_port))
+        timer.mark('request')
+        while reliable or tracker is None or tracker.received < tracker.total_segments:
+            try:
+                if timestamps:
+                    num_bytes, ancdata, _, addr = s.recvmsg_into(buffers, TIMESTAMP_ANCILLARY_SIZE)
+                    received_at = receive_timestamp(ancdata)
+                else:
+                    num_bytes, addr = s.recvfrom_into(buffer)
+                    received_at = time.time_ns()
+            except BlockingIOError:
+                try:
+                    await asyncio.wait_for(wait_readable(loop, s),
+                                           NACK_INTERVAL if reliable else arrivals.idle_timeout())
+                except asyncio.TimeoutError:
+                    if not reliable or loop.time() - last_arrival > RELIABLE_TIMEOUT:
+                        break
+            else:
+                if num_bytes < PAYLOAD_PACKET_HEADER_SIZE:
+                    rejection = parse_reject(buffer, num_bytes)
+                    if rejection:
+                        raise rejection
+                    continue
+                magic_cookie, msg_type, total_segments, segment_number = PAYLOAD_PACKET_STRUCT.unpack_from(buffer)
+                if (magic_cookie, msg_type) != (MAGIC_COOKIE, PAYLOAD_TYPE):
+                    continue
+                if tracker is None:
+                    tracker = SegmentTracker(total_segments)
+                    first_payload = num_bytes - PAYLOAD_PACKET_HEADER_SIZE
+                if tracker.add(segment_number):
+                    data_size += num_bytes - PAYLOAD_PACKET_HEADER_SIZE
+                arrivals.add(received_at)
+                sender_addr = addr
+                frontier = max(frontier, segment_number + 1)
+                last_arrival = loop.time()
+                last_packet = time.perf_counter_ns()
+                timer.mark('first_byte', last_packet)
+
+            if reliable and sender_addr and loop.time() >= next_report:
+                base = tracker.first_missing(base)
+                nack = build_nack(tracker, base, frontier)
+                if base >= tracker.total_segments:
+                    for _ in range(FINAL_NACK_COUNT):
+                        await loop.sock_sendto(s, nack, sender_addr)
+                    break
+                await loop.sock_sendto(s, nack, sender_addr)
+                next_report = loop.time() + NACK_INTERVAL
+
+    timer.mark('last_byte', last_packet)
+    client_metrics.record_phases('udp', timer)
+    client_metrics.meter('udp').add(data_size)
+    duration = max(last_packet - timer.start, 1) / 1e9
+    success_rate = tracker.received / tracker.total_segments * 100 if tracker else 0.0
+    return {'protocol': 'udp', 'bytes': data_size, 'duration': duration,
+            'throughput': arrival_throughput(arrivals, data_size, first_payload, duration),
+            'success_rate': success_rate, 'inter_arrival': arrivals.mean_gap / 1e9, 'jitter': arrivals.jitter / 1e9,
+            'phases': phase_times(timer)}
+
+
+async def run_load(server_ip, tcp_port, udp_port, file_size, tcp_connections, udp_connections,
+                   arrival_rate=0, udp_fraction=0.0, duration=0, max_in_flight=LOAD_MAX_IN_FLIGHT, rate=0,
+                   sessions=0, pipeline_depth=PIPELINE_DEPTH, reliable=False):
+    """
+    Generates download load against one server on a single event loop.
+
+    In closed-loop mode `tcp_connections` and `udp_connections` downloads run concurrently, and each starts
+    a new download as soon as the previous one ends, until `duration` seconds are over. Without a duration
+    each runs once. In open-loop mode new downloads arrive as a Poisson process of `arrival_rate` downloads
+    per second regardless of how fast the server serves them, `udp_fraction` of them over UDP.
+
+    With `sessions` TCP downloads are pipelined over at most that many persistent sessions, up to
+    `pipeline_depth` requests in flight on each, instead of opening a connection per download. With
+    `reliable` UDP downloads ask for reliable transfers.
+
+    :return: A tuple of the completed download results, each with its `latency` from arrival to last byte,
+        a Counter of failed downloads by protocol and of rejected ones by protocol with a `_rejected`
+        suffix, and the elapsed time in seconds.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = memoryview(bytearray(max(TCP_READ_SIZE, UDP_RECV_BUFFER_SIZE)))
+    in_flight = asyncio.Semaphore(max_in_flight)
+    results = []
+    errors = Counter()
+    start_time = loop.time()
+    deadline = start_time + duration if duration else None
+    pool = AsyncSessionPool(server_ip, tcp_port, buffer, sessions, pipeline_depth) if sessions else None
+
+    async def download(protocol, arrival):
+        """
+        Runs one download and records its result.
+
+        :return: True if the server rejected it for good, so retrying the same download is pointless.
+        """
+        async with in_flight:
+            try:
+                if pool is not None and protocol == 'tcp':
+                    result = await pool.download(file_size)
+                elif protocol == 'tcp':
+                    result = await async_tcp_download(server_ip, tcp_port, file_size, buffer)
+                else:
+                    result = await async_udp_download(server_ip, udp_port, file_size, buffer, rate, reliable)
+            except TransferRejected as e:
+                errors[f'{protocol}_rejected'] += 1
+                backoff = e.retry_after
+            except (OSError, ConnectionError):
+                errors[protocol] += 1
+                return False
+            else:
+                result['latency'] = loop.time() - arrival
+                results.append(result)
+                return False
+        if backoff is None:
+            return True
+        await asyncio.sleep(backoff)  # Honour the server's back-off before this loop downloads again
+        return False
+
+    if arrival_rate:
+        tasks = set()
+        next_arrival = start_time
+        while next_arrival < deadline:
+            await asyncio.sleep(max(0.0, next_arrival - loop.time()))
+            while next_arrival <= loop.time() and next_arrival < deadline:
+                protocol = 'udp' if random.random() < udp_fraction else 'tcp'
+                task = asyncio.create_task(download(protocol, next_arrival))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                next_arrival += random.expovariate(arrival_rate)
+        await asyncio.gather(*tasks)
+    else:
+        async def closed_loop(protocol):
+            while True:
+                if await download(protocol, loop.time()):
+                    return  # Rejected for good, as a file larger than the server serves
+                if deadline is None or loop.time() >= deadline:
+                    return
+
+        await asyncio.gather(*(closed_loop('tcp') for _ in range(tcp_connections)),
+                             *(closed_loop('udp') for _ in range(udp_connections)))
+    if pool is not None:
+        pool.close()
+    return results, errors, loop.time() - start_time
+
+
+def run_load_process(load_args):
+    """
+    Runs `run_load` in a process of the load generator pool.
+
+    :return: The `run_load` results followed by the exported metrics of the process.
+    """
+    return (*asyncio.run(run_load(*load_args)), client_metrics.export())
+
+
+def report_metrics(metrics_queue):
+    """
+    Periodically sends the exported metrics of a load generator process to the parent.
+    """
+    while True:
+        time.sleep(STATS_REPORT_INTERVAL)
+        metrics_queue.put((os.getpid(), client_metrics.export()))
+
+
+def start_metrics_reports(metrics_queue):
+    """
+    Initializer of the load generator pool processes.
+    """
+    threading.Thread(target=report_metrics, args=(metrics_queue,), daemon=True).start()
+
+
+def collect_metrics(metrics_queue, process_metrics):
+    """
+    Keeps the latest metrics reported by every load generator process in `process_metrics`.
+    """
+    while True:
+        pid, exported = metrics_queue.get()
+        process_metrics[pid] = exported
+
+
+def merge_metrics(exports):
+    registry = MetricsRegistry()
+    for exported in exports:
+        registry.merge(exported)
+    return registry
+
+
+def percentile(sorted_values, p):
+    """
+    Returns the nearest-rank `p`th percentile of an ascending list.
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))]
+
+
+def print_load_summary(results, errors, elapsed, registry=None):
+    """
+    Prints latency and throughput percentiles of the load generator downloads, per protocol, and the
+    phase percentiles recorded in `registry`.
+    """
+    for protocol, color in (('tcp', TCP_DOWNLOAD_COLOR), ('udp', UDP_DOWNLOAD_COLOR)):
+        protocol_results = [result for result in results if result['protocol'] == protocol]
+        rejected = errors[f'{protocol}_rejected']
+        if not protocol_results and not errors[protocol] and not rejected:
+            continue
+        latencies = sorted(result['latency'] * 1000 for result in protocol_results)
+        throughputs = sorted(result['throughput'] / 1000 for result in protocol_results)
+        total_bytes = sum(result['bytes'] for result in protocol_results)
+        latency_percentiles = ', '.join(f"p{p} {METRIC_COLOR}{percentile(latencies, p):.2f}{RESET}" for p in PERCENTILES)
+        throughput_percentiles = ', '.join(f"p{p} {METRIC_COLOR}{percentile(throughputs, 100 - p):.2f}{RESET}"
+                                           for p in PERCENTILES)
+        print(f"{BLUE}[Client]{RESET} {color}{protocol.upper()}{RESET}: {METRIC_COLOR}{len(protocol_results)}{RESET} downloads "
+              f"({METRIC_COLOR}{len(protocol_results) / elapsed:.2f}/s{RESET}), {METRIC_COLOR}{errors[protocol]}{RESET} errors, "
+              f"{METRIC_COLOR}{rejected}{RESET} rejected, "
+              f"total speed: {METRIC_COLOR}{total_bytes / elapsed / 1000:.2f} kB/s{RESET}")
+        print(f"{BLUE}[Client]{RESET}     latency ms: {latency_percentiles}, max {METRIC_COLOR}{latencies[-1] if latencies else 0:.2f}{RESET}")
+        print(f"{BLUE}[Client]{RESET}     speed kB/s (slowest first): {throughput_percentiles}")
+        if registry is not None:
+            phases = ', '.join(
+                f"{name.split('.', 1)[1]} {METRIC_COLOR}{histogram.percentile(50) / 1e6:.2f}/{histogram.percentile(99) / 1e6:.2f}{RESET}"
+                for name, histogram in registry.histograms.items() if name.startswith(protocol + '.'))
+            if phases:
+                print(f"{BLUE}[Client]{RESET}     phases ms after start (p50/p99): {phases}")
+        if protocol == 'udp' and protocol_results:
+            success_rate = sum(result['success_rate'] for result in protocol_results) / len(protocol_results)
+            jitters = sorted(result['jitter'] * 1e6 for result in protocol_results)
+            jitter_percentiles = ', '.join(f"p{p} {METRIC_COLOR}{percentile(jitters, p):.1f}{RESET}" for p in PERCENTILES)
+            print(f"{BLUE}[Client]{RESET}     mean packet success rate: {METRIC_COLOR}{success_rate:.2f}%{RESET}")
+            print(f"{BLUE}[Client]{RESET}     inter-arrival jitter µs: {jitter_percentiles}")
+
+
+def raise_file_limit():
+    """
+    Raises the open file limit to its hard maximum so thousands of sockets can be open at once.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def load_generator(args):
+    """
+    Runs the load generator described by the command line options and prints its summary.
+    """
+    raise_file_limit()
+    processes = max(1, args.processes)
+
+    def share(total, index):
+        return total // processes + (1 if index < total % processes else 0)
+
+    load_args = [(args.server, args.tcp_port, args.udp_port, args.size,
+                  share(args.tcp, i), share(args.udp, i), args.arrival_rate / processes, args.udp_fraction,
+                  args.duration, args.max_in_flight, args.rate, max(1, share(args.sessions, i)) if args.sessions else 0,
+                  args.pipeline_depth, args.reliable)
+                 for i in range(processes)]
+    print(f"{BLUE}[Client]{RESET} Generating load against {ADDR_COLOR}{args.server}{RESET} "
+          f"with {METRIC_COLOR}{processes}{RESET} process(es)")
+    if processes == 1:
+        if args.stats_port:
+            start_stats_endpoint(args.stats_port, client_metrics.snapshot)
+        outcomes = [run_load_process(load_args[0])]
+    else:
+        metrics_queue = multiprocessing.Queue()
+        process_metrics = {}
+        threading.Thread(target=collect_metrics, args=(metrics_queue, process_metrics), daemon=True).start()
+        if args.stats_port:
+            start_stats_endpoint(args.stats_port, lambda: merge_metrics(list(process_metrics.values())).snapshot())
+        # One task per process, so every process reports the metrics of exactly one share of the load
+        with multiprocessing.Pool(processes, initializer=start_metrics_reports, initargs=(metrics_queue,),
+                                  maxtasksperchild=1) as pool:
+            outcomes = pool.map(run_load_process, load_args)
+
+    results = [result for outcome in outcomes for result in outcome[0]]
+    errors = sum((outcome[1] for outcome in outcomes), Counter())
+    elapsed = max(outcome[2] for outcome in outcomes)
+    print_load_summary(results, errors, elapsed, merge_metrics(outcome[3] for outcome in outcomes))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Speed test client. Without --server it asks for the transfer sizes and waits for a server offer.")
+    parser.add_argument('--server', help="Server IP address. Skips waiting for offers and runs as a load generator.")
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_UDP_PORT)
+    parser.add_argument('--size', type=int, default=1_000_000, help="File size in bytes of every download.")
+    parser.add_argument('--tcp', type=int, default=1, help="Concurrent TCP downloads in closed-loop mode.")
+    parser.add_argument('--udp', type=int, default=0, help="Concurrent UDP downloads in closed-loop mode.")
+    parser.add_argument('--duration', type=float, default=0,
+                        help="Seconds to keep generating downloads. 0 runs each closed-loop download once.")
+    parser.add_argument('--arrival-rate', type=float, default=0,
+                        help="Open-loop mode: new downloads per second, arriving as a Poisson process. Needs --duration.")
+    parser.add_argument('--udp-fraction', type=float, default=0.0,
+                        help="Open-loop mode: fraction of the downloads made over UDP.")
+    parser.add_argument('--max-in-flight', type=int, default=LOAD_MAX_IN_FLIGHT,
+                        help="Most concurrent downloads per process. Open-loop arrivals beyond it wait.")
+    parser.add_argument('--rate', type=int, default=0,
+                        help="UDP rate in bytes per second to ask the server for, in both modes. 0 leaves it to the "
+                             "server.")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Load generator processes, each running its own event loop with a share of the load.")
+    parser.add_argument('--stats-port', type=int, default=0,
+                        help="Local TCP port serving the live download phase timings and throughput as JSON. "
+                             "0 disables it.")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help="Lowest level logged. 'debug' also logs every UDP segment received.")
+    parser.add_argument('--stripes', type=int, default=1,
+                        help="Interactive mode: split every TCP download into this many parallel range requests.")
+    parser.add_argument('--mmap', action='store_true',
+                        help="Interactive mode: reassemble striped downloads into a memory map instead of a bytearray.")
+    parser.add_argument('--multicast-group', nargs='?', const=OFFER_MULTICAST_GROUP,
+                        help=f"Interactive mode: also listen for offers sent to this multicast group, "
+                             f"{OFFER_MULTICAST_GROUP} when no group is given.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Interactive mode: request checksummed payloads and verify them, reporting the time "
+                             "spent verifying separately.")
+    parser.add_argument('--server-selection', choices=('load', 'latency'), default='load',
+                        help="Interactive mode: spread downloads over the offered servers by their reported load, "
+                             "or send them to the servers with the lowest round trip time.")
+    parser.add_argument('--sessions', type=int, default=0,
+                        help="Download over persistent TCP sessions instead of a connection per download. "
+                             "Load generator: pipeline the TCP downloads over at most this many sessions, split "
+                             "across processes. Interactive mode: keep up to this many idle sessions per server for "
+                             "the next downloads. 0 opens a connection per download.")
+    parser.add_argument('--pipeline-depth', type=int, default=PIPELINE_DEPTH,
+                        help="Load generator: requests in flight on a session before another session is opened.")
+    parser.add_argument('--reliable', action='store_true',
+                        help="Download over UDP reliably: report missing segments so the server retransmits them, "
+                             "with its rate adapted to the losses.")
+    parser.add_argument('--capture', metavar='PATH',
+                        help="Interactive mode: record every payload datagram and TCP read to a binary trace at PATH, "
+                             "for replay.py.")
+    args = parser.parse_args()
+    if args.arrival_rate and not args.duration:
+        parser.error("--arrival-rate needs --duration")
+    return args
+
+
+def print_server_choices(choices, servers):
+    """
+    Prints how many downloads of a round go to each server, with the server's round trip time and load.
+    """
+    for server, downloads in Counter(choices).items():
+        info = servers.get(server, {})
+        rtt = f"{info['rtt'] * 1000:.2f} ms" if info.get('rtt') is not None else "unknown"
+        print(f"{BLUE}[Client]{RESET} {METRIC_COLOR}{downloads}{RESET} downloads to {ADDR_COLOR}{server[0]}{RESET} "
+              f"(UDP {ADDR_COLOR}{server[1]}{RESET}, TCP {ADDR_COLOR}{server[2]}{RESET}), "
+              f"RTT {METRIC_COLOR}{rtt}{RESET}, {METRIC_COLOR}{info.get('load', 0)}{RESET} transfers active")
+
+
+def interactive(stripes=1, use_mmap=False, multicast_group=None, selection='load', verify=False, sessions=0,
+                reliable=False, rate=0):
+    session_pool = SessionPool(sessions) if sessions else None
+    try:
+        discovery = ServerDiscovery(multicast_group, selection=selection).start()
+    except RuntimeError as e:
+        print(f"{ERROR}[Client]{RESET} {OFFER_COLOR}Critical error: {e}")
+        return
+    print(f"{BLUE}[Client]{OFFER_COLOR} Listening for offers...{RESET}")
     while True:
         print(f"{UDP_DOWNLOAD_COLOR}{GOOSE}{RESET}")
         file_size = int(input("Enter file size in bytes: "))
         tcp_conn = int(input("Enter number of TCP connections: "))
         udp_conn = int(input("Enter number of UDP connections: "))
 
-        server_ip, udp_port, tcp_port = listen_for_offers()
+        choices = discovery.choose(tcp_conn + udp_conn)
+        print_server_choices(choices, discovery.servers())
         udp_threads = []
         tcp_threads = []
         for i in range(1, tcp_conn + 1):
-            tcp_threads.append(threading.Thread(target=tcp_download, args=(server_ip, tcp_port, file_size, i)))
+            server_ip, _, tcp_port = choices[i - 1]
+            if stripes > 1:
+                tcp_threads.append(threading.Thread(target=striped_tcp_download,
+                                                    args=(server_ip, tcp_port, file_size, i, stripes, use_mmap),
+                                                    kwargs={'verify': verify, 'sessions': session_pool}))
+            else:
+                tcp_threads.append(threading.Thread(target=tcp_download, args=(server_ip, tcp_port, file_size, i),
+                                                    kwargs={'verify': verify, 'sessions': session_pool}))
 
         for i in range(1, udp_conn + 1):
-            udp_threads.append(threading.Thread(target=udp_download, args=(server_ip, udp_port, file_size, i)))
+            server_ip, udp_port, _ = choices[tcp_conn + i - 1]
+            udp_threads.append(threading.Thread(target=udp_download, args=(server_ip, udp_port, file_size, i),
+                                                kwargs={'verify': verify, 'reliable': reliable, 'rate': rate}))
 
         for t in tcp_threads:
             t.start()
@@ -221,7 +1771,23 @@ def main():
         for t in udp_threads:
             t.join()
 
-        print(f"{BLUE}[Client]{RESET} All transfers complete, listening to {OFFER_COLOR}offer requests{RESET}")
+        print(f"{BLUE}[Client]{RESET} All transfers complete, choosing from {METRIC_COLOR}{len(discovery.servers())}"
+              f"{RESET} {OFFER_COLOR}offered servers{RESET}")
+
+
+def main():
+    global client_capture
+    args = parse_args()
+    setup_logging('client', 'Client', args.log_level)
+    if args.capture:
+        client_capture = open_trace(args.capture)
+    if args.server:
+        load_generator(args)
+    else:
+        if args.stats_port:
+            start_stats_endpoint(args.stats_port, client_metrics.snapshot)
+        interactive(args.stripes, args.mmap, args.multicast_group, args.server_selection, args.verify, args.sessions,
+                    args.reliable, args.rate)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+# logs.py
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_QUEUE_SIZE = 10000  # Records buffered for the writer thread, newer ones are dropped when it falls behind
+RATE_LIMIT_INTERVAL = 1.0  # Seconds over which repeats of the same warning are counted
+RATE_LIMIT_BURST = 5  # Repeats of the same warning written per interval, the rest are suppressed
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+# ANSI Color Codes
+GREEN = '\033[92m'
+WARNING = '\033[93m'
+ERROR = '\033[91m'
+RESET = '\033[0m'
+
+# Attributes every LogRecord has, anything else was passed through `extra` and goes into JSON output
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'suppressed', 'dropped'}
+
+
+class LogThrottle(logging.Filter):
+    """
+    Samples informational records and rate-limits warnings, per message template.
+
+    Records are grouped by their unformatted message, so "Invalid request from %s" floods from many
+    addresses count as one message. Of every `sample` informational records with the same template
+    only the first is kept. At most `burst` warnings or errors with the same template are kept per
+    `interval` seconds, and the first one kept after a suppressed stretch carries the number of
+    suppressed records in its `suppressed` attribute.
+    """
+
+    def __init__(self, sample=1, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.sample = max(1, sample)
+        self.burst = burst
+        self.interval = interval
+        self._seen = {}  # Template to number of informational records seen
+        self._windows = {}  # Template to [window start, records kept, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = record.msg
+        with self._lock:
+            if record.levelno < logging.WARNING:
+                seen = self._seen.get(key, 0)
+                self._seen[key] = seen + 1
+                return seen % self.sample == 0
+
+            now = time.monotonic()
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without ever blocking the caller.
+
+    Formatting is left to the writer thread. When the queue is full the record is dropped, and the
+    next record that fits carries the number of dropped records in its `dropped` attribute.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # The writer thread lives in the same process, so the record needs no pickling-safe copy
+        return record
+
+    def enqueue(self, record):
+        with self._lock:
+            if self.dropped:
+                record.dropped = self.dropped
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+            else:
+                self.dropped = 0
+
+
+class ColorFormatter(logging.Formatter):
+    """
+    Formats records the way the server and client print, with a coloured `[tag]` prefix.
+
+    Informational records are tagged with `tag`, warnings and errors with their level.
+    """
+
+    def __init__(self, tag):
+        super().__init__()
+        self.tag = tag
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            line = f"{ERROR}[Error] {message}{RESET}"
+        elif record.levelno >= logging.WARNING:
+            line = f"{WARNING}[Warning] {message}{RESET}"
+        elif record.levelno >= logging.INFO:
+            line = f"{GREEN}[{self.tag}] {message}{RESET}"
+        else:
+            line = f"[Debug] {message}"
+        if getattr(record, 'suppressed', 0):
+            line += f" ({record.suppressed} similar messages suppressed)"
+        if getattr(record, 'dropped', 0):
+            line += f" ({record.dropped} messages dropped)"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line, with the fields passed through `extra`.
+    """
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname.lower(), 'logger': record.name,
+                 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if getattr(record, 'dropped', 0):
+            entry['dropped'] = record.dropped
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BlockingStopListener(logging.handlers.QueueListener):
+    """
+    Queue listener whose stop waits for room in a full queue instead of failing.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+_listeners = {}  # Logger name to (pid, listener), a forked process does not own its parent's listeners
+
+
+def setup_logging(name, tag, level='info', json_output=False, sample=1, stream=None):
+    """
+    Routes the records of the `name` logger through a bounded queue to a background writer thread.
+
+    Callers only pay for the level check, the throttle and a non-blocking queue put. Can be called
+    again, for example in a forked worker process, to replace the previous configuration.
+
+    Parameters:
+    name (str): The logger to configure.
+    tag (str): The prefix of informational lines in text output.
+    level (str): The lowest level written, one of `LOG_LEVELS`.
+    json_output (bool): Write one JSON object per record instead of coloured text.
+    sample (int): Keep one of every `sample` informational records with the same message.
+    stream (TextIO): Where the writer thread writes, standard output by default.
+
+    Returns:
+    logging.Logger: The configured logger.
+    """
+    logger = logging.getLogger(name)
+    pid, previous = _listeners.pop(name, (None, None))
+    if pid == os.getpid():
+        previous.stop()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        logger.removeFilter(log_filter)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if json_output else ColorFormatter(tag))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = BlockingStopListener(log_queue, output)
+    listener.start()
+    _listeners[name] = (os.getpid(), listener)
+
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    logger.addFilter(LogThrottle(sample))
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return logger
+
+
+@atexit.register
+def flush_logs():
+    """
+    Writes out the queued records of every configured logger before the process exits.
+    """
+    for pid, listener in list(_listeners.values()):
+        if pid == os.getpid():
+            listener.stop()
+    _listeners.clear()
@@ -0,0 +1,271 @@
+# metrics.py
+import json
+import socket
+import threading
+import time
+from collections import deque
+
+SUB_BUCKET_BITS = 6  # Values keep their top 6 bits, so a histogram bucket is at most ~3% wide
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKET_COUNT = SUB_BUCKET_COUNT // 2
+HISTOGRAM_BUCKETS = SUB_BUCKET_COUNT + (64 - SUB_BUCKET_BITS) * HALF_SUB_BUCKET_COUNT
+HISTOGRAM_PERCENTILES = (50, 90, 99, 99.9)
+THROUGHPUT_SAMPLES = 60  # Number of one-second throughput samples kept per meter
+THROUGHPUT_WINDOW = 5  # Seconds the current throughput is averaged over
+STATS_HOST = '127.0.0.1'  # Stats endpoints only listen locally
+
+
+def bucket_index(value):
+    """
+    Maps a non-negative integer to its log-linear histogram bucket.
+
+    Values below `SUB_BUCKET_COUNT` get a bucket each, larger ones share a bucket with the values that
+    have the same bit length and the same top `SUB_BUCKET_BITS` bits.
+    """
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * HALF_SUB_BUCKET_COUNT + (value >> shift) - HALF_SUB_BUCKET_COUNT
+
+
+def bucket_value(index):
+    """
+    Returns the midpoint of the values that fall in a histogram bucket.
+    """
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift, offset = divmod(index - SUB_BUCKET_COUNT, HALF_SUB_BUCKET_COUNT)
+    shift += 1
+    return ((offset + HALF_SUB_BUCKET_COUNT) << shift) + (1 << shift) // 2
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations in nanoseconds.
+
+    Buckets are log-linear, so recording is O(1), memory is fixed and percentiles stay within a few
+    percent of the exact value from nanoseconds up to hours. Histograms from several processes are
+    merged by adding their buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def record(self, value_ns):
+        value_ns = max(0, value_ns)
+        with self._lock:
+            self.counts[bucket_index(value_ns)] += 1
+            self.count += 1
+            self.total += value_ns
+            self.min = value_ns if self.min is None else min(self.min, value_ns)
+            self.max = max(self.max, value_ns)
+
+    def percentile(self, p):
+        """
+        Returns the `p`th percentile in nanoseconds.
+        """
+        if not self.count:
+            return 0
+        rank = max(1, round(p / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def export(self):
+        """
+        Returns the state of the histogram in a picklable form, for `merge`.
+        """
+        with self._lock:
+            return {'counts': {index: count for index, count in enumerate(self.counts) if count},
+                    'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+    def merge(self, exported):
+        with self._lock:
+            for index, count in exported['counts'].items():
+                self.counts[index] += count
+            self.count += exported['count']
+            self.total += exported['total']
+            if exported['min'] is not None:
+                self.min = exported['min'] if self.min is None else min(self.min, exported['min'])
+            self.max = max(self.max, exported['max'])
+
+    def summary(self):
+        """
+        Returns the count, mean, min, max and percentiles of the histogram in milliseconds.
+        """
+        summary = {'count': self.count,
+                   'mean_ms': self.total / self.count / 1e6 if self.count else 0.0,
+                   'min_ms': (self.min or 0) / 1e6,
+                   'max_ms': self.max / 1e6}
+        for p in HISTOGRAM_PERCENTILES:
+            summary[f'p{p}_ms'] = self.percentile(p) / 1e6
+        return summary
+
+
+class ThroughputMeter:
+    """
+    Counts bytes in one-second samples and keeps the last `THROUGHPUT_SAMPLES` of them.
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=THROUGHPUT_SAMPLES)  # [second, bytes] pairs, oldest first
+        self._lock = threading.Lock()
+
+    def add(self, num_bytes, second=None):
+        second = int(time.time()) if second is None else second
+        with self._lock:
+            if self.samples and self.samples[-1][0] == second:
+                self.samples[-1][1] += num_bytes
+            elif not self.samples or self.samples[-1][0] < second:
+                self.samples.append([second, num_bytes])
+            else:
+                for sample in self.samples:
+                    if sample[0] == second:
+                        sample[1] += num_bytes
+                        break
+
+    def rate(self):
+        """
+        Returns the bytes per second averaged over the last `THROUGHPUT_WINDOW` complete seconds.
+        """
+        now = int(time.time())
+        with self._lock:
+            recent = sum(num_bytes for second, num_bytes in self.samples if now - THROUGHPUT_WINDOW <= second < now)
+        return recent / THROUGHPUT_WINDOW
+
+    def export(self):
+        with self._lock:
+            return [tuple(sample) for sample in self.samples]
+
+    def merge(self, exported):
+        for second, num_bytes in exported:
+            self.add(num_bytes, second)
+
+    def summary(self):
+        return {'bytes_per_second': self.rate(), 'samples': self.export()}
+
+
+class PhaseTimer:
+    """
+    Records when a connection reaches each phase, with `time.perf_counter_ns`.
+
+    Only the first time a phase is reached counts, so `mark('first_byte')` can be called for every chunk.
+    """
+
+    __slots__ = ('start', 'marks')
+
+    def __init__(self):
+        self.start = time.perf_counter_ns()
+        self.marks = {}
+
+    def mark(self, phase, timestamp=None):
+        if phase not in self.marks:
+            self.marks[phase] = time.perf_counter_ns() if timestamp is None else timestamp
+
+
+class MetricsRegistry:
+    """
+    Phase latency histograms and throughput meters of one process, by name.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.meters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def meter(self, name):
+        meter = self.meters.get(name)
+        if meter is None:
+            with self._lock:
+                meter = self.meters.setdefault(name, ThroughputMeter())
+        return meter
+
+    def record_phases(self, prefix, timer):
+        """
+        Records the time from the start of `timer` to each of its phases in the `prefix.phase` histograms.
+        """
+        for phase, timestamp in timer.marks.items():
+            self.histogram(f'{prefix}.{phase}').record(timestamp - timer.start)
+
+    def export(self):
+        """
+        Returns the state of every histogram and meter in a picklable form, for `merge`.
+        """
+        with self._lock:
+            histograms, meters = dict(self.histograms), dict(self.meters)
+        return {'histograms': {name: histogram.export() for name, histogram in histograms.items()},
+                'meters': {name: meter.export() for name, meter in meters.items()}}
+
+    def merge(self, exported):
+        for name, histogram in exported['histograms'].items():
+            self.histogram(name).merge(histogram)
+        for name, meter in exported['meters'].items():
+            self.meter(name).merge(meter)
+
+    def snapshot(self):
+        """
+        Returns a JSON-serializable summary of every histogram and meter.
+        """
+        with self._lock:
+            histograms, meters = dict(self.histograms), dict(self.meters)
+        return {'latency': {name: histogram.summary() for name, histogram in sorted(histograms.items())},
+                'throughput': {name: meter.summary() for name, meter in sorted(meters.items())}}
+
+
+def serve_stats(port, snapshot):
+    """
+    Serves `snapshot()` as JSON to every connection on a local TCP port, until the process exits.
+
+    The reply is a minimal HTTP response, so the endpoint can be read with `curl http://127.0.0.1:<port>/`
+    as well as with a plain TCP connection.
+
+    Parameters:
+    port (int): The local port to listen on.
+    snapshot (Callable[[], dict]): Returns the stats to serve.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((STATS_HOST, port))
+            s.listen()
+        except OSError as e:
+            print(f"[Error] Failed to start stats endpoint on port {port}: {e}")
+            return
+        while True:
+            conn, _ = s.accept()
+            with conn:
+                try:
+                    conn.settimeout(0.1)
+                    try:
+                        conn.recv(1024)  # Skip the request line of an HTTP client
+                    except socket.timeout:
+                        pass
+                    body = json.dumps(snapshot()).encode()
+                    conn.sendall(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                                 b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                except OSError:
+                    pass
+
+
+def start_stats_endpoint(port, snapshot):
+    """
+    Starts `serve_stats` in a daemon thread.
+    """
+    thread = threading.Thread(target=serve_stats, args=(port, snapshot), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,227 @@
+# replay.py
+import argparse
+import socket
+import struct
+import sys
+import time
+from itertools import groupby
+
+import client
+from capture import CHECKSUMMED, SENT, TCP, read_trace
+
+REPLAY_PORT = 30001  # Default UDP port a replayed stream is served on, the server's UDP port
+REPLAY_SPIN_THRESHOLD = 0.0002  # Waits for the next packet shorter than this are busy-waited instead of slept
+
+# ANSI Color Codes
+GREEN = '\033[92m'
+ERROR = '\033[91m'
+METRIC_COLOR = '\033[93m'
+RESET = '\033[0m'
+
+
+def header_size(record):
+    """
+    Returns the size of the payload header of a captured UDP datagram.
+    """
+    return client.VERIFIED_PACKET_STRUCT.size if record.flags & CHECKSUMMED else client.PAYLOAD_PACKET_HEADER_SIZE
+
+
+def split_streams(records):
+    """
+    Groups the records of a trace by stream, each stream's records in the order they were written.
+
+    Returns:
+        dict: Stream number to its list of records, in order of the streams' first record.
+    """
+    streams = {}
+    for record in records:
+        streams.setdefault(record.stream, []).append(record)
+    return streams
+
+
+def describe(records):
+    """
+    Returns the protocol and side of a captured stream, such as 'UDP received'.
+    """
+    flags = records[0].flags
+    return f"{'TCP' if flags & TCP else 'UDP'} {'sent' if flags & SENT else 'received'}"
+
+
+def print_summary(streams):
+    """
+    Prints the packets or calls, bytes, span and rate of every stream of a trace.
+    """
+    for stream, records in streams.items():
+        num_bytes = sum(record.size for record in records)
+        span = (records[-1].timestamp - records[0].timestamp) / 1e9
+        rate = f"{num_bytes / span / 1e6:.2f} MB/s" if span else "-"
+        unit = 'calls' if records[0].flags & TCP else 'datagrams'
+        print(f"{GREEN}[Replay]{RESET} Stream {stream} ({describe(records)}): "
+              f"{METRIC_COLOR}{len(records)}{RESET} {unit}, {METRIC_COLOR}{num_bytes / 1e6:.2f} MB{RESET} "
+              f"over {METRIC_COLOR}{span:.3f} s{RESET}, {METRIC_COLOR}{rate}{RESET}")
+
+
+def analyze_udp(stream, records):
+    """
+    Feeds the payload datagrams of a captured UDP stream through the receive analysis of `client.udp_download`.
+
+    Sent streams are analyzed the same way, so retransmissions of a reliable transfer show up as duplicates.
+    The duration of a stream is the span of its payload datagrams, so a stream of a single datagram has
+    no rate.
+
+    Returns:
+        dict: The `client.report_udp_download` results of the stream, or None if it holds no payload.
+    """
+    tracker = None
+    arrivals = client.ArrivalTimes()
+    data_size = first_payload = 0
+    for record in records:
+        if record.msg_type != client.PAYLOAD_TYPE:
+            continue
+        payload = record.size - header_size(record)
+        if tracker is None:
+            tracker = client.SegmentTracker(record.total)
+            first_payload = payload
+        if tracker.add(record.segment):
+            data_size += payload
+        arrivals.add(record.timestamp)
+    if tracker is None:
+        print(f"{GREEN}[Replay]{RESET} Stream {stream} ({describe(records)}): no payload datagrams")
+        return None
+    return client.report_udp_download(stream, tracker, arrivals, data_size, first_payload, arrivals.span)
+
+
+def analyze_tcp(stream, records):
+    """
+    Prints the throughput and the sizes of the send or receive calls of a captured TCP stream.
+    """
+    num_bytes = sum(record.size for record in records)
+    span = (records[-1].timestamp - records[0].timestamp) / 1e9
+    sizes = sorted(record.size for record in records)
+    gaps = [(later.timestamp - earlier.timestamp) / 1000 for earlier, later in zip(records, records[1:])]
+    rate = num_bytes / span / 1e6 if span else 0
+    print(f"{GREEN}[Replay]{RESET} Stream {stream} ({describe(records)}): "
+          f"{METRIC_COLOR}{rate:.2f} MB/s{RESET} over {METRIC_COLOR}{span:.3f} s{RESET}, "
+          f"{METRIC_COLOR}{len(records)}{RESET} calls of median {METRIC_COLOR}{client.percentile(sizes, 50)}{RESET} "
+          f"bytes, p99 gap between calls {METRIC_COLOR}{client.percentile(sorted(gaps), 99):.1f} µs{RESET}")
+
+
+def wait_until(deadline):
+    """
+    Waits until `time.perf_counter_ns()` reaches `deadline`, sleeping for long waits and spinning for short ones.
+    """
+    while True:
+        remaining = (deadline - time.perf_counter_ns()) / 1e9
+        if remaining <= 0:
+            return
+        if remaining > REPLAY_SPIN_THRESHOLD:
+            time.sleep(remaining - REPLAY_SPIN_THRESHOLD)
+
+
+def emit(s, records, addr, speed=1.0):
+    """
+    Sends the payload datagrams of a captured UDP stream to `addr`, with the gaps they were captured with
+    divided by `speed`.
+
+    Datagrams keep their captured size, segment numbers and message types. Their payload is zeros and their
+    header never carries a checksum, so the receiver must not verify them.
+
+    Returns:
+        int: The number of datagrams sent.
+    """
+    datagram = bytearray(max(record.size for record in records))
+    view = memoryview(datagram)
+    base = records[0].timestamp
+    start = time.perf_counter_ns()
+    sent = 0
+    for timestamp, batch in groupby(records, key=lambda record: record.timestamp):
+        wait_until(start + (timestamp - base) / speed)
+        for record in batch:
+            size = record.size - header_size(record) + client.PAYLOAD_PACKET_HEADER_SIZE
+            client.PAYLOAD_PACKET_STRUCT.pack_into(datagram, 0, client.MAGIC_COOKIE, record.msg_type, record.total,
+                                                   record.segment)
+            try:
+                s.sendto(view[:size], addr)
+                sent += 1
+            except BlockingIOError:
+                pass  # Dropped like a datagram lost on the way
+    return sent
+
+
+def serve(records, port, speed=1.0):
+    """
+    Answers every UDP download request on `port` by re-emitting a captured stream with its captured timing.
+
+    A stream captured by the server replays what it sent, one captured by the client replays what arrived,
+    losses and reordering included. Either way the receive path of the client sees the same packets at the
+    same pace on every run.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('', port))
+        print(f"{GREEN}[Replay]{RESET} Serving {METRIC_COLOR}{len(records)}{RESET} datagrams on UDP port "
+              f"{METRIC_COLOR}{port}{RESET}")
+        while True:
+            data, addr = s.recvfrom(client.RECV_BUFFER_SIZE)
+            try:
+                cookie, msg_type, _ = struct.unpack_from(client.REQUEST_PACKET_FORMAT, data)
+            except struct.error:
+                continue
+            if cookie != client.MAGIC_COOKIE or msg_type != client.REQUEST_TYPE:
+                continue
+            start = time.perf_counter()
+            sent = emit(s, records, addr, speed)
+            print(f"{GREEN}[Replay]{RESET} Replayed {METRIC_COLOR}{sent}{RESET} datagrams to {addr[0]}:{addr[1]} "
+                  f"in {METRIC_COLOR}{time.perf_counter() - start:.3f} s{RESET}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Inspect, analyze and replay traces recorded with --capture by the server or the client. "
+                    "Run under `python -m cProfile` to profile the client analysis on a fixed input.")
+    parser.add_argument('command', choices=('summary', 'analyze', 'serve'),
+                        help="'summary' lists the streams of the trace, 'analyze' runs the client's download analysis "
+                             "on them and 'serve' re-emits one UDP stream to every client that requests a download.")
+    parser.add_argument('trace', help="Trace file to read.")
+    parser.add_argument('--stream', type=int,
+                        help="Only this stream. 'serve' defaults to the first UDP stream of the trace.")
+    parser.add_argument('--port', type=int, default=REPLAY_PORT, help="'serve': UDP port to listen on.")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="'serve': replay this many times faster than captured.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        streams = split_streams(read_trace(args.trace))
+    except (OSError, ValueError) as e:
+        print(f"{ERROR}[Error]{RESET} Failed to read trace: {e}")
+        sys.exit(1)
+    if args.stream is not None:
+        if args.stream not in streams:
+            print(f"{ERROR}[Error]{RESET} No stream {args.stream} in {args.trace}")
+            sys.exit(1)
+        streams = {args.stream: streams[args.stream]}
+
+    if args.command == 'summary':
+        print_summary(streams)
+    elif args.command == 'analyze':
+        for stream, records in streams.items():
+            if records[0].flags & TCP:
+                analyze_tcp(stream, records)
+            else:
+                analyze_udp(stream, records)
+    else:
+        udp_streams = [records for records in streams.values() if not records[0].flags & TCP]
+        if not udp_streams:
+            print(f"{ERROR}[Error]{RESET} No UDP stream to replay in {args.trace}")
+            sys.exit(1)
+        try:
+            serve(udp_streams[0], args.port, args.speed)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,33 @@
 # server.py
+import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import functools
+import ipaddress
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import select
+import selectors
 import socket
+import sys
+import tempfile
 import threading
 import struct
 import time
+import zlib
+from collections import deque
 
 import netifaces
 
+from capture import CHECKSUMMED, SENT, TCP, open_trace
+from logs import LOG_LEVELS, setup_logging
+from metrics import MetricsRegistry, PhaseTimer, start_stats_endpoint
+
 #import netifaces
 # import tqdm
 # from tqdm import tqdm
@@ -15,15 +37,52 @@ MAGIC_COOKIE = 0xabcddcba
 OFFER_TYPE = 0x2
 REQUEST_TYPE = 0x3
 PAYLOAD_TYPE = 0x4
+NACK_TYPE = 0x5
+REJECT_TYPE = 0x6
+PROBE_TYPE = 0x7
+SESSION_TYPE = 0x8
+SESSION_REQUEST_TYPE = 0x9
+SESSION_RESPONSE_TYPE = 0xa
 UDP_PORT = 30001
 OFFER_PORT = 30003
 TCP_PORT = 30002
 BUFFER_SIZE = 1024
 RECV_BUFFER_SIZE = 1024  # Standard buffer size for receiving data
-# ANSI Color Codes
-GREEN = '\033[92m'
-ERROR = '\033[91m'
-RESET = '\033[0m'
+PAYLOAD_BLOCK_SIZE = 1024 * 1024  # Size of the shared payload block every transfer is served from
+PAYLOAD_SEED = 0x5eed  # Seed of the pseudo-random payload block, the same on every host
+TCP_CHECKSUM_BLOCK = 256 * 1024  # Payload bytes covered by each checksum of a verified TCP transfer
+PAYLOAD_MIRROR_SIZE = TCP_CHECKSUM_BLOCK  # Start of the block repeated after its end, so any datagram or checksum block is contiguous
+UDP_DATAGRAM_SIZE = BUFFER_SIZE  # Default UDP datagram size, header included
+MAX_DATAGRAM_SIZE = 65507  # Largest UDP payload that fits in an IPv4 packet
+IP_UDP_HEADER_SIZE = 28  # IPv4 + UDP header bytes subtracted from the path MTU
+IP_MTU = getattr(socket, 'IP_MTU', 14)  # Linux socket option exposing the path MTU of a connected socket
+UDP_SEND_BATCH = 64  # Number of datagrams handed to the kernel per send call
+STATS_INTERVAL = 5  # Seconds between worker stats reports to the parent process
+STATS_PORT = 30004  # Local port serving the server metrics as JSON
+PACING_QUANTUM = 0.001  # Seconds of traffic a paced transfer sends per batch
+PACING_BURST = 0.005  # Seconds of traffic a token bucket may accumulate while idle
+PACING_SPIN_THRESHOLD = 0.0002  # Pacing delays shorter than this are busy-waited instead of slept
+NACK_INTERVAL = 0.02  # Seconds between progress reports sent by a reliable UDP client
+RELIABLE_WINDOW = 4096  # Most segments a reliable transfer sends past the client's first missing segment
+RELIABLE_INITIAL_RATE = 12_500_000  # Starting rate of an unlimited reliable transfer, in bytes per second
+RELIABLE_MIN_RATE = 125_000  # Reliable transfers never back off below this rate, in bytes per second
+RELIABLE_RATE_STEP = 1_250_000  # Rate added after every report without new losses, in bytes per second
+RELIABLE_BACKOFF = 0.7  # Factor the rate is multiplied by when new losses are reported
+RELIABLE_BACKOFF_INTERVAL = 0.1  # Seconds between two rate backoffs
+RETRANSMIT_HOLDOFF = 0.05  # Seconds before a segment that was just sent may be sent again
+RELIABLE_TIMEOUT = 5  # Seconds without a report before a reliable transfer is abandoned
+MAX_FILE_SIZE = 10_000_000_000  # Default largest file a client may request, in bytes
+MAX_TRANSFERS = 128  # Default number of transfers served at once by a process
+QUEUE_DEPTH = 512  # Default number of admitted transfers waiting for a free worker
+PER_IP_TRANSFERS = 64  # Default most active and queued transfers of one client IP
+REJECT_RETRY_AFTER = 0.5  # Seconds a rejected client is asked to wait before retrying
+OFFER_INTERVAL = 1  # Seconds between two rounds of offers
+INTERFACE_REFRESH_INTERVAL = 10  # Default seconds between rereading the network interfaces
+LOOPBACK_BROADCAST = '127.255.255.255'  # Offered on when the host has no other IPv4 interface
+OFFER_MULTICAST_GROUP = '239.255.117.3'  # Default administratively scoped group for multicast offers
+OFFER_MULTICAST_TTL = 1  # Multicast offers stay on the local network
+REQUEST_TIMEOUT = 10  # Seconds a new TCP connection has to send a complete request before it is closed
+READER_POLL_INTERVAL = 1  # Seconds between checks of the request reader for connections past REQUEST_TIMEOUT
 
 # Packet Format Constants
 OFFER_PACKET_FORMAT = '!IbHH'
@@ -32,83 +91,1014 @@ OFFER_PACKET_SIZE = struct.calcsize(OFFER_PACKET_FORMAT)
 REQUEST_PACKET_FORMAT = '!IbQ'
 REQUEST_PACKET_SIZE = struct.calcsize(REQUEST_PACKET_FORMAT)
 
+REQUEST_OPTIONS_FORMAT = '!QB'  # Optional requested rate in bytes per second and flags, appended to a request packet
+REQUEST_RATE_SIZE = struct.calcsize('!Q')
+REQUEST_OPTIONS_SIZE = struct.calcsize(REQUEST_OPTIONS_FORMAT)
+RELIABLE_FLAG = 0x1  # Request flag asking for a reliable transfer
+VERIFY_FLAG = 0x2  # Request flag asking for checksummed segments, followed by the content seed
+REQUEST_SEED_FORMAT = '!I'
+REQUEST_SEED_SIZE = struct.calcsize(REQUEST_SEED_FORMAT)
+
+NACK_PACKET_FORMAT = '!IbQQ'  # Followed by a bitmap of the missing segments from the base segment on
+NACK_PACKET_SIZE = struct.calcsize(NACK_PACKET_FORMAT)
+
+REJECT_PACKET_FORMAT = '!IbBI'  # Reason and the milliseconds the client should wait before retrying, 0 for never
+REJECT_PACKET_SIZE = struct.calcsize(REJECT_PACKET_FORMAT)
+REJECT_BUSY = 0x1  # Every worker is busy and the queue is full
+REJECT_QUOTA = 0x2  # The client IP is over its concurrency or byte quota
+REJECT_TOO_LARGE = 0x3  # The requested file is larger than the server allows
+REJECT_REASONS = {REJECT_BUSY: 'server busy', REJECT_QUOTA: 'client over quota', REJECT_TOO_LARGE: 'file too large'}
+
+PROBE_PACKET_FORMAT = '!IbQ'  # Token echoed back in the reply
+PROBE_PACKET_SIZE = struct.calcsize(PROBE_PACKET_FORMAT)
+PROBE_REPLY_FORMAT = '!IbQII'  # Echoed token, admitted transfers and the most transfers admitted at once
+
+SESSION_HELLO = struct.pack('!Ib', MAGIC_COOKIE, SESSION_TYPE)  # Opens a persistent session, in place of a request line
+SESSION_REQUEST_STRUCT = struct.Struct('!IbIQQQBI')  # Request id, file size, offset, length, flags and content seed
+# Request id, reject reason or 0, milliseconds to wait before retrying and the payload bytes that follow
+SESSION_RESPONSE_STRUCT = struct.Struct('!IbIBIQ')
+
 PAYLOAD_PACKET_FORMAT = '!IbQQ'
 PAYLOAD_PACKET_HEADER_SIZE = struct.calcsize(PAYLOAD_PACKET_FORMAT)
+PAYLOAD_PACKET_STRUCT = struct.Struct(PAYLOAD_PACKET_FORMAT)
+VERIFIED_PACKET_STRUCT = struct.Struct('!IbQQI')  # Payload header followed by the CRC32 of the segment
+CHECKSUM_STRUCT = struct.Struct('!I')  # CRC32 sent after every block of a verified TCP transfer
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
 
-CONTENT_DEBUG = False
+log = logging.getLogger('server')
 
-def get_broadcast_address():
-    server_ip = ""
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        try:
-            s.connect(("8.8.8.8", 80))  # Use an external address to determine the outbound interface
-            server_ip = s.getsockname()[0]  # PC IP that was used in the connection
-        except:
-            server_ip = "127.0.0.1"  # Local host address in case we couldn't connect or don't have an IP
-
-    if str(server_ip) == "127.0.0.1":  # In case server IP retrieval failed
-        return "127.255.255.255"
-    for interface in netifaces.interfaces():  # Go through the network interfaces of the device and check which one has our IP
-        addrs = netifaces.ifaddresses(interface)
-        if netifaces.AF_INET in addrs:  # Check if the interface has an IPv4 address assigned
-            ipv4_info = addrs[netifaces.AF_INET][0]
-            if str(ipv4_info['addr']) == str(
-                    server_ip):  # Check if the interface IP matches our own in case of multiple active interfaces
-                return str(ipv4_info['broadcast'])
-
-def send_offers():
-    """
-    Broadcasts offer packets over UDP to potential clients.
-
-    The function continuously sends offer messages to the network's broadcast address
-    until either a maximum number of consecutive errors (`MAX_ERROR_COUNT`) is reached
-    or the server is manually stopped. The offer message includes essential connection
-    details packed according to `OFFER_PACKET_FORMAT`.
-
-    Error Handling:
-    - Handles errors in retrieving the broadcast address.
-    - Handles errors during offer message packing.
-    - Handles socket creation and configuration errors.
-    - Handles errors during packet transmission.
+_payload_block = None
+_payload_block_lock = threading.Lock()
+
+
+class ServerStats:
+    """
+    Thread-safe counters of the transfers served by this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {'tcp_transfers': 0, 'udp_transfers': 0, 'bytes_sent': 0, 'errors': 0, 'rejected': 0}
+
+    def record_transfer(self, protocol, num_bytes):
+        with self._lock:
+            self._counters[f'{protocol}_transfers'] += 1
+            self._counters['bytes_sent'] += num_bytes
+
+    def record_error(self):
+        with self._lock:
+            self._counters['errors'] += 1
+
+    def record_rejection(self):
+        with self._lock:
+            self._counters['rejected'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+server_stats = ServerStats()
+server_metrics = MetricsRegistry()
+tcp_meter = server_metrics.meter('tcp')
+udp_meter = server_metrics.meter('udp')
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to pace UDP transfers.
+
+    Senders reserve tokens before sending and are told how long to wait, so the same bucket works for
+    blocking threads and for event-loop tasks. Reservations may drive the bucket into debt, which
+    later senders wait out.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Parameters:
+        rate (float): The refill rate in bytes per second.
+        burst (float): The most tokens the bucket holds, defaults to `PACING_BURST` seconds of traffic.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * PACING_BURST
+        self.tokens = self.burst
+        self.timestamp = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes `amount` tokens from the bucket.
+
+        Returns:
+        float: The number of seconds to wait before sending `amount` bytes.
+        """
+        with self._lock:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+server_bucket = None  # Server-wide token bucket shared by every UDP transfer of this process
+server_capture = None  # Trace every payload packet and TCP send of this process is recorded to, if any
+
+
+class AdmissionController:
+    """
+    Decides which transfer requests a process takes on, so bursts queue up to a bound and are then
+    turned away instead of piling up threads.
+
+    A request is admitted while fewer than `max_transfers + queue_depth` transfers are active or
+    queued, its file is at most `max_file_size` bytes and its source IP stays within its concurrency
+    and byte quotas. An admitted transfer holds its place until `release` is called.
+    """
+
+    def __init__(self, max_transfers=MAX_TRANSFERS, queue_depth=QUEUE_DEPTH, max_file_size=MAX_FILE_SIZE,
+                 per_ip_transfers=PER_IP_TRANSFERS, per_ip_bytes=0):
+        """
+        Parameters:
+        max_transfers (int): The number of transfers served at once.
+        queue_depth (int): The number of admitted transfers that may wait for a worker.
+        max_file_size (int): The largest file a client may request, in bytes.
+        per_ip_transfers (int): The most active and queued transfers of one IP, or 0 for no limit.
+        per_ip_bytes (int): The most bytes one IP may have left to receive over its admitted
+            transfers, or 0 for no limit.
+        """
+        self.max_pending = max_transfers + queue_depth
+        self.max_file_size = max_file_size
+        self.per_ip_transfers = per_ip_transfers
+        self.per_ip_bytes = per_ip_bytes
+        self.pending = 0
+        self._clients = {}  # IP to [admitted transfers, admitted bytes]
+        self._lock = threading.Lock()
+
+    def admit(self, ip, num_bytes):
+        """
+        Admits a transfer of `num_bytes` to `ip` if the limits allow it.
+
+        Returns:
+        int: 0 if the transfer was admitted, otherwise the `REJECT_*` reason.
+        """
+        if num_bytes > self.max_file_size:
+            return REJECT_TOO_LARGE
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return REJECT_BUSY
+            transfers, admitted_bytes = self._clients.get(ip, (0, 0))
+            if ((self.per_ip_transfers and transfers >= self.per_ip_transfers)
+                    or (self.per_ip_bytes and admitted_bytes + num_bytes > self.per_ip_bytes)):
+                return REJECT_QUOTA
+            self.pending += 1
+            self._clients[ip] = [transfers + 1, admitted_bytes + num_bytes]
+            return 0
+
+    def release(self, ip, num_bytes):
+        with self._lock:
+            self.pending -= 1
+            client = self._clients[ip]
+            client[0] -= 1
+            client[1] -= num_bytes
+            if not client[0]:
+                del self._clients[ip]
+
+
+server_admission = AdmissionController()
+
+
+def retry_after_ms(reason):
+    """
+    Returns the milliseconds a refused client is asked to wait. Requests refused for their size should not be retried.
+    """
+    return 0 if reason == REJECT_TOO_LARGE else int(REJECT_RETRY_AFTER * 1000)
+
+
+def build_reject(reason):
+    """
+    Packs the reject packet sent for a refused request.
+    """
+    return struct.pack(REJECT_PACKET_FORMAT, MAGIC_COOKIE, REJECT_TYPE, reason, retry_after_ms(reason))
+
+
+def build_session_response(request_id, reason=0, length=0):
+    """
+    Packs the header sent on a session ahead of the payload of a request, or in its place when it was refused.
+    """
+    retry_after = retry_after_ms(reason) if reason else 0
+    return SESSION_RESPONSE_STRUCT.pack(MAGIC_COOKIE, SESSION_RESPONSE_TYPE, request_id, reason, retry_after, length)
+
+
+class TransferPool:
+    """
+    A fixed set of worker threads serving transfers from a bounded queue.
+    """
+
+    def __init__(self, workers=MAX_TRANSFERS, queue_depth=QUEUE_DEPTH):
+        self._queue = queue.Queue(workers + queue_depth)  # Admission control keeps it from filling up
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            handler, args = self._queue.get()
+            try:
+                handler(*args)
+            except Exception as e:
+                log.error("Unexpected error in transfer worker: %s", e)
+
+    def submit(self, handler, *args):
+        """
+        Queues `handler(*args)` for the next free worker.
+
+        Raises:
+        queue.Full: If the queue is full.
+        """
+        self._queue.put_nowait((handler, args))
+
+
+def record_rejection(protocol, addr, reason):
+    server_stats.record_rejection()
+    log.warning("Rejected %s request from %s: %s", protocol, addr, REJECT_REASONS[reason],
+                extra={'peer': addr, 'reason': REJECT_REASONS[reason]})
+
+
+def run_admitted(addr, num_bytes, handler, *args):
+    """
+    Runs an admitted transfer and releases its admission once it is over.
     """
-    error_count = 0
     try:
-        broadcast_addr = get_broadcast_address()
-    except Exception as e:
-        print(f"{ERROR}Failed to get broadcast address: {e}{RESET}")
+        handler(*args)
+    finally:
+        server_admission.release(addr[0], num_bytes)
+
+
+async def async_run_admitted(addr, num_bytes, slots, transfer):
+    """
+    Event-loop version of `run_admitted`. Waits for one of the `slots` before running the `transfer` coroutine.
+    """
+    try:
+        async with slots:
+            await transfer
+    finally:
+        server_admission.release(addr[0], num_bytes)
+
+
+class Pacer:
+    """
+    Paces one UDP transfer against its own rate and the server-wide rate.
+    """
+
+    def __init__(self, rate, datagram_size):
+        """
+        Parameters:
+        rate (int): The transfer rate in bytes per second, or 0 for no per-transfer limit.
+        datagram_size (int): The size of the datagrams being paced.
+        """
+        self.datagram_size = datagram_size
+        self.transfer_bucket = TokenBucket(rate) if rate else None
+        self._update_buckets()
+
+    def _update_buckets(self):
+        self.buckets = [bucket for bucket in (self.transfer_bucket, server_bucket) if bucket]
+        if self.buckets:
+            slowest = min(bucket.rate for bucket in self.buckets)
+            self.batch_size = max(1, min(UDP_SEND_BATCH, int(slowest * PACING_QUANTUM / self.datagram_size)))
+        else:
+            self.batch_size = UDP_SEND_BATCH
+
+    def set_rate(self, rate):
+        """
+        Changes the per-transfer rate, in bytes per second.
+        """
+        if self.transfer_bucket is None:
+            self.transfer_bucket = TokenBucket(rate)
+        else:
+            self.transfer_bucket.rate = rate
+            self.transfer_bucket.burst = rate * PACING_BURST
+        self._update_buckets()
+
+    def reserve(self, num_datagrams):
+        """
+        Reserves room for a batch of datagrams in every bucket.
+
+        Returns:
+        float: The number of seconds to wait before sending the batch.
+        """
+        num_bytes = num_datagrams * self.datagram_size
+        return max((bucket.reserve(num_bytes) for bucket in self.buckets), default=0.0)
+
+
+def pace_sleep(delay):
+    """
+    Sleeps for `delay` seconds with sub-millisecond precision.
+
+    The bulk of the delay is slept, and the last `PACING_SPIN_THRESHOLD` seconds are busy-waited so that
+    the oversleep of `time.sleep` does not eat into the paced rate.
+    """
+    if delay <= 0:
         return
+    deadline = time.perf_counter() + delay
+    if delay > PACING_SPIN_THRESHOLD:
+        time.sleep(delay - PACING_SPIN_THRESHOLD)
+    while time.perf_counter() < deadline:
+        pass
+
+
+def effective_rate(requested_rate, rate_cap):
+    """
+    Returns the rate a transfer runs at, given the rate the client asked for and the server's cap.
+    Either value may be 0 for no limit.
+    """
+    rates = [rate for rate in (requested_rate, rate_cap) if rate > 0]
+    return min(rates) if rates else 0
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """
+    Looks up `sendmmsg` in the C library.
+
+    Returns:
+        The ctypes function, or None when the platform does not provide it.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def discover_interfaces():
+    """
+    Reads the IPv4 addresses of every interface from the host, without any network traffic.
+
+    Interfaces without a broadcast address, such as point-to-point links, are skipped unless the
+    broadcast address can be derived from their netmask. When no interface qualifies, for example on
+    a host with only a loopback interface, offers go to the loopback broadcast address so local
+    clients can still find the server.
+
+    Returns:
+    dict: (interface name, interface address) to broadcast address.
+    """
+    interfaces = {}
+    for interface in netifaces.interfaces():
+        try:
+            entries = netifaces.ifaddresses(interface).get(netifaces.AF_INET, [])
+        except ValueError:  # The interface went away while being listed
+            continue
+        for entry in entries:
+            address, broadcast = entry.get('addr'), entry.get('broadcast')
+            if not address or ipaddress.IPv4Address(address).is_loopback:
+                continue
+            if not broadcast and entry.get('netmask') and 'peer' not in entry:
+                broadcast = str(ipaddress.IPv4Network(f"{address}/{entry['netmask']}", strict=False).broadcast_address)
+            if broadcast:
+                interfaces[(interface, address)] = broadcast
+    return interfaces or {('lo', '127.0.0.1'): LOOPBACK_BROADCAST}
+
+
+class InterfaceCache:
+    """
+    Cached map of the host's interfaces to their broadcast addresses, refreshed by a background thread.
+
+    Readers never wait for the interfaces to be read, they get the map of the last refresh, which is
+    empty until the first refresh completes. Changes between two refreshes are logged.
+    """
+
+    def __init__(self, refresh_interval=INTERFACE_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.ready = threading.Event()
+        self._interfaces = {}
+
+    def refresh(self):
+        try:
+            interfaces = discover_interfaces()
+        except Exception as e:
+            log.error("Failed to read network interfaces: %s", e)
+            self.ready.set()  # Senders go on with the interfaces of the last refresh
+            return
+        previous = self._interfaces
+        for (interface, address), broadcast in interfaces.items():
+            if previous.get((interface, address)) != broadcast:
+                log.info("Offering on %s (%s) to %s", interface, address, broadcast)
+        for interface, address in previous.keys() - interfaces.keys():
+            log.info("Stopped offering on %s (%s)", interface, address)
+        self._interfaces = interfaces  # Replaced whole, so readers never see a partial update
+        self.ready.set()
+
+    def run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_interval)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def snapshot(self):
+        return self._interfaces
+
+
+def offer_destinations(interfaces, multicast_group=None):
+    """
+    Lists where one round of offers is sent: the broadcast address of every interface, and the multicast
+    group out of every interface when one is given.
+
+    Returns:
+    list: (interface address for IP_MULTICAST_IF or None, destination address) pairs.
+    """
+    destinations = [(None, broadcast) for broadcast in sorted(set(interfaces.values()))]
+    if multicast_group:
+        destinations += [(address, multicast_group) for _, address in sorted(interfaces)]
+    return destinations
 
+
+def send_offer_round(s, offer_message, destinations):
+    """
+    Sends the offer to every destination. A failing interface does not keep the others from being offered on.
+
+    Returns:
+    int: The number of offers sent.
+    """
+    sent = 0
+    for interface_address, destination in destinations:
+        try:
+            if interface_address:
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_address))
+            s.sendto(offer_message, (destination, OFFER_PORT))
+            sent += 1
+        except BlockingIOError:
+            pass  # The send buffer is full, the next round will offer again
+        except OSError as e:
+            log.warning("Failed to send offer to %s: %s", destination, e)
+    return sent
+
+
+def open_offer_socket(multicast_group=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if multicast_group:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, OFFER_MULTICAST_TTL)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+
+def send_offers(interface_cache=None, multicast_group=None):
+    """
+    Broadcasts offer packets over UDP to potential clients on every interface.
+
+    Every `OFFER_INTERVAL` seconds the offer is sent to the broadcast address of each interface in
+    `interface_cache`, and to `multicast_group` out of each interface when one is given. The interfaces
+    are read in the background, so offers start as soon as the first read completes and follow
+    interfaces coming and going. Sending stops after `MAX_ERROR_COUNT` consecutive rounds in which no
+    offer could be sent.
+
+    Parameters:
+    interface_cache (InterfaceCache): The interfaces to offer on, started here when not given.
+    multicast_group (str): Multicast group the offers are also sent to, or None.
+    """
+    interface_cache = interface_cache or InterfaceCache().start()
+    error_count = 0
     try:
         offer_message = struct.pack(OFFER_PACKET_FORMAT, MAGIC_COOKIE, OFFER_TYPE, UDP_PORT, TCP_PORT)
     except struct.error as e:
-        print(f"{ERROR}Error packing offer message: {e}{RESET}")
+        log.error("Error packing offer message: %s", e)
         return
 
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as s:
-            try:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            except socket.error as e:
-                print(f"{ERROR}[Error] Failed to set socket options: {e}{RESET}")
-                return
-
+        with open_offer_socket(multicast_group) as s:
+            interface_cache.ready.wait()
             while error_count < MAX_ERROR_COUNT:
-                try:
-                    s.sendto(offer_message, (broadcast_addr, OFFER_PORT))
-                    print(f"{GREEN}[Server] Offer sent.{RESET}")
-                    time.sleep(1)
-                except socket.error as e:
-                    error_count += 1
-                    print(f"{ERROR}[Error] server sending offer: {e}{RESET}")
-                except Exception as e:
+                destinations = offer_destinations(interface_cache.snapshot(), multicast_group)
+                sent = send_offer_round(s, offer_message, destinations)
+                if sent:
+                    error_count = 0
+                    log.info("Offer sent on %d of %d destinations.", sent, len(destinations))
+                else:
                     error_count += 1
-                    print(f"{ERROR}[Error] Server Unexpected error: {e}{RESET}")
-            print(f"{ERROR}[Error] Server Offer sending stopped after {error_count} errors.{RESET}")
+                time.sleep(OFFER_INTERVAL)
+            log.error("Server Offer sending stopped after %d rounds without an offer sent.", error_count)
     except socket.error as e:
-        print(f"{ERROR}[Error] Socket creation failed: {e}{RESET}")
+        log.error("Socket creation failed: %s", e)
+
+
+def get_payload_block():
+    """
+    Returns the shared payload block, creating it on first use.
+
+    The block is a file-backed memory map of `PAYLOAD_BLOCK_SIZE` pseudo-random bytes generated from
+    `PAYLOAD_SEED`, followed by a copy of its first `PAYLOAD_MIRROR_SIZE` bytes. A file is the block
+    repeated from a position set by the request's content seed, so its content is known on every host,
+    cannot be compressed on the way, and a datagram or checksum block starting anywhere in the block is
+    one contiguous slice. The block is allocated once per process and reused by every transfer, so memory
+    use stays constant regardless of the requested file size or the number of connected clients.
+
+    Returns:
+        tuple: The backing file object and a memoryview over the mapped block.
+    """
+    global _payload_block
+    with _payload_block_lock:
+        if _payload_block is None:
+            block = random.Random(PAYLOAD_SEED).randbytes(PAYLOAD_BLOCK_SIZE)
+            payload_file = tempfile.TemporaryFile()
+            payload_file.write(block + block[:PAYLOAD_MIRROR_SIZE])
+            payload_file.flush()
+            payload_map = mmap.mmap(payload_file.fileno(), PAYLOAD_BLOCK_SIZE + PAYLOAD_MIRROR_SIZE)
+            _payload_block = (payload_file, memoryview(payload_map))
+        return _payload_block
+
+
+@functools.lru_cache(maxsize=1024)
+def block_checksum(position, length):
+    """
+    Returns the CRC32 of `length` payload bytes from `position` in the payload block.
+
+    A verified TCP transfer only ever starts blocks at a few positions of the payload block, so their
+    checksums are computed once and then served from the cache.
+    """
+    _, payload_view = get_payload_block()
+    return zlib.crc32(payload_view[position:position + length])
+
+
+def send_tcp_payload(conn, file_size, timer=None, offset=0, seed=None):
+    """
+    Streams `file_size` payload bytes over a connected TCP socket.
+
+    The payload is sent in chunks of the shared payload block. Where `os.sendfile` is available the
+    kernel copies straight from the block's backing file to the socket, otherwise the mapped block is
+    passed to `sendall` without building an intermediate buffer. A verified transfer is sent in blocks
+    of `TCP_CHECKSUM_BLOCK` bytes, each followed by its CRC32.
+
+    Parameters:
+    conn (socket.socket): The connected client socket.
+    file_size (int): The number of bytes to send.
+    timer (PhaseTimer): Marks 'first_byte' as the first chunk starts going out, if given.
+    offset (int): The position in the file of the first byte sent. The file is the payload block
+        repeated, so a range starts at `(seed + offset) % PAYLOAD_BLOCK_SIZE` in the block.
+    seed (int): The content seed of a verified transfer, or None to send the payload without checksums.
+
+    Raises:
+    ConnectionError: If the peer closes the connection before all bytes were sent.
+    """
+    payload_file, payload_view = get_payload_block()
+    capture = server_capture
+    stream = capture.new_stream() if capture is not None else 0
+    remaining = file_size
+    position = ((seed or 0) + offset) % PAYLOAD_BLOCK_SIZE
+    block_start = block_length = block_left = 0
+    while remaining > 0:
+        if seed is not None and not block_left:
+            block_start, block_length = position, min(remaining, TCP_CHECKSUM_BLOCK)
+            block_left = block_length
+        chunk = block_left if seed is not None else min(remaining, PAYLOAD_BLOCK_SIZE - position)
+        if timer is not None:
+            timer.mark('first_byte')
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(conn.fileno(), payload_file.fileno(), position, chunk)
+            if sent == 0:
+                raise ConnectionError("Connection closed by peer.")
+        else:
+            conn.sendall(payload_view[position:position + chunk])
+            sent = chunk
+        if capture is not None:
+            capture.record(stream, PAYLOAD_TYPE, SENT | TCP, offset + file_size - remaining, offset + file_size, sent)
+        tcp_meter.add(sent)
+        remaining -= sent
+        position = (position + sent) % PAYLOAD_BLOCK_SIZE
+        if seed is not None:
+            block_left -= sent
+            if not block_left:
+                conn.sendall(CHECKSUM_STRUCT.pack(block_checksum(block_start, block_length)), MSG_MORE if remaining else 0)
+
+
+def resolve_datagram_size(sock, datagram_size):
+    """
+    Resolves the datagram size used for a UDP transfer.
+
+    Parameters:
+    sock (socket.socket): The UDP socket, already connected to the client.
+    datagram_size (int): The requested datagram size in bytes, header included, or 0 for the path MTU.
+
+    Returns:
+    int: The datagram size, capped at `MAX_DATAGRAM_SIZE`.
+    """
+    if datagram_size <= 0:
+        try:
+            datagram_size = sock.getsockopt(socket.IPPROTO_IP, IP_MTU) - IP_UDP_HEADER_SIZE
+        except socket.error:
+            datagram_size = UDP_DATAGRAM_SIZE
+    return min(datagram_size, MAX_DATAGRAM_SIZE)
+
+
+class UDPSegmentSender:
+    """
+    Sends the segments of one UDP transfer in batches without per-datagram allocations.
+
+    Headers are packed with `struct.pack_into` into one reusable buffer and every datagram points at
+    its position in the shared payload block, so a datagram is a (header, payload) scatter-gather pair.
+    Batches go out with a single `sendmmsg` call where the C library provides it, and with one `sendmsg`
+    per datagram otherwise. The headers of a verified transfer carry the CRC32 of their segment.
+    """
+
+    def __init__(self, sock, file_size, datagram_size=UDP_DATAGRAM_SIZE, batch_size=UDP_SEND_BATCH, timer=None,
+                 seed=None):
+        """
+        Parameters:
+        sock (socket.socket): A UDP socket connected to the client.
+        file_size (int): The total number of payload bytes to send.
+        datagram_size (int): The datagram size in bytes, header included.
+        batch_size (int): The maximum number of datagrams per send call.
+        timer (PhaseTimer): Marks 'first_byte' once the first datagram is sent, if given.
+        seed (int): The content seed of a verified transfer, or None to send segments without checksums.
+
+        Raises:
+        ValueError: If the datagram size leaves no room for payload.
+        """
+        self.sock = sock
+        self.datagram_size = datagram_size
+        self.verify = seed is not None
+        self.header_struct = VERIFIED_PACKET_STRUCT if self.verify else PAYLOAD_PACKET_STRUCT
+        self.header_size = self.header_struct.size
+        self.data_size = datagram_size - self.header_size
+        if self.data_size <= 0:
+            raise ValueError("Datagram size must be greater than the payload header size.")
+        self.seed = seed or 0
+        self.file_size = file_size
+        self.total_segments = -(-file_size // self.data_size)
+        self.batch_size = batch_size
+        self.next_segment = 0
+        self.timer = timer
+        self.capture = server_capture
+        self.stream = self.capture.new_stream() if self.capture is not None else 0
+        self.capture_flags = SENT | (CHECKSUMMED if self.verify else 0)
+
+        self.headers = bytearray(batch_size * self.header_size)
+        self.header_view = memoryview(self.headers)
+        _, self.payload_view = get_payload_block()
+
+        self._msgs = None
+        if _sendmmsg is not None:
+            self._header_buffer = ctypes.c_char.from_buffer(self.headers)
+            self._payload_buffer = ctypes.c_char.from_buffer(self.payload_view)
+            header_base = ctypes.addressof(self._header_buffer)
+            self._payload_base = ctypes.addressof(self._payload_buffer)
+            self._iovs = (_IOVec * (2 * batch_size))()
+            self._msgs = (_MMsgHdr * batch_size)()
+            for i in range(batch_size):
+                self._iovs[2 * i].iov_base = header_base + i * self.header_size
+                self._iovs[2 * i].iov_len = self.header_size
+                self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[2 * i])
+                self._msgs[i].msg_hdr.msg_iovlen = 2
+
+    @property
+    def done(self):
+        return self.next_segment >= self.total_segments
+
+    @property
+    def remaining(self):
+        return self.total_segments - self.next_segment
+
+    def segment_size(self, segment):
+        """
+        Returns the number of payload bytes carried by a segment.
+        """
+        if segment == self.total_segments - 1:
+            return self.file_size - segment * self.data_size
+        return self.data_size
 
+    def segment_position(self, segment):
+        """
+        Returns where the payload of a segment starts in the payload block.
+        """
+        return (self.seed + segment * self.data_size) % PAYLOAD_BLOCK_SIZE
 
-def handle_tcp_client(conn, addr, file_size):
+    def send_segments(self, segments):
+        """
+        Sends up to `batch_size` segments in one batch.
+
+        Parameters:
+        segments (Sequence[int]): The segment numbers to send.
+
+        Returns:
+        int: The number of datagrams accepted by the kernel, counted from the start of `segments`.
+
+        Raises:
+        BlockingIOError: If the socket is non-blocking and nothing could be sent.
+        OSError: If sending fails.
+        """
+        count = min(len(segments), self.batch_size)
+        positions = [self.segment_position(segment) for segment in segments[:count]]
+        if self.verify:
+            for i in range(count):
+                position = positions[i]
+                checksum = zlib.crc32(self.payload_view[position:position + self.segment_size(segments[i])])
+                VERIFIED_PACKET_STRUCT.pack_into(self.headers, i * self.header_size, MAGIC_COOKIE, PAYLOAD_TYPE,
+                                                 self.total_segments, segments[i], checksum)
+        else:
+            for i in range(count):
+                PAYLOAD_PACKET_STRUCT.pack_into(self.headers, i * PAYLOAD_PACKET_HEADER_SIZE,
+                                                MAGIC_COOKIE, PAYLOAD_TYPE, self.total_segments, segments[i])
+
+        if self._msgs is not None:
+            for i in range(count):
+                self._iovs[2 * i + 1].iov_base = self._payload_base + positions[i]
+                self._iovs[2 * i + 1].iov_len = self.segment_size(segments[i])
+            sent = _sendmmsg(self.sock.fileno(), self._msgs, count, 0)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return self._record_sent(segments, sent)
+
+        sent = 0
+        try:
+            for i in range(count):
+                offset = i * self.header_size
+                self.sock.sendmsg([self.header_view[offset:offset + self.header_size],
+                                   self.payload_view[positions[i]:positions[i] + self.segment_size(segments[i])]])
+                sent += 1
+        except BlockingIOError:
+            if sent == 0:
+                raise
+        return self._record_sent(segments, sent)
+
+    def _record_sent(self, segments, sent):
+        """
+        Counts sent datagrams in the UDP throughput meter, marks the first byte of the transfer and
+        records the datagrams in the capture trace.
+        """
+        if sent:
+            if self.timer is not None:
+                self.timer.mark('first_byte')
+            num_bytes = sent * self.data_size
+            last = self.total_segments - 1
+            if last in segments[:sent]:  # Only the last segment of the file is short
+                num_bytes -= self.data_size - self.segment_size(last)
+            udp_meter.add(num_bytes)
+            if self.capture is not None:
+                sizes = [self.header_size + self.segment_size(segment) for segment in segments[:sent]]
+                self.capture.record_batch(self.stream, PAYLOAD_TYPE, self.capture_flags, segments[:sent],
+                                          self.total_segments, sizes)
+        return sent
+
+    def send_next_batch(self, limit=None):
+        """
+        Sends the next batch of segments in order.
+
+        Parameters:
+        limit (int): The most datagrams to send, defaults to `batch_size`.
+
+        Returns:
+        int: The number of datagrams sent.
+        """
+        end = min(self.next_segment + min(limit or self.batch_size, self.batch_size), self.total_segments)
+        sent = self.send_segments(range(self.next_segment, end))
+        self.next_segment += sent
+        return sent
+
+
+def parse_nack(data):
+    """
+    Parses a NACK packet sent by a reliable UDP client.
+
+    Parameters:
+    data (bytes): The received datagram.
+
+    Returns:
+    tuple: The base segment, below which every segment has arrived, the segment after the highest one
+        received, and a generator of the missing segment numbers flagged in the bitmap.
+
+    Raises:
+    ValueError: If the packet is not a NACK packet.
+    """
+    if len(data) < NACK_PACKET_SIZE:
+        raise ValueError("NACK packet too small")
+    magic_cookie, msg_type, base, frontier = struct.unpack_from(NACK_PACKET_FORMAT, data)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, NACK_TYPE):
+        raise ValueError("Invalid NACK packet")
+    bitmap = data[NACK_PACKET_SIZE:]
+    missing = (base + index * 8 + bit
+               for index, byte in enumerate(bitmap) if byte
+               for bit in range(8) if byte >> bit & 1)
+    return base, frontier, missing
+
+
+class ReliableTransfer:
+    """
+    Sliding-window state of a reliable UDP transfer.
+
+    The client reports its progress in NACK packets: every segment below the base has arrived, and a
+    bitmap flags the missing segments between the base and the highest segment received. Only flagged
+    segments are retransmitted, new segments are never sent more than `RELIABLE_WINDOW` past the base,
+    and the rate backs off multiplicatively whenever new losses are reported (AIMD).
+    """
+
+    def __init__(self, sender, pacer, max_rate=0):
+        """
+        Parameters:
+        sender (UDPSegmentSender): Sends the segments of this transfer.
+        pacer (Pacer): Paces this transfer, its rate is adjusted as reports come in.
+        max_rate (int): The rate the transfer may grow to in bytes per second, or 0 for no limit.
+        """
+        self.sender = sender
+        self.pacer = pacer
+        self.max_rate = max_rate or float('inf')
+        self.rate = min(RELIABLE_INITIAL_RATE, self.max_rate)
+        pacer.set_rate(self.rate)
+
+        self.base = 0
+        self.frontier = 0
+        self.pending = deque()  # Segments queued for retransmission
+        self.last_sent = {}  # Segment number -> time it was last retransmitted
+        self.last_report = time.monotonic()
+        self.last_new_send = 0.0
+        self.last_backoff = 0.0
+        self.complete = False
+
+    @property
+    def timed_out(self):
+        return time.monotonic() - self.last_report > RELIABLE_TIMEOUT
+
+    def _queue(self, segment, now):
+        last = self.last_sent.get(segment)
+        if last is None or now - last > RETRANSMIT_HOLDOFF:
+            self.last_sent[segment] = now
+            self.pending.append(segment)
+
+    def _queue_unacknowledged(self, now):
+        # Nothing new can be sent and nothing is flagged missing, so the segments past the highest one
+        # received, or the reports about them, were lost
+        if self.sender.next_segment < min(self.sender.total_segments, self.base + RELIABLE_WINDOW):
+            return
+        if now - self.last_new_send <= RETRANSMIT_HOLDOFF:
+            return
+        start = max(self.base, self.frontier)
+        for segment in range(start, min(self.sender.next_segment, start + self.pacer.batch_size)):
+            self._queue(segment, now)
+
+    def handle_report(self, data):
+        """
+        Applies a NACK packet: queues the missing segments and adjusts the rate.
+
+        Parameters:
+        data (bytes): The received datagram. Anything but a NACK packet is ignored.
+        """
+        try:
+            base, frontier, missing = parse_nack(data)
+        except ValueError:
+            return
+        now = time.monotonic()
+        self.last_report = now
+        if base >= self.sender.total_segments:
+            self.complete = True
+            return
+
+        self.base = max(self.base, base)
+        self.frontier = max(self.frontier, frontier)
+        if len(self.last_sent) > RELIABLE_WINDOW:
+            self.last_sent = {segment: sent for segment, sent in self.last_sent.items() if segment >= self.base}
+
+        new_losses = 0
+        for segment in missing:
+            if segment not in self.last_sent:
+                new_losses += 1
+            self._queue(segment, now)
+        if not self.pending:
+            self._queue_unacknowledged(now)
+
+        if new_losses and now - self.last_backoff > RELIABLE_BACKOFF_INTERVAL:
+            self.rate = max(RELIABLE_MIN_RATE, self.rate * RELIABLE_BACKOFF)
+            self.last_backoff = now
+        elif not new_losses:
+            self.rate = min(self.max_rate, self.rate + RELIABLE_RATE_STEP)
+        self.pacer.set_rate(self.rate)
+
+    def expire(self, error=None):
+        """
+        Called once the client went quiet for `RELIABLE_TIMEOUT`, or closed its socket. If every segment
+        was sent, every one reported missing was retransmitted since, and no report sent after the last
+        new segment fell short of it, only the client's completion reports were lost, and the transfer
+        is complete.
+
+        Parameters:
+        error (OSError): Raised instead of a `TimeoutError` when the transfer is not complete.
+
+        Raises:
+        TimeoutError: If the client had not acknowledged every segment, in which case it gave up.
+        """
+        total = self.sender.total_segments
+        if (self.sender.next_segment < total or self.pending
+                or (self.frontier < total and self.last_report > self.last_new_send)):
+            raise error or TimeoutError("Client stopped reporting progress.")
+        log.info("No completion report after every segment was sent, taking the transfer as complete.")
+        self.complete = True
+
+    def handle_idle(self):
+        """
+        Called when no report arrived for a report interval, resends the oldest unacknowledged segments.
+        """
+        self._queue_unacknowledged(time.monotonic())
+
+    def next_segments(self, limit):
+        """
+        Picks the next segments to send, retransmissions first, then new segments within the window.
+
+        Parameters:
+        limit (int): The most segments to return.
+
+        Returns:
+        list: The segment numbers to send.
+        """
+        segments = []
+        while self.pending and len(segments) < limit:
+            segment = self.pending.popleft()
+            if segment >= self.base:
+                segments.append(segment)
+
+        window_end = min(self.sender.total_segments, self.base + RELIABLE_WINDOW)
+        if len(segments) < limit and self.sender.next_segment < window_end:
+            end = min(window_end, self.sender.next_segment + limit - len(segments))
+            segments.extend(range(self.sender.next_segment, end))
+            self.sender.next_segment = end
+            self.last_new_send = time.monotonic()
+        return segments
+
+    def requeue(self, segments):
+        """
+        Puts back segments that were picked but could not be sent.
+        """
+        self.pending.extendleft(reversed(segments))
+
+
+def send_reliable(sock, sender, pacer, max_rate=0):
+    """
+    Runs a reliable UDP transfer on a blocking socket until the client reports that it has every segment.
+
+    Parameters:
+    sock (socket.socket): The UDP socket connected to the client.
+    sender (UDPSegmentSender): Sends the segments of the transfer.
+    pacer (Pacer): Paces the transfer.
+    max_rate (int): The rate the transfer may grow to in bytes per second, or 0 for no limit.
+
+    Raises:
+    TimeoutError: If the client stops reporting before every segment was sent.
+    """
+    transfer = ReliableTransfer(sender, pacer, max_rate)
+    while not transfer.complete:
+        if transfer.timed_out:
+            transfer.expire()
+            break
+        while True:
+            try:
+                transfer.handle_report(sock.recv(RECV_BUFFER_SIZE, socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError as e:  # The client closed its socket
+                transfer.expire(e)
+                return
+
+        segments = transfer.next_segments(pacer.batch_size)
+        if not segments:
+            ready, _, _ = select.select([sock], [], [], NACK_INTERVAL)
+            if not ready:
+                transfer.handle_idle()
+            continue
+
+        pace_sleep(pacer.reserve(len(segments)))
+        try:
+            sent = sender.send_segments(segments)
+        except ConnectionRefusedError:
+            raise
+        except OSError as e:
+            log.warning("Error sending segments %d-%d: %s", segments[0], segments[-1], e)
+            sent = len(segments)  # The client reports them missing and they are retransmitted
+        transfer.requeue(segments[sent:])
+
+
+def handle_tcp_client(conn, addr, file_size, timer=None, offset=0, length=None, seed=None):
     """
     Handles a TCP client connection by sending a specified amount of data.
 
@@ -116,6 +1106,10 @@ def handle_tcp_client(conn, addr, file_size):
     conn (socket.socket): The socket object representing the client connection.
     addr (tuple): The address of the connected client.
     file_size (int): The size of the data (in bytes) to send to the client.
+    timer (PhaseTimer): The phase timer started when the connection was accepted.
+    offset (int): The position of the first byte to send, for one stripe of a striped download.
+    length (int): The number of bytes to send from `offset`, by default the rest of the file.
+    seed (int): The content seed of a verified transfer, or None to send the payload without checksums.
 
     Raises:
     ValueError: If file_size is not a positive integer.
@@ -124,157 +1118,1174 @@ def handle_tcp_client(conn, addr, file_size):
     try:
         if not isinstance(file_size, int) or file_size <= 0:
             raise ValueError("file_size must be a positive integer.")
+        length = file_size - offset if length is None else length
 
-        print(f"{GREEN}[Server] TCP connection from {addr}{RESET}")
-        data = b'x' * file_size  # Create a data payload of specified size
-        conn.sendall(data)
+        log.info("TCP connection from %s", addr, extra={'peer': addr, 'file_size': file_size, 'offset': offset,
+                                                         'length': length})
+        timer = timer or PhaseTimer()
+        send_tcp_payload(conn, length, timer, offset, seed)
+        timer.mark('last_byte')
+        server_metrics.record_phases('tcp', timer)
+        server_stats.record_transfer('tcp', length)
     except (socket.error, ConnectionError) as e:
-        print(f"{ERROR}[Error] Error sending data to {addr}: {e}{RESET}")
+        server_stats.record_error()
+        log.error("Error sending data to %s: %s", addr, e)
     except ValueError as ve:
-        print(f"{ERROR}[Error] Invalid file size: {ve}{RESET}")
+        log.error("Invalid file size from %s: %s", addr, ve)
     finally:
         conn.close()  # Ensure the connection is closed
-        print(f"[Server] Connection with {addr} closed.{RESET}")
+        log.info("Connection with %s closed.", addr)
 
 
-def handle_udp_client(addr, file_size):
+def handle_udp_client(addr, file_size, datagram_size=UDP_DATAGRAM_SIZE, rate=0, reliable=False, timer=None,
+                      seed=None):
     """
     Handles UDP file transfer to a client.
 
     Parameters:
     addr (tuple): The address of the client as (IP, port).
     file_size (int): The size of the file to be sent in bytes.
+    datagram_size (int): The datagram size in bytes, header included, or 0 to use the path MTU.
+    rate (int): The transfer rate in bytes per second, or 0 to send as fast as the server-wide rate allows.
+        A reliable transfer adapts its rate to the reported losses and uses this as its upper bound.
+    reliable (bool): Retransmit the segments the client reports missing until it has all of them.
+    timer (PhaseTimer): The phase timer started when the request was received.
+    seed (int): The content seed of a verified transfer, or None to send segments without checksums.
 
-    This function splits the file into UDP packets and sends them to the client.
+    This function splits the file into UDP packets and sends them to the client in paced batches.
     """
+    debug = log.isEnabledFor(logging.DEBUG)
     try:
         # Create UDP socket
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
-            data_size = BUFFER_SIZE - PAYLOAD_PACKET_HEADER_SIZE
-            if data_size <= 0:
-                raise ValueError("BUFFER_SIZE must be greater than PAYLOAD_PACKET_HEADER_SIZE.")
-
-            total_segments = file_size // data_size
-            last_segment_size = file_size % data_size
-            total_segments_to_send = total_segments + (1 if last_segment_size > 0 else 0)
+            udp_socket.connect(addr)
+            timer = timer or PhaseTimer()
+            sender = UDPSegmentSender(udp_socket, file_size, resolve_datagram_size(udp_socket, datagram_size),
+                                      timer=timer, seed=seed)
+            pacer = Pacer(rate, sender.datagram_size)
 
-            for segment in range(total_segments):
-                try:
-                    payload = struct.pack(
-                        PAYLOAD_PACKET_FORMAT,
-                        MAGIC_COOKIE,
-                        PAYLOAD_TYPE,
-                        total_segments_to_send,
-                        segment
-                    ) + b'x' * data_size
-
-                    udp_socket.sendto(payload, addr)
-
-                    if CONTENT_DEBUG:
-                        print(
-                            f"{GREEN}[Server] Sent UDP packet {segment + 1}/{total_segments_to_send} with size {len(payload)} bytes.{RESET}")
-                except Exception as e:
-                    print(f"Error sending segment {segment}: {e}")
+            if reliable:
+                send_reliable(udp_socket, sender, pacer, rate)
 
-            if last_segment_size > 0:
+            while not sender.done:
                 try:
-                    payload = struct.pack(
-                        PAYLOAD_PACKET_FORMAT,
-                        MAGIC_COOKIE,
-                        PAYLOAD_TYPE,
-                        total_segments_to_send,
-                        total_segments
-                    ) + b'x' * last_segment_size
-                    udp_socket.sendto(payload, addr)
-                    if CONTENT_DEBUG:
-                        print(f"{GREEN}[Server] Sent last UDP packet with size {len(payload)} bytes.{RESET}")
-                except Exception as e:
-                    print(f"Error sending last segment: {e}")
+                    batch = min(pacer.batch_size, sender.remaining)
+                    pace_sleep(pacer.reserve(batch))
+                    sent = sender.send_next_batch(batch)
+                    if debug:
+                        log.debug("Sent %d UDP packets, %d/%d total.", sent, sender.next_segment, sender.total_segments)
+                except ConnectionRefusedError:
+                    raise
+                except OSError as e:
+                    log.warning("Error sending segment %d: %s", sender.next_segment, e)
+                    sender.next_segment += 1
 
-            print(f"{GREEN}[Server] UDP transfer to {addr} completed.{RESET}")
+            timer.mark('last_byte')
+            server_metrics.record_phases('udp', timer)
+            server_stats.record_transfer('udp', file_size)
+            log.info("UDP transfer to %s completed.", addr, extra={'peer': addr, 'file_size': file_size})
 
     except ValueError as ve:
-        print(f"{ERROR}[ValueError]: {ve}")
+        log.error("Invalid UDP transfer to %s: %s", addr, ve)
     except socket.error as se:
-        print(f"{ERROR}[Socket error]: {se}")
+        server_stats.record_error()
+        log.error("Socket error sending to %s: %s", addr, se)
     except Exception as e:
-        print(f"[ERROR][Unexpected error]: {e}")
-def tcp_listener():
-    """
-    Starts a TCP server that listens for incoming connections and handles clients in separate threads.
+        log.error("Unexpected error sending to %s: %s", addr, e)
+
+
+def parse_tcp_request(data):
+    """
+    Parses a TCP request line.
+
+    The line holds the file size, optionally followed by the offset and length of the range to send
+    for one stripe of a striped download, and then optionally by the content seed of a verified transfer.
+
+    Parameters:
+    data (bytes): The received request line.
+
+    Returns:
+    tuple: The file size, the offset and length of the requested range, and the content seed, None
+        when the transfer is not verified.
+
+    Raises:
+    ValueError: If the line is malformed or the range is not inside the file.
+    """
+    fields = data.decode().split()
+    if len(fields) not in (1, 3, 4):
+        raise ValueError("Malformed request line")
+    file_size = int(fields[0])
+    offset, length = (int(fields[1]), int(fields[2])) if len(fields) >= 3 else (0, file_size)
+    seed = int(fields[3]) if len(fields) == 4 else None
+    check_range(file_size, offset, length)
+    return file_size, offset, length, seed
+
+
+def check_range(file_size, offset, length):
+    """
+    Raises:
+    ValueError: If the requested range is empty or not inside the file.
+    """
+    if file_size <= 0 or offset < 0 or length <= 0 or offset + length > file_size:
+        raise ValueError("Requested range is not inside the file")
+
+
+def parse_session_request(data, offset=0):
+    """
+    Parses a request frame of a persistent session.
+
+    Parameters:
+    data (bytes): The received bytes, holding at least one frame from `offset` on.
+    offset (int): Where the frame starts in `data`.
+
+    Returns:
+    tuple: The request id, the offset and length of the requested range, and the content seed, None
+        when the transfer is not verified.
+
+    Raises:
+    ValueError: If the frame is malformed or the range is not inside the file.
+    """
+    magic_cookie, msg_type, request_id, file_size, range_offset, length, flags, seed = \
+        SESSION_REQUEST_STRUCT.unpack_from(data, offset)
+    if magic_cookie != MAGIC_COOKIE or msg_type != SESSION_REQUEST_TYPE:
+        raise ValueError("Malformed session request")
+    check_range(file_size, range_offset, length)
+    return request_id, range_offset, length, seed if flags & VERIFY_FLAG else None
+
+
+def parse_udp_request(data):
+    """
+    Parses a UDP request packet.
+
+    Parameters:
+    data (bytes): The received datagram.
+
+    Returns:
+    tuple: The requested file size, the requested rate in bytes per second, 0 when the packet
+        does not carry one, the request flags, and the content seed, None unless `VERIFY_FLAG` is set.
+
+    Raises:
+    ValueError: If the packet is too small or is not a valid request.
+    """
+    if len(data) < REQUEST_PACKET_SIZE:
+        raise ValueError("Received packet too small")
+    magic_cookie, msg_type, file_size = struct.unpack_from(REQUEST_PACKET_FORMAT, data)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, REQUEST_TYPE):
+        raise ValueError("Invalid request")
+    requested_rate, flags = 0, 0
+    if len(data) >= REQUEST_PACKET_SIZE + REQUEST_OPTIONS_SIZE:
+        requested_rate, flags = struct.unpack_from(REQUEST_OPTIONS_FORMAT, data, REQUEST_PACKET_SIZE)
+    elif len(data) >= REQUEST_PACKET_SIZE + REQUEST_RATE_SIZE:
+        requested_rate, = struct.unpack_from('!Q', data, REQUEST_PACKET_SIZE)
+    seed = None
+    if flags & VERIFY_FLAG:
+        if len(data) < REQUEST_PACKET_SIZE + REQUEST_OPTIONS_SIZE + REQUEST_SEED_SIZE:
+            raise ValueError("Verified request without a content seed")
+        seed, = struct.unpack_from(REQUEST_SEED_FORMAT, data, REQUEST_PACKET_SIZE + REQUEST_OPTIONS_SIZE)
+    return file_size, requested_rate, flags, seed
+
+
+def probe_reply(data):
+    """
+    Builds the answer to a probe packet, echoing its token along with the load of this process.
+
+    Parameters:
+    data (bytes): The received datagram.
+
+    Returns:
+    bytes: The reply, or None if the datagram is not a probe.
+    """
+    if len(data) != PROBE_PACKET_SIZE:
+        return None
+    magic_cookie, msg_type, token = struct.unpack(PROBE_PACKET_FORMAT, data)
+    if (magic_cookie, msg_type) != (MAGIC_COOKIE, PROBE_TYPE):
+        return None
+    return struct.pack(PROBE_REPLY_FORMAT, MAGIC_COOKIE, PROBE_TYPE, token, server_admission.pending,
+                       server_admission.max_pending)
+
+
+def bind_server_socket(s, port, reuse_port=False):
+    """
+    Binds a listening socket to `port` on all interfaces.
+
+    Parameters:
+    s (socket.socket): The socket to bind.
+    port (int): The port to bind.
+    reuse_port (bool): Set `SO_REUSEPORT` so several worker processes can bind the same port and the
+        kernel load-balances clients between them.
+    """
+    if s.type == socket.SOCK_STREAM:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(('', port))
+
+
+class TCPSession:
+    """
+    A persistent TCP connection over which a client pipelines transfer requests.
+
+    The `RequestReader` queues every request as soon as it is parsed, either admitted or with the reason
+    it was refused, and the transfers are sent in request order by the pool workers. Whichever worker
+    finds the session idle serves its queue until it is empty, so an idle session holds no worker, and
+    the reader keeps parsing the next requests while a transfer is being sent. A refused request that
+    reaches an idle session is answered by the reader right away, so only admitted transfers ever take
+    a place in the pool's queue.
+    """
+
+    def __init__(self, conn, addr, pool):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Responses must not wait for the client's ACKs
+        self.conn = conn
+        self.addr = addr
+        self.pool = pool
+        self.requests = deque()  # (request id, reject reason, offset, length, seed, timer), oldest first
+        self.busy = False  # A worker is serving the queue
+        self.closed = False  # The reader is done with the connection, which is closed once the queue is served
+        self.failed = False  # Sending failed, the remaining requests are only released
+        self._lock = threading.Lock()
+
+    def submit(self, request_id, reason, offset, length, seed, timer):
+        with self._lock:
+            if reason and not self.busy:
+                self._send_reject(request_id, reason)
+                return
+            self.requests.append((request_id, reason, offset, length, seed, timer))
+            if self.busy:
+                return
+            self.busy = True
+        try:
+            self.pool.submit(self.serve)
+        except queue.Full:
+            log.error("No room in the transfer queue for the session of %s, closing it.", self.addr)
+            self.fail()
+            self.serve()  # Only releases the admitted requests of a failed session
+
+    def _send_reject(self, request_id, reason):
+        """
+        Answers a refused request from the reader thread without blocking it. A client whose receive
+        buffer is too full to take the response is not reading its responses, and loses the session.
+        """
+        if self.failed:
+            return
+        response = build_session_response(request_id, reason)
+        try:
+            sent = self.conn.send(response, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            log.error("Error sending to %s: %s", self.addr, e)
+            self.fail()
+            return
+        if sent < len(response):
+            log.error("Session of %s does not read its responses, closing it.", self.addr)
+            self.fail()
+
+    def serve(self):
+        """
+        Sends the queued transfers in order until the queue is empty.
+        """
+        while True:
+            with self._lock:
+                if not self.requests:
+                    self.busy = False
+                    closed = self.closed
+                    break
+                request = self.requests.popleft()
+            self.serve_request(*request)
+        if closed:
+            self.close()
+
+    def serve_request(self, request_id, reason, offset, length, seed, timer):
+        if reason:
+            if not self.failed:
+                try:
+                    self.conn.sendall(build_session_response(request_id, reason))
+                except OSError as e:
+                    log.error("Error sending to %s: %s", self.addr, e)
+                    self.fail()
+            return
+        try:
+            if self.failed:
+                return
+            log.debug("Session transfer %d of %d bytes to %s", request_id, length, self.addr)
+            self.conn.sendall(build_session_response(request_id, length=length), MSG_MORE)
+            send_tcp_payload(self.conn, length, timer, offset, seed)
+            timer.mark('last_byte')
+            server_metrics.record_phases('tcp', timer)
+            server_stats.record_transfer('tcp', length)
+        except (socket.error, ConnectionError) as e:
+            server_stats.record_error()
+            log.error("Error sending data to %s: %s", self.addr, e)
+            self.fail()
+        finally:
+            server_admission.release(self.addr[0], length)
+
+    def fail(self):
+        """
+        Stops sending on the session and shuts the connection down, which the reader sees as the client leaving.
+        """
+        self.failed = True
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def finish(self):
+        """
+        Called by the reader once it stopped reading requests. Closes the connection, or leaves that to the
+        worker serving the queue.
+        """
+        with self._lock:
+            self.closed = True
+            if self.busy:
+                return
+        self.close()
+
+    def close(self):
+        self.conn.close()
+        log.info("Session with %s closed.", self.addr)
+
+
+class PendingConnection:
     """
+    A connection watched by the `RequestReader`, with the bytes received but not yet parsed.
+    """
+
+    __slots__ = ('addr', 'timer', 'accepted', 'data', 'session')
+
+    def __init__(self, addr, timer):
+        self.addr = addr
+        self.timer = timer
+        self.accepted = time.monotonic()
+        self.data = bytearray()
+        self.session = None
+
+
+class RequestReader:
+    """
+    Reads and parses TCP requests on one selector thread, so a client that is slow to send its request
+    holds up neither the accept loop nor a transfer worker.
+
+    The accept loop hands every new connection over with `add`. A one-shot request line is admitted and
+    its transfer submitted to the pool, after which the reader lets go of the connection. A connection
+    that starts with a session hello stays with the reader for its lifetime, and every request frame is
+    admitted and queued on its `TCPSession` as soon as it arrives. Connections without a complete first
+    request after `REQUEST_TIMEOUT` seconds are closed.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.selector = selectors.DefaultSelector()
+        self._new = queue.SimpleQueue()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def add(self, conn, addr, timer):
+        """
+        Hands a newly accepted connection to the reader thread.
+        """
+        self._new.put((conn, addr, timer))
+        try:
+            self._wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass  # The reader has wakeups pending already
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select(READER_POLL_INTERVAL):
+                if key.fileobj is self._wakeup_recv:
+                    self._register_new()
+                    continue
+                try:
+                    self._read(key.fileobj, key.data)
+                except Exception as e:
+                    log.error("Error reading request from %s: %s", key.data.addr, e)
+                    try:
+                        self._drop(key.fileobj, key.data)
+                    except (KeyError, ValueError):
+                        pass  # Already handed over or closed
+            self._expire()
+
+    def _register_new(self):
+        try:
+            while self._wakeup_recv.recv(RECV_BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                conn, addr, timer = self._new.get_nowait()
+            except queue.Empty:
+                return
+            self.selector.register(conn, selectors.EVENT_READ, PendingConnection(addr, timer))
+
+    def _drop(self, conn, pending):
+        """
+        Stops reading from a connection and closes it, or leaves closing a session to its worker.
+        """
+        self.selector.unregister(conn)
+        if pending.session is not None:
+            pending.session.finish()
+        else:
+            conn.close()
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            pending = key.data
+            if pending is not None and pending.session is None and now - pending.accepted > REQUEST_TIMEOUT:
+                log.warning("No request received from %s in time, closing connection.", pending.addr)
+                self._drop(key.fileobj, pending)
+
+    def _read(self, conn, pending):
+        try:
+            data = conn.recv(RECV_BUFFER_SIZE)
+        except OSError:
+            data = b''
+        if not data:
+            if pending.session is None:
+                log.warning("No data received from %s, closing connection.", pending.addr)
+            self._drop(conn, pending)
+            return
+        pending.data += data
+
+        if pending.session is None:
+            if pending.data.startswith(SESSION_HELLO):
+                del pending.data[:len(SESSION_HELLO)]
+                pending.session = TCPSession(conn, pending.addr, self.pool)
+                log.info("Session opened by %s", pending.addr, extra={'peer': pending.addr})
+            elif SESSION_HELLO.startswith(pending.data) or (b'\n' not in pending.data
+                                                            and len(pending.data) < RECV_BUFFER_SIZE):
+                return  # The rest of the hello or of the request line is still on its way
+            else:
+                self.selector.unregister(conn)
+                self._start_transfer(conn, pending)
+                return
+        self._queue_requests(conn, pending)
+
+    def _start_transfer(self, conn, pending):
+        """
+        Admits the transfer asked for by a request line and submits it to the pool.
+        """
+        addr, timer = pending.addr, pending.timer
+        try:
+            file_size, offset, length, seed = parse_tcp_request(bytes(pending.data))
+        except ValueError:
+            log.warning("Invalid file size received from %s, closing connection.", addr)
+            conn.close()
+            return
+        timer.mark('request')
+        reason = server_admission.admit(addr[0], length)
+        if reason:
+            record_rejection('TCP', addr, reason)
+            try:
+                conn.sendall(build_reject(reason))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+            return
+        try:
+            self.pool.submit(run_admitted, addr, length, handle_tcp_client,
+                             conn, addr, file_size, timer, offset, length, seed)
+        except queue.Full:
+            log.error("No room in the transfer queue for %s, closing connection.", addr)
+            server_admission.release(addr[0], length)
+            conn.close()
+
+    def _queue_requests(self, conn, pending):
+        """
+        Admits and queues every complete request frame received on a session.
+        """
+        frame_size = SESSION_REQUEST_STRUCT.size
+        parsed = 0
+        try:
+            while len(pending.data) - parsed >= frame_size:
+                timer = PhaseTimer()
+                request_id, offset, length, seed = parse_session_request(pending.data, parsed)
+                parsed += frame_size
+                timer.mark('request')
+                reason = server_admission.admit(pending.addr[0], length)
+                if reason:
+                    record_rejection('TCP', pending.addr, reason)
+                pending.session.submit(request_id, reason, offset, length, seed, timer)
+        except ValueError as e:
+            log.warning("Invalid session request from %s, closing session: %s", pending.addr, e)
+            pending.session.fail()
+            self._drop(conn, pending)
+            return
+        del pending.data[:parsed]
+
+
+def tcp_listener(reuse_port=False, pool=None):
+    """
+    Starts a TCP server that listens for incoming connections and hands them to a `RequestReader`,
+    which submits the admitted transfers to a worker pool.
+
+    A client turned away by `server_admission` gets a reject packet instead of the payload and is disconnected.
+
+    Parameters:
+    reuse_port (bool): Bind with `SO_REUSEPORT` to share the port with other worker processes.
+    pool (TransferPool): The workers serving the transfers, a new pool by default.
+    """
+    pool = pool or TransferPool()
+    reader = RequestReader(pool).start()
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', TCP_PORT))
+            bind_server_socket(s, TCP_PORT, reuse_port)
             s.listen()
-            print(f"{GREEN}[Server] TCP server listening on port {TCP_PORT}{RESET}")
+            log.info("TCP server listening on port %d", TCP_PORT)
             while True:
                 try:
                     conn, addr = s.accept()
-                    print(f"{GREEN}[Server] Connection accepted from {addr}{RESET}")
-                    file_size_data = conn.recv(RECV_BUFFER_SIZE)
-                    if not file_size_data:
-                        print(f"{ERROR}[Error] No data received from {addr}, closing connection.{RESET}")
-                        conn.close()
-                        continue
-                    try:
-                        file_size = int(file_size_data.decode().strip())
-                    except ValueError:
-                        print(f"{ERROR}[Error] Invalid file size received from {addr}, closing connection.{RESET}")
-                        conn.close()
-                        continue
-                    threading.Thread(target=handle_tcp_client, args=(conn, addr, file_size)).start()
+                    timer = PhaseTimer()
+                    log.info("Connection accepted from %s", addr, extra={'peer': addr})
+                    reader.add(conn, addr, timer)
                 except Exception as e:
-                    print(f"{ERROR}[Error] Error accepting connection: {e}{RESET}")
+                    log.error("Error accepting connection: %s", e)
     except Exception as e:
-        print(f"{ERROR}[Error] Failed to start TCP server: {e}{RESET}")
+        log.error("Failed to start TCP server: %s", e)
 
-def udp_listener():
+def udp_listener(datagram_size=UDP_DATAGRAM_SIZE, reuse_port=False, client_rate=0, pool=None):
     """
-    Starts a UDP server that listens for incoming requests and spawns threads to handle valid packets.
+    Starts a UDP server that listens for incoming requests and hands admitted ones to a worker pool.
+
+    A request turned away by `server_admission` is answered with a reject packet, and a probe with the
+    current load.
+
+    Parameters:
+    datagram_size (int): The datagram size used for transfers, header included, or 0 for the path MTU.
+    reuse_port (bool): Bind with `SO_REUSEPORT` to share the port with other worker processes.
+    client_rate (int): The most bytes per second sent to a single client, or 0 for no limit.
+    pool (TransferPool): The workers serving the transfers, a new pool by default.
     """
+    pool = pool or TransferPool()
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
             try:
-                s.bind(('', UDP_PORT))
-                print(f"{GREEN}[Server] UDP server listening on port {UDP_PORT}{RESET}")
+                bind_server_socket(s, UDP_PORT, reuse_port)
+                log.info("UDP server listening on port %d", UDP_PORT)
             except socket.error as e:
-                print(f"{ERROR}[Error] Failed to bind UDP socket: {e}")
+                log.error("Failed to bind UDP socket: %s", e)
                 return
 
             while True:
                 try:
                     data, addr = s.recvfrom(RECV_BUFFER_SIZE)
-                    if len(data) >= REQUEST_PACKET_SIZE:
-                        unpacked_data = struct.unpack(REQUEST_PACKET_FORMAT, data[:REQUEST_PACKET_SIZE])
-                        if unpacked_data[0:2] == (MAGIC_COOKIE, REQUEST_TYPE):
-                            print(f"{GREEN}[Server] UDP request received from {addr}{RESET}")
-                            file_size = unpacked_data[2]
-                            threading.Thread(target=handle_udp_client, args=(addr, file_size)).start()
-                        else:
-                            print(f"[Warning] Invalid request from {addr}")
-                    else:
-                        print(f"[Warning] Received packet too small from {addr}")
+                    reply = probe_reply(data)
+                    if reply:
+                        s.sendto(reply, addr)
+                        continue
+                    timer = PhaseTimer()
+                    try:
+                        file_size, requested_rate, flags, seed = parse_udp_request(data)
+                    except ValueError as e:
+                        log.warning("%s from %s", e, addr)
+                        continue
+                    reason = server_admission.admit(addr[0], file_size)
+                    if reason:
+                        record_rejection('UDP', addr, reason)
+                        s.sendto(build_reject(reason), addr)
+                        continue
+                    log.info("UDP request received from %s", addr, extra={'peer': addr, 'file_size': file_size})
+                    rate = effective_rate(requested_rate, client_rate)
+                    reliable = bool(flags & RELIABLE_FLAG)
+                    timer.mark('request')
+                    try:
+                        pool.submit(run_admitted, addr, file_size, handle_udp_client,
+                                    addr, file_size, datagram_size, rate, reliable, timer, seed)
+                    except queue.Full:
+                        log.error("No room in the transfer queue for %s, rejecting request.", addr)
+                        server_admission.release(addr[0], file_size)
+                        record_rejection('UDP', addr, REJECT_BUSY)
+                        s.sendto(build_reject(REJECT_BUSY), addr)
                 except struct.error as e:
-                    print(f"{ERROR}[Error] Failed to unpack data from {addr}: {e}")
+                    log.error("Failed to unpack data from %s: %s", addr, e)
                 except socket.error as e:
-                    print(f"{ERROR}[Error] Socket error: {e}")
+                    log.error("Socket error: %s", e)
     except Exception as e:
-        print(f"{ERROR}[Error] Unexpected error: {e}")
+        log.error("Unexpected error: %s", e)
+
+async def wait_writable(loop, sock):
+    """
+    Waits until a non-blocking socket has room in its send buffer.
+    """
+    writable = loop.create_future()
+
+    def on_writable():
+        if not writable.done():
+            writable.set_result(None)
+
+    loop.add_writer(sock.fileno(), on_writable)
+    try:
+        await writable
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+async def async_send_offers(interface_cache, multicast_group=None):
+    """
+    Event-loop version of `send_offers`, sending offers every `OFFER_INTERVAL` seconds from a non-blocking socket.
+    """
+    loop = asyncio.get_running_loop()
+    error_count = 0
+    try:
+        offer_message = struct.pack(OFFER_PACKET_FORMAT, MAGIC_COOKIE, OFFER_TYPE, UDP_PORT, TCP_PORT)
+    except struct.error as e:
+        log.error("Error packing offer message: %s", e)
+        return
+
+    try:
+        with open_offer_socket(multicast_group) as s:
+            s.setblocking(False)
+            await loop.run_in_executor(None, interface_cache.ready.wait)
+            while error_count < MAX_ERROR_COUNT:
+                destinations = offer_destinations(interface_cache.snapshot(), multicast_group)
+                sent = send_offer_round(s, offer_message, destinations)
+                if sent:
+                    error_count = 0
+                    log.info("Offer sent on %d of %d destinations.", sent, len(destinations))
+                else:
+                    error_count += 1
+                await asyncio.sleep(OFFER_INTERVAL)
+            log.error("Server Offer sending stopped after %d rounds without an offer sent.", error_count)
+    except socket.error as e:
+        log.error("Socket creation failed: %s", e)
+
+
+async def async_send_reliable(sock, sender, pacer, max_rate=0):
+    """
+    Event-loop version of `send_reliable`, on a non-blocking socket.
+    """
+    loop = asyncio.get_running_loop()
+    transfer = ReliableTransfer(sender, pacer, max_rate)
+    while not transfer.complete:
+        if transfer.timed_out:
+            transfer.expire()
+            break
+        try:
+            while True:
+                try:
+                    transfer.handle_report(sock.recv(RECV_BUFFER_SIZE))
+                except BlockingIOError:
+                    break
+
+            segments = transfer.next_segments(pacer.batch_size)
+            if not segments:
+                try:
+                    transfer.handle_report(await asyncio.wait_for(loop.sock_recv(sock, RECV_BUFFER_SIZE),
+                                                                  NACK_INTERVAL))
+                except asyncio.TimeoutError:
+                    transfer.handle_idle()
+                continue
+        except ConnectionRefusedError as e:  # The client closed its socket
+            transfer.expire(e)
+            return
+
+        delay = pacer.reserve(len(segments))  # Once, the segments are sent after a full send buffer drains
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent = 0
+        while sent < len(segments):
+            try:
+                sent += sender.send_segments(segments[sent:])
+            except BlockingIOError:
+                await wait_writable(loop, sock)
+            except ConnectionRefusedError:
+                raise
+            except OSError as e:
+                log.warning("Error sending segments %d-%d: %s", segments[sent], segments[-1], e)
+                break  # The client reports them missing and they are retransmitted
+        await asyncio.sleep(0)
+
+
+async def async_send_tcp_payload(conn, file_size, timer, offset=0, seed=None):
+    """
+    Event-loop version of `send_tcp_payload`.
+
+    The payload goes out through `loop.sock_sendfile`, which only writes while the socket is
+    writable, so a slow client holds no thread and does not stall the other transfers.
+    """
+    loop = asyncio.get_running_loop()
+    payload_file, _ = get_payload_block()
+    capture = server_capture
+    stream = capture.new_stream() if capture is not None else 0
+    remaining = file_size
+    position = ((seed or 0) + offset) % PAYLOAD_BLOCK_SIZE
+    while remaining > 0:
+        if seed is not None:
+            chunk = min(remaining, TCP_CHECKSUM_BLOCK)
+        else:
+            chunk = min(remaining, PAYLOAD_BLOCK_SIZE - position)
+        timer.mark('first_byte')  # As the first chunk starts going out, like `send_tcp_payload`
+        await loop.sock_sendfile(conn, payload_file, position, chunk)
+        if seed is not None:
+            await loop.sock_sendall(conn, CHECKSUM_STRUCT.pack(block_checksum(position, chunk)))
+        if capture is not None:
+            capture.record(stream, PAYLOAD_TYPE, SENT | TCP, offset + file_size - remaining, offset + file_size, chunk)
+        tcp_meter.add(chunk)
+        remaining -= chunk
+        position = (position + chunk) % PAYLOAD_BLOCK_SIZE
+
+
+async def async_serve_session(conn, addr, data, slots):
+    """
+    Event-loop version of a `TCPSession`. Serves the request frames of a persistent session in order until
+    the client closes it.
+
+    Parameters:
+    conn (socket.socket): The non-blocking client socket.
+    addr (tuple): The address of the connected client.
+    data (bytes): What the client sent after the session hello so far.
+    slots (asyncio.Semaphore): Bounds the transfers served at once.
+
+    Raises:
+    ValueError: If the client sends a malformed request frame.
+    """
+    loop = asyncio.get_running_loop()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Responses must not wait for the client's ACKs
+    data = bytearray(data)
+    log.info("Session opened by %s", addr, extra={'peer': addr})
+    while True:
+        while len(data) < SESSION_REQUEST_STRUCT.size:
+            received = await loop.sock_recv(conn, RECV_BUFFER_SIZE)
+            if not received:
+                return
+            data += received
+        timer = PhaseTimer()
+        request_id, offset, length, seed = parse_session_request(data)
+        del data[:SESSION_REQUEST_STRUCT.size]
+        timer.mark('request')
+
+        reason = server_admission.admit(addr[0], length)
+        if reason:
+            record_rejection('TCP', addr, reason)
+            await loop.sock_sendall(conn, build_session_response(request_id, reason))
+            continue
+        log.debug("Session transfer %d of %d bytes to %s", request_id, length, addr)
+        await async_run_admitted(addr, length, slots,
+                                 async_send_session_transfer(conn, request_id, length, timer, offset, seed))
+        timer.mark('last_byte')
+        server_metrics.record_phases('tcp', timer)
+        server_stats.record_transfer('tcp', length)
+
+
+async def async_send_session_transfer(conn, request_id, length, timer, offset, seed):
+    await asyncio.get_running_loop().sock_sendall(conn, build_session_response(request_id, length=length))
+    await async_send_tcp_payload(conn, length, timer, offset, seed)
+
+
+async def async_handle_tcp_client(conn, addr, timer=None, slots=None):
+    """
+    Reads the size request from a TCP client and streams the payload back on the event loop, or serves
+    the client's requests until it leaves when it opens a persistent session.
+
+    Parameters:
+    conn (socket.socket): The non-blocking client socket.
+    addr (tuple): The address of the connected client.
+    timer (PhaseTimer): The phase timer started when the connection was accepted.
+    slots (asyncio.Semaphore): Bounds the transfers served at once, the others wait for a slot.
+    """
+    loop = asyncio.get_running_loop()
+    timer = timer or PhaseTimer()
+    slots = slots or asyncio.Semaphore(MAX_TRANSFERS)
+    try:
+        file_size_data = await loop.sock_recv(conn, RECV_BUFFER_SIZE)
+        while 0 < len(file_size_data) < len(SESSION_HELLO) and SESSION_HELLO.startswith(file_size_data):
+            received = await loop.sock_recv(conn, RECV_BUFFER_SIZE)  # The rest of a hello split across reads
+            if not received:
+                break
+            file_size_data += received
+        if not file_size_data:
+            log.warning("No data received from %s, closing connection.", addr)
+            return
+        if file_size_data.startswith(SESSION_HELLO):
+            await async_serve_session(conn, addr, file_size_data[len(SESSION_HELLO):], slots)
+            return
+        file_size, offset, length, seed = parse_tcp_request(file_size_data)
+        timer.mark('request')
+
+        reason = server_admission.admit(addr[0], length)
+        if reason:
+            record_rejection('TCP', addr, reason)
+            await loop.sock_sendall(conn, build_reject(reason))
+            return
+        log.info("TCP connection from %s", addr, extra={'peer': addr, 'file_size': file_size, 'offset': offset,
+                                                         'length': length})
+        await async_run_admitted(addr, length, slots, async_send_tcp_payload(conn, length, timer, offset, seed))
+        timer.mark('last_byte')
+        server_metrics.record_phases('tcp', timer)
+        server_stats.record_transfer('tcp', length)
+    except (socket.error, ConnectionError) as e:
+        server_stats.record_error()
+        log.error("Error sending data to %s: %s", addr, e)
+    except ValueError as ve:
+        log.error("Invalid file size from %s: %s", addr, ve)
+    finally:
+        conn.close()
+        log.info("Connection with %s closed.", addr)
+
+
+async def async_handle_udp_client(addr, file_size, datagram_size=UDP_DATAGRAM_SIZE, rate=0, reliable=False,
+                                  timer=None, seed=None):
+    """
+    Event-loop version of `handle_udp_client`.
+
+    Batches are sent from a non-blocking socket. When the send buffer is full the transfer waits for
+    writability instead of spinning and then sends the rest of the batch, which was paced already, and it
+    yields to the other transfers after every batch.
+
+    Parameters:
+    addr (tuple): The address of the client as (IP, port).
+    file_size (int): The size of the file to be sent in bytes.
+    datagram_size (int): The datagram size in bytes, header included, or 0 to use the path MTU.
+    rate (int): The transfer rate in bytes per second, or 0 to send as fast as the server-wide rate allows.
+        A reliable transfer adapts its rate to the reported losses and uses this as its upper bound.
+    reliable (bool): Retransmit the segments the client reports missing until it has all of them.
+    timer (PhaseTimer): The phase timer started when the request was received.
+    seed (int): The content seed of a verified transfer, or None to send segments without checksums.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+            udp_socket.setblocking(False)
+            udp_socket.connect(addr)
+            timer = timer or PhaseTimer()
+            sender = UDPSegmentSender(udp_socket, file_size, resolve_datagram_size(udp_socket, datagram_size),
+                                      timer=timer, seed=seed)
+            pacer = Pacer(rate, sender.datagram_size)
+
+            if reliable:
+                await async_send_reliable(udp_socket, sender, pacer, rate)
+
+            while not sender.done:
+                batch = min(pacer.batch_size, sender.remaining)
+                delay = pacer.reserve(batch)  # Once per batch, however often a full send buffer interrupts it
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                while batch:
+                    try:
+                        batch -= sender.send_next_batch(batch)
+                    except BlockingIOError:
+                        await wait_writable(loop, udp_socket)
+                    except ConnectionRefusedError:
+                        raise
+                    except OSError as e:
+                        log.warning("Error sending segment %d: %s", sender.next_segment, e)
+                        sender.next_segment += 1
+                        batch -= 1
+                await asyncio.sleep(0)
+
+            timer.mark('last_byte')
+            server_metrics.record_phases('udp', timer)
+            server_stats.record_transfer('udp', file_size)
+            log.info("UDP transfer to %s completed.", addr, extra={'peer': addr, 'file_size': file_size})
+
+    except ValueError as ve:
+        log.error("Invalid UDP transfer to %s: %s", addr, ve)
+    except socket.error as se:
+        server_stats.record_error()
+        log.error("Socket error sending to %s: %s", addr, se)
+
+
+async def async_tcp_listener(tasks, reuse_port=False, slots=None):
+    """
+    Accepts TCP connections on the event loop and serves each one in its own task.
+
+    Parameters:
+    tasks (set): Holds references to the running client tasks.
+    reuse_port (bool): Bind with `SO_REUSEPORT` to share the port with other worker processes.
+    slots (asyncio.Semaphore): Bounds the transfers served at once.
+    """
+    loop = asyncio.get_running_loop()
+    slots = slots or asyncio.Semaphore(MAX_TRANSFERS)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            bind_server_socket(s, TCP_PORT, reuse_port)
+            s.listen()
+            s.setblocking(False)
+            log.info("TCP server listening on port %d", TCP_PORT)
+            while True:
+                try:
+                    conn, addr = await loop.sock_accept(s)
+                    timer = PhaseTimer()
+                    log.info("Connection accepted from %s", addr, extra={'peer': addr})
+                    conn.setblocking(False)
+                    task = asyncio.create_task(async_handle_tcp_client(conn, addr, timer, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                except socket.error as e:
+                    log.error("Error accepting connection: %s", e)
+    except socket.error as e:
+        log.error("Failed to start TCP server: %s", e)
+
+
+async def async_udp_listener(tasks, datagram_size=UDP_DATAGRAM_SIZE, reuse_port=False, client_rate=0, slots=None):
+    """
+    Receives UDP requests on the event loop and serves each admitted one in its own task.
+
+    Parameters:
+    tasks (set): Holds references to the running client tasks.
+    datagram_size (int): The datagram size used for transfers, header included, or 0 for the path MTU.
+    reuse_port (bool): Bind with `SO_REUSEPORT` to share the port with other worker processes.
+    client_rate (int): The most bytes per second sent to a single client, or 0 for no limit.
+    slots (asyncio.Semaphore): Bounds the transfers served at once.
+    """
+    loop = asyncio.get_running_loop()
+    slots = slots or asyncio.Semaphore(MAX_TRANSFERS)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            bind_server_socket(s, UDP_PORT, reuse_port)
+            s.setblocking(False)
+            log.info("UDP server listening on port %d", UDP_PORT)
+            while True:
+                try:
+                    data, addr = await loop.sock_recvfrom(s, RECV_BUFFER_SIZE)
+                    reply = probe_reply(data)
+                    if reply:
+                        try:
+                            s.sendto(reply, addr)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    timer = PhaseTimer()
+                    try:
+                        file_size, requested_rate, flags, seed = parse_udp_request(data)
+                    except ValueError as e:
+                        log.warning("%s from %s", e, addr)
+                        continue
+                    reason = server_admission.admit(addr[0], file_size)
+                    if reason:
+                        record_rejection('UDP', addr, reason)
+                        try:
+                            s.sendto(build_reject(reason), addr)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    log.info("UDP request received from %s", addr, extra={'peer': addr, 'file_size': file_size})
+                    rate = effective_rate(requested_rate, client_rate)
+                    reliable = bool(flags & RELIABLE_FLAG)
+                    timer.mark('request')
+                    task = asyncio.create_task(async_run_admitted(
+                        addr, file_size, slots, async_handle_udp_client(addr, file_size, datagram_size, rate, reliable,
+                                                                        timer, seed)))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                except socket.error as e:
+                    log.error("Socket error: %s", e)
+    except socket.error as e:
+        log.error("Failed to bind UDP socket: %s", e)
+
+
+async def run_event_loop_server(args, offers=True):
+    """
+    Runs the offer broadcaster and the TCP and UDP servers on a single event loop.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line options.
+    offers (bool): Whether this process broadcasts offers.
+    """
+    tasks = set()
+    reuse_port = args.workers > 1
+    slots = asyncio.Semaphore(args.max_transfers)
+    servers = [async_tcp_listener(tasks, reuse_port, slots),
+               async_udp_listener(tasks, args.datagram_size, reuse_port, args.client_rate, slots)]
+    if offers:
+        servers.append(async_send_offers(InterfaceCache(args.interface_refresh).start(), args.multicast_group))
+    await asyncio.gather(*servers)
+
+
+def run_threaded_server(args, offers=True):
+    """
+    Runs the offer broadcaster and the TCP and UDP servers in threads, with transfers served by a
+    shared pool of `args.max_transfers` worker threads.
+
+    Parameters:
+    args (argparse.Namespace): The parsed command line options.
+    offers (bool): Whether this process broadcasts offers.
+    """
+    reuse_port = args.workers > 1
+    pool = TransferPool(args.max_transfers, args.queue_depth)
+    threads = [threading.Thread(target=tcp_listener, args=(reuse_port, pool)),
+               threading.Thread(target=udp_listener, args=(args.datagram_size, reuse_port, args.client_rate, pool))]
+    if offers:
+        interface_cache = InterfaceCache(args.interface_refresh).start()
+        threads.append(threading.Thread(target=send_offers, args=(interface_cache, args.multicast_group)))
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+
+def run_server(args, offers=True, worker_id=None):
+    """
+    Runs the server in the mode selected by `args.mode`. Each worker process records its own trace,
+    named after `args.capture` with the worker id appended.
+    """
+    global server_bucket, server_admission, server_capture
+    if args.capture:
+        server_capture = open_trace(args.capture if worker_id is None else f"{args.capture}.{worker_id}")
+    if args.server_rate:
+        server_bucket = TokenBucket(args.server_rate / args.workers)
+    server_admission = AdmissionController(args.max_transfers, args.queue_depth, args.max_file_size,
+                                           args.per_ip_transfers, args.per_ip_bytes)
+    if args.mode == 'asyncio':
+        asyncio.run(run_event_loop_server(args, offers))
+    else:
+        run_threaded_server(args, offers)
+
+
+def stats_snapshot():
+    """
+    Returns the counters and metrics of this process, as served on the stats port.
+    """
+    return {'counters': server_stats.snapshot(), **server_metrics.snapshot()}
+
+
+def report_stats(worker_id, stats_queue):
+    """
+    Periodically sends this worker's stats snapshot and exported metrics to the parent process.
+    """
+    while True:
+        time.sleep(STATS_INTERVAL)
+        stats_queue.put((worker_id, server_stats.snapshot(), server_metrics.export()))
 
-def main():
-    offer = threading.Thread(target=send_offers)
-    tcp_listen = threading.Thread(target=tcp_listener)
-    udp_listen = threading.Thread(target=udp_listener)
 
-    offer.start()
-    tcp_listen.start()
-    udp_listen.start()
+def run_worker(args, worker_id, stats_queue):
+    """
+    Entry point of a worker process. Serves TCP and UDP clients on ports shared through `SO_REUSEPORT`
+    and leaves offer broadcasting to the parent.
+    """
+    configure_logging(args)
+    threading.Thread(target=report_stats, args=(worker_id, stats_queue), daemon=True).start()
+    try:
+        run_server(args, offers=False, worker_id=worker_id)
+    except KeyboardInterrupt:
+        pass
 
-    tcp_listen.join()
-    udp_listen.join()
-    offer.join()
+
+def run_workers(args):
+    """
+    Forks `args.workers` worker processes that share the TCP and UDP ports, broadcasts offers from the
+    parent, and logs the stats aggregated over all workers whenever they change.
+
+    The stats port is served by the parent, which merges the metrics last reported by every worker.
+    """
+    stats_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(args, worker_id, stats_queue), daemon=True)
+               for worker_id in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    log.info("Started %d workers.", len(workers))
+
+    interface_cache = InterfaceCache(args.interface_refresh).start()
+    threading.Thread(target=send_offers, args=(interface_cache, args.multicast_group), daemon=True).start()
+
+    worker_stats = {}
+    worker_metrics = {}
+    last_total = None
+
+    def merged_snapshot():
+        registry = MetricsRegistry()
+        for exported in list(worker_metrics.values()):
+            registry.merge(exported)
+        return {'counters': last_total or {}, 'workers': len(workers), **registry.snapshot()}
+
+    if args.stats_port:
+        start_stats_endpoint(args.stats_port, merged_snapshot)
+
+    try:
+        while any(worker.is_alive() for worker in workers):
+            try:
+                worker_id, snapshot, exported = stats_queue.get(timeout=STATS_INTERVAL)
+            except queue.Empty:
+                continue
+            worker_stats[worker_id] = snapshot
+            worker_metrics[worker_id] = exported
+            total = {key: sum(stats[key] for stats in worker_stats.values()) for key in snapshot}
+            if total != last_total:
+                last_total = total
+                log.info("%d TCP and %d UDP transfers, %.2f MB sent, %d errors, %d rejected across %d workers.",
+                         total['tcp_transfers'], total['udp_transfers'], total['bytes_sent'] / 1e6, total['errors'],
+                         total['rejected'], len(workers), extra={'counters': total})
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed test server.")
+    parser.add_argument('--datagram-size', type=int, default=UDP_DATAGRAM_SIZE,
+                        help=f"UDP datagram size in bytes, header included, up to {MAX_DATAGRAM_SIZE}. "
+                             f"0 uses the path MTU of each client.")
+    parser.add_argument('--mode', choices=('threaded', 'asyncio'), default='threaded',
+                        help="Serve with a thread per transfer, or with every transfer on one asyncio event loop.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes sharing the TCP and UDP ports through SO_REUSEPORT.")
+    parser.add_argument('--client-rate', type=int, default=0,
+                        help="Most bytes per second sent to a single UDP client. Clients may ask for less. 0 is unlimited.")
+    parser.add_argument('--server-rate', type=int, default=0,
+                        help="Most bytes per second sent over all UDP transfers, split evenly across workers. "
+                             "0 is unlimited.")
+    parser.add_argument('--max-transfers', type=int, default=MAX_TRANSFERS,
+                        help="Transfers served at once by each worker process.")
+    parser.add_argument('--queue-depth', type=int, default=QUEUE_DEPTH,
+                        help="Admitted transfers that may wait for a free slot in each worker process. "
+                             "Requests beyond it are rejected.")
+    parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE,
+                        help="Largest file in bytes a client may request.")
+    parser.add_argument('--per-ip-transfers', type=int, default=PER_IP_TRANSFERS,
+                        help="Most active and queued transfers of one client IP per worker process. 0 is unlimited.")
+    parser.add_argument('--per-ip-bytes', type=int, default=0,
+                        help="Most bytes one client IP may have requested over its admitted transfers per worker "
+                             "process. 0 is unlimited.")
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help="Local TCP port serving connection phase timings and throughput as JSON. 0 disables it.")
+    parser.add_argument('--interface-refresh', type=float, default=INTERFACE_REFRESH_INTERVAL,
+                        help="Seconds between rereading the network interfaces offers are sent on.")
+    parser.add_argument('--multicast-group', nargs='?', const=OFFER_MULTICAST_GROUP,
+                        help=f"Also send offers to this multicast group on every interface, {OFFER_MULTICAST_GROUP} "
+                             f"when no group is given.")
+    parser.add_argument('--capture', metavar='PATH',
+                        help="Record every payload datagram and TCP send to a binary trace at PATH, for replay.py. "
+                             "With several workers each writes PATH.<worker id>.")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help="Lowest level logged. 'debug' also logs every batch of UDP packets sent.")
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text',
+                        help="Coloured text lines, or one JSON object per line.")
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help="Log one of every N informational messages of each kind, such as accepted connections.")
+    return parser.parse_args()
+
+
+def configure_logging(args):
+    """
+    Sets up the server logger from the command line options.
+    """
+    setup_logging('server', 'Server', args.log_level, args.log_format == 'json', args.log_sample)
+
+
+def main():
+    args = parse_args()
+    configure_logging(args)
+    get_payload_block()  # Allocate the shared payload block before serving any client
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        if args.stats_port:
+            start_stats_endpoint(args.stats_port, stats_snapshot)
+        run_server(args)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,74 @@
+# test_metrics.py
+import random
+import socket
+
+import pytest
+
+import server
+from metrics import HISTOGRAM_BUCKETS, SUB_BUCKET_COUNT, LatencyHistogram, bucket_index, bucket_value
+
+
+def test_small_values_get_a_bucket_each():
+    for value in range(SUB_BUCKET_COUNT):
+        assert bucket_index(value) == value
+        assert bucket_value(value) == value
+
+
+def test_bucket_index_is_monotonic_and_bounded():
+    values = sorted({random.getrandbits(bits) for bits in range(1, 64) for _ in range(50)})
+    indexes = [bucket_index(value) for value in values]
+    assert indexes == sorted(indexes)
+    assert indexes[-1] < HISTOGRAM_BUCKETS
+    assert bucket_index(2 ** 64 - 1) == HISTOGRAM_BUCKETS - 1
+
+
+@pytest.mark.parametrize('value', [SUB_BUCKET_COUNT, 1_000, 123_456, 10 ** 9, 3_600 * 10 ** 9, 2 ** 62 + 12345])
+def test_bucket_value_is_close_to_the_recorded_value(value):
+    assert bucket_value(bucket_index(value)) == pytest.approx(value, rel=2 / SUB_BUCKET_COUNT)
+
+
+def test_percentiles_are_close_to_exact():
+    values = sorted(random.randint(1_000, 10 ** 9) for _ in range(10_000))
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    for p in (50, 90, 99):
+        exact = values[round(p / 100 * len(values)) - 1]
+        assert histogram.percentile(p) == pytest.approx(exact, rel=0.02)
+    assert values[-1] * 0.98 <= histogram.percentile(100) <= values[-1]
+    assert (histogram.min, histogram.max, histogram.count) == (values[0], values[-1], len(values))
+
+
+def test_merge_adds_the_buckets():
+    first, second, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+    for value in range(0, 10 ** 6, 997):
+        (first if value % 2 else second).record(value)
+        both.record(value)
+    first.merge(second.export())
+    assert first.counts == both.counts
+    assert first.summary() == both.summary()
+
+
+def test_empty_histogram():
+    assert LatencyHistogram().percentile(99) == 0
+    assert LatencyHistogram().summary()['count'] == 0
+
+
+class CountingMeter:
+    def __init__(self):
+        self.total = 0
+
+    def add(self, num_bytes):
+        self.total += num_bytes
+
+
+@pytest.mark.parametrize('file_size', [2500, 3000, 999, 1])
+def test_udp_meter_counts_payload_bytes(monkeypatch, file_size):
+    meter = CountingMeter()
+    monkeypatch.setattr(server, 'udp_meter', meter)
+    sender_socket, receiver_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    with sender_socket, receiver_socket:
+        sender = server.UDPSegmentSender(sender_socket, file_size, 1000, batch_size=2)
+        while not sender.done:
+            sender.send_next_batch()
+    assert meter.total == file_size
@@ -0,0 +1,164 @@
+# test_protocol.py
+import struct
+
+import pytest
+
+import client
+import server
+
+
+def test_client_and_server_agree_on_wire_formats():
+    for name in ('MAGIC_COOKIE', 'REQUEST_TYPE', 'PAYLOAD_TYPE', 'NACK_TYPE', 'REJECT_TYPE', 'REQUEST_PACKET_FORMAT',
+                 'REQUEST_OPTIONS_FORMAT', 'REQUEST_SEED_FORMAT', 'NACK_PACKET_FORMAT', 'REJECT_PACKET_FORMAT',
+                 'RELIABLE_FLAG', 'VERIFY_FLAG', 'SESSION_HELLO', 'SESSION_REQUEST_TYPE', 'SESSION_RESPONSE_TYPE'):
+        assert getattr(client, name) == getattr(server, name), name
+    assert client.SESSION_REQUEST_STRUCT.format == server.SESSION_REQUEST_STRUCT.format
+    assert client.SESSION_RESPONSE_STRUCT.format == server.SESSION_RESPONSE_STRUCT.format
+
+
+def nack_for(total_segments, received):
+    tracker = client.SegmentTracker(total_segments)
+    for segment in received:
+        tracker.add(segment)
+    base = tracker.first_missing()
+    frontier = max(received) + 1
+    return client.build_nack(tracker, base, frontier)
+
+
+@pytest.mark.parametrize('total_segments, received', [
+    (10, [0, 1, 2, 4, 7, 8]),
+    (100, [0] + list(range(2, 100, 3))),
+    (20, list(range(9)) + [17]),
+    (64, list(range(16)) + [63]),  # Missing segments spanning whole bitmap bytes
+])
+def test_nack_bitmap_round_trip(total_segments, received):
+    base, frontier, missing = server.parse_nack(nack_for(total_segments, received))
+    assert base == min(set(range(total_segments)) - set(received))
+    assert frontier == max(received) + 1
+    assert list(missing) == [segment for segment in range(base, frontier) if segment not in received]
+
+
+def test_nack_of_complete_download_has_no_bitmap():
+    data = nack_for(5, range(5))
+    assert len(data) == server.NACK_PACKET_SIZE
+    base, frontier, missing = server.parse_nack(data)
+    assert (base, frontier, list(missing)) == (5, 5, [])
+
+
+def test_nack_bitmap_is_capped():
+    total_segments = client.MAX_NACK_BITMAP_SIZE * 8 * 2
+    data = nack_for(total_segments, [0, total_segments - 1])
+    assert len(data) == server.NACK_PACKET_SIZE + client.MAX_NACK_BITMAP_SIZE
+    base, frontier, missing = server.parse_nack(data)
+    assert frontier == total_segments
+    assert list(missing) == list(range(1, 1 + client.MAX_NACK_BITMAP_SIZE * 8))
+
+
+def test_parse_nack_rejects_other_packets():
+    with pytest.raises(ValueError):
+        server.parse_nack(b'\0' * 4)
+    with pytest.raises(ValueError):
+        server.parse_nack(struct.pack(server.NACK_PACKET_FORMAT, server.MAGIC_COOKIE, server.REQUEST_TYPE, 0, 0))
+
+
+@pytest.mark.parametrize('line, expected', [
+    (b'1000\n', (1000, 0, 1000, None)),
+    (b'1000 200 300\n', (1000, 200, 300, None)),
+    (b'1000 0 1000 42\n', (1000, 0, 1000, 42)),
+    (b'1000 999 1\n', (1000, 999, 1, None)),
+])
+def test_parse_tcp_request(line, expected):
+    assert server.parse_tcp_request(line) == expected
+
+
+@pytest.mark.parametrize('line', [
+    b'\n', b'abc\n', b'1000 5\n', b'1000 1 2 3 4\n',  # Malformed
+    b'0\n', b'-5\n',  # Empty file
+    b'1000 -1 10\n', b'1000 10 0\n', b'1000 900 101\n',  # Range outside the file
+])
+def test_parse_tcp_request_rejects(line):
+    with pytest.raises(ValueError):
+        server.parse_tcp_request(line)
+
+
+def udp_request(file_size, *options, seed=None):
+    data = struct.pack(client.REQUEST_PACKET_FORMAT, client.MAGIC_COOKIE, client.REQUEST_TYPE, file_size)
+    if options:
+        data += struct.pack(client.REQUEST_OPTIONS_FORMAT, *options)
+    if seed is not None:
+        data += struct.pack(client.REQUEST_SEED_FORMAT, seed)
+    return data
+
+
+def test_parse_udp_request():
+    assert server.parse_udp_request(udp_request(5000)) == (5000, 0, 0, None)
+    assert server.parse_udp_request(udp_request(5000, 1_000_000, client.RELIABLE_FLAG)) == \
+        (5000, 1_000_000, client.RELIABLE_FLAG, None)
+    assert server.parse_udp_request(udp_request(5000, 0, client.VERIFY_FLAG, seed=7)) == \
+        (5000, 0, client.VERIFY_FLAG, 7)
+
+
+def test_parse_udp_request_with_rate_only():
+    data = udp_request(5000) + struct.pack('!Q', 250_000)
+    assert server.parse_udp_request(data) == (5000, 250_000, 0, None)
+
+
+@pytest.mark.parametrize('data', [
+    b'\0' * 5,
+    struct.pack(client.REQUEST_PACKET_FORMAT, client.MAGIC_COOKIE + 1, client.REQUEST_TYPE, 5000),
+    struct.pack(client.REQUEST_PACKET_FORMAT, client.MAGIC_COOKIE, client.PAYLOAD_TYPE, 5000),
+    udp_request(5000, 0, client.VERIFY_FLAG),  # Verified without a seed
+])
+def test_parse_udp_request_rejects(data):
+    with pytest.raises(ValueError):
+        server.parse_udp_request(data)
+
+
+def session_request(request_id, file_size, offset, length, flags=0, seed=0):
+    return client.SESSION_REQUEST_STRUCT.pack(client.MAGIC_COOKIE, client.SESSION_REQUEST_TYPE, request_id,
+                                              file_size, offset, length, flags, seed)
+
+
+def test_session_request_round_trip():
+    frames = session_request(1, 1000, 0, 1000) + session_request(2, 1000, 100, 50, client.VERIFY_FLAG, 9)
+    assert server.parse_session_request(frames) == (1, 0, 1000, None)
+    assert server.parse_session_request(frames, server.SESSION_REQUEST_STRUCT.size) == (2, 100, 50, 9)
+
+
+@pytest.mark.parametrize('frame', [
+    session_request(1, 1000, 900, 101),
+    session_request(1, 0, 0, 0),
+    client.SESSION_REQUEST_STRUCT.pack(client.MAGIC_COOKIE, client.REQUEST_TYPE, 1, 1000, 0, 1000, 0, 0),
+])
+def test_parse_session_request_rejects(frame):
+    with pytest.raises(ValueError):
+        server.parse_session_request(frame)
+
+
+def test_session_response_round_trip():
+    assert client.check_session_response(server.build_session_response(3, length=500), 3, 500) == (0, 0)
+
+
+def test_session_rejections_carry_retry_after():
+    assert client.check_session_response(server.build_session_response(3, server.REJECT_BUSY), 3, 500) == \
+        (server.REJECT_BUSY, server.REJECT_RETRY_AFTER * 1000)
+    assert client.check_session_response(server.build_session_response(3, server.REJECT_TOO_LARGE), 3, 500) == \
+        (server.REJECT_TOO_LARGE, 0)
+
+
+@pytest.mark.parametrize('response', [
+    server.build_session_response(4, length=500),  # Another request
+    server.build_session_response(3, length=400),  # Another length
+    b'\0' * server.SESSION_RESPONSE_STRUCT.size,
+])
+def test_check_session_response_rejects(response):
+    with pytest.raises(ConnectionError):
+        client.check_session_response(response, 3, 500)
+
+
+def test_reject_round_trip():
+    rejection = client.parse_reject(server.build_reject(server.REJECT_BUSY), client.REJECT_PACKET_SIZE)
+    assert rejection.reason == server.REJECT_BUSY
+    assert rejection.retry_after == server.REJECT_RETRY_AFTER
+    rejection = client.parse_reject(server.build_reject(server.REJECT_TOO_LARGE), client.REJECT_PACKET_SIZE)
+    assert rejection.retry_after is None
@@ -0,0 +1,118 @@
+# test_reliable.py
+import struct
+
+import pytest
+
+import client
+import server
+
+
+class FakeSender:
+    """
+    Stands in for `UDPSegmentSender`, only tracking the next new segment.
+    """
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.next_segment = 0
+
+
+def report(total_segments, received, frontier=None):
+    tracker = client.SegmentTracker(total_segments)
+    for segment in received:
+        tracker.add(segment)
+    frontier = frontier if frontier is not None else max(received, default=-1) + 1
+    return client.build_nack(tracker, tracker.first_missing(), frontier)
+
+
+def new_transfer(total_segments, max_rate=0):
+    sender = FakeSender(total_segments)
+    return sender, server.ReliableTransfer(sender, server.Pacer(0, 1000), max_rate)
+
+
+def test_new_segments_stay_within_the_window():
+    sender, transfer = new_transfer(server.RELIABLE_WINDOW * 2)
+    sent = []
+    while True:
+        segments = transfer.next_segments(64)
+        if not segments:
+            break
+        sent.extend(segments)
+    assert sent == list(range(server.RELIABLE_WINDOW))
+    assert sender.next_segment == server.RELIABLE_WINDOW
+
+
+def test_missing_segments_are_retransmitted_first():
+    total = 100
+    sender, transfer = new_transfer(total)
+    transfer.next_segments(50)
+    transfer.handle_report(report(total, [0, 1, 3, 4, 7, 8, 9]))
+    assert transfer.base == 2
+    assert transfer.next_segments(5) == [2, 5, 6, 50, 51]
+
+
+def test_retransmission_is_held_off():
+    total = 100
+    _, transfer = new_transfer(total)
+    transfer.next_segments(10)
+    transfer.handle_report(report(total, [0, 2]))
+    assert transfer.next_segments(1) == [1]
+    transfer.handle_report(report(total, [0, 2]))
+    assert 1 not in transfer.next_segments(10)  # Reported missing again before it could have arrived
+
+
+def test_rate_backs_off_on_new_losses_and_grows_without():
+    total = 100
+    _, transfer = new_transfer(total)
+    transfer.next_segments(10)
+    initial = transfer.rate
+    transfer.handle_report(report(total, [0, 1, 2]))
+    assert transfer.rate == initial + server.RELIABLE_RATE_STEP
+    transfer.handle_report(report(total, [0, 1, 2, 5]))
+    assert transfer.rate == (initial + server.RELIABLE_RATE_STEP) * server.RELIABLE_BACKOFF
+    assert transfer.pacer.transfer_bucket.rate == transfer.rate
+
+
+def test_rate_never_exceeds_the_requested_rate():
+    total = 100
+    _, transfer = new_transfer(total, max_rate=server.RELIABLE_INITIAL_RATE + server.RELIABLE_RATE_STEP // 2)
+    transfer.next_segments(10)
+    for _ in range(3):
+        transfer.handle_report(report(total, range(10)))
+    assert transfer.rate == transfer.max_rate
+
+
+def test_completion_report_ends_the_transfer():
+    total = 20
+    _, transfer = new_transfer(total)
+    transfer.next_segments(total)
+    transfer.handle_report(report(total, range(total)))
+    assert transfer.complete
+
+
+def test_other_packets_are_ignored():
+    _, transfer = new_transfer(10)
+    transfer.handle_report(struct.pack(client.REQUEST_PACKET_FORMAT, client.MAGIC_COOKIE, client.REQUEST_TYPE, 1))
+    assert (transfer.base, transfer.complete) == (0, False)
+
+
+def test_silence_after_every_segment_was_sent_completes_the_transfer():
+    total = 20
+    _, transfer = new_transfer(total)
+    transfer.next_segments(total)
+    transfer.handle_report(report(total, range(total - 1), frontier=total))
+    assert transfer.next_segments(10) == [total - 1]
+    transfer.expire()  # The completion reports were lost
+    assert transfer.complete
+
+
+def test_silence_with_segments_left_is_a_timeout():
+    total = 20
+    _, transfer = new_transfer(total)
+    transfer.next_segments(10)
+    with pytest.raises(TimeoutError):
+        transfer.expire()
+    transfer.next_segments(total)
+    transfer.handle_report(report(total, [0, 1]))
+    with pytest.raises(TimeoutError):
+        transfer.expire()  # Reported missing and not yet retransmitted